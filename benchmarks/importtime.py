@@ -0,0 +1,97 @@
+"""Cold start cost of each magicproxy entry point, measured with python -X importtime
+
+    python benchmarks/importtime.py [--modules magicproxy.config,magicproxy.proxy] [--repeat 5] [--top 10]
+                                    [--output results.json]
+
+Each module is imported in a fresh interpreter, --repeat times. The results are printed as JSON: the best cumulative
+import time of the module and the best wall time of the interpreter, in milliseconds, and the --top slowest imports
+it pulled in, by self time.
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import magicproxy
+
+MODULES = (
+    "magicproxy.config",
+    "magicproxy.mint",
+    "magicproxy.proxy",
+    "magicproxy.async_proxy",
+    "magicproxy.__main__",
+)
+
+
+def _strings(value):
+    return value.split(",")
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--modules", type=_strings, default=list(MODULES))
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--top", type=int, default=10, help="slowest imports listed for each module")
+parser.add_argument("--output", help="write the results there instead of stdout")
+
+
+def import_times(module: str):
+    """The wall time of the interpreter, and (self, cumulative) microseconds of each import, in import order"""
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    wall = time.perf_counter() - start
+    times = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return wall, times
+
+
+def measure(module: str, repeat: int, top: int) -> dict:
+    walls = []
+    cumulatives = []
+    best_times = None
+    for _ in range(repeat):
+        wall, times = import_times(module)
+        walls.append(wall)
+        cumulative = next(cumulative for name, _, cumulative in reversed(times) if name == module)
+        if not cumulatives or cumulative < min(cumulatives):
+            best_times = times
+        cumulatives.append(cumulative)
+    slowest = sorted(best_times, key=lambda entry: entry[1], reverse=True)[:top]
+    return {
+        "import_ms": min(cumulatives) / 1e3,
+        "wall_ms": min(walls) * 1e3,
+        "modules": len(best_times),
+        "slowest": [{"module": name, "self_ms": self_us / 1e3} for name, self_us, _ in slowest],
+    }
+
+
+def main():
+    args = parser.parse_args()
+    results = {module: measure(module, args.repeat, args.top) for module in args.modules}
+    report = {
+        "magicproxy": magicproxy.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Throughput and latency of the flask (sync) and aiohttp (async) proxies, against a local stand-in API
+
+The stand-in API and the proxy each run in their own process, the load is generated by an aiohttp client
+in this one. Every combination of the options is measured, the results are printed as JSON.
+
+    python benchmarks/load.py [--modes sync,async] [--concurrency 1,8,32] [--token-types scopes,allowed]
+                              [--rules 10,100] [--body-sizes 0,65536] [--requests 500] [--output results.json]
+
+A body size of 0 is a GET, anything else a PUT of that many bytes. The rules are the permissions of the
+token (in its scope, or in its allowed list), the ones matching the benchmark requests come last.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import statistics
+import sys
+import time
+
+import aiohttp
+import aiohttp.web
+
+import magicproxy
+from magicproxy import magictoken
+from magicproxy.keys import Keys
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "data")
+HOST = "127.0.0.1"
+GET_PATH = "/repos/bench/bench/pulls"
+PUT_PATH = "/upload"
+STARTUP_TIMEOUT = 15
+
+
+def _integers(value):
+    return [int(item) for item in value.split(",")]
+
+
+def _strings(value):
+    return value.split(",")
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--modes", type=_strings, default=["sync", "async"])
+parser.add_argument("--concurrency", type=_integers, default=[1, 8, 32])
+parser.add_argument("--token-types", type=_strings, default=["scopes", "allowed"])
+parser.add_argument("--rules", type=_integers, default=[10, 100])
+parser.add_argument("--body-sizes", type=_integers, default=[0, 65536])
+parser.add_argument("--requests", type=int, default=500, help="measured requests per combination")
+parser.add_argument("--warmup", type=int, default=20, help="requests before measuring, per combination")
+parser.add_argument("--token-version", type=int, default=1, choices=magictoken.TOKEN_VERSIONS)
+parser.add_argument("--private-key", default=os.path.join(DATA, "private.pem"))
+parser.add_argument("--certificate", default=os.path.join(DATA, "public.x509.cer"))
+parser.add_argument("--output", help="write the results there instead of stdout")
+
+
+def rule_set(size: int):
+    rules = [f"GET /repos/org/repo{number}/.*" for number in range(max(size - 2, 0))]
+    return rules + ["GET /repos/bench/.*", f"PUT {PUT_PATH}"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def serve_api(port: int):
+    async def get(request):
+        return aiohttp.web.json_response([{"number": number, "title": "pull request"} for number in range(10)])
+
+    async def put(request):
+        size = 0
+        async for chunk in request.content.iter_any():
+            size += len(chunk)
+        return aiohttp.web.json_response({"size": size})
+
+    app = aiohttp.web.Application()
+    app.router.add_get(GET_PATH, get)
+    app.router.add_put(PUT_PATH, put)
+    aiohttp.web.run_app(app, host=HOST, port=port, print=None, access_log=None)
+
+
+def serve_proxy(mode: str, port: int, api_root: str, rules, private_key: str, certificate: str):
+    import logging
+
+    from magicproxy import async_proxy, proxy
+    from magicproxy.config import Config, parse_permission
+
+    # stdout is for the results
+    sys.stdout = sys.stderr
+    # the proxies log every request at debug level, not what's measured here
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    config = Config(
+        api_root=api_root,
+        keys=Keys.from_files(private_key, certificate),
+        scopes={"bench": [parse_permission(rule) for rule in rules]},
+    )
+    module = async_proxy if mode == "async" else proxy
+    module.run_app(host=HOST, port=port, config=config)
+
+
+def start(target, *args) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=target, args=args, daemon=True)
+    process.start()
+    return process
+
+
+async def wait_until_up(url: str):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} didn't come up in {STARTUP_TIMEOUT}s")
+            await asyncio.sleep(0.1)
+
+
+async def run_load(proxy_root: str, token: str, body_size: int, concurrency: int, number: int, warmup: int) -> dict:
+    body = os.urandom(body_size) if body_size else None
+    method, url = ("PUT", proxy_root + PUT_PATH) if body_size else ("GET", proxy_root + GET_PATH)
+    headers = {"Authorization": f"Bearer {token}"}
+    latencies = []
+    errors = 0
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+
+        async def one(measured: bool):
+            nonlocal errors
+            start = time.perf_counter()
+            try:
+                async with session.request(method, url, data=body, headers=headers) as response:
+                    await response.read()
+                    ok = response.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            if measured:
+                latencies.append(time.perf_counter() - start)
+                errors += not ok
+
+        async def worker(requests_left, measured: bool):
+            while requests_left:
+                requests_left.pop()
+                await one(measured)
+
+        await worker(list(range(warmup)), False)
+        requests_left = list(range(number))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(requests_left, True) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": number,
+        "errors": errors,
+        "throughput_rps": number / elapsed,
+        "mean_ms": statistics.mean(latencies) * 1e3,
+        "p50_ms": latencies[int(0.50 * (len(latencies) - 1))] * 1e3,
+        "p99_ms": latencies[int(0.99 * (len(latencies) - 1))] * 1e3,
+    }
+
+
+async def benchmark(args, keys: Keys, api_root: str) -> list:
+    results = []
+    for mode in args.modes:
+        for rules_size in args.rules:
+            rules = rule_set(rules_size)
+            port = free_port()
+            proxy_root = f"http://{HOST}:{port}"
+            process = start(serve_proxy, mode, port, api_root, rules, args.private_key, args.certificate)
+            try:
+                await wait_until_up(proxy_root + "/__magictoken")
+                for token_type in args.token_types:
+                    if token_type == "scopes":
+                        token = magictoken.create(keys, "api token", scopes=["bench"], version=args.token_version)
+                    else:
+                        token = magictoken.create(keys, "api token", allowed=rules, version=args.token_version)
+                    for body_size in args.body_sizes:
+                        for concurrency in args.concurrency:
+                            result = await run_load(
+                                proxy_root, token, body_size, concurrency, args.requests, args.warmup
+                            )
+                            result.update(
+                                mode=mode,
+                                token_type=token_type,
+                                rules=rules_size,
+                                body_size=body_size,
+                                concurrency=concurrency,
+                            )
+                            print(json.dumps(result), file=sys.stderr)
+                            results.append(result)
+            finally:
+                process.terminate()
+                process.join()
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    keys = Keys.from_files(args.private_key, args.certificate)
+
+    api_port = free_port()
+    api_root = f"http://{HOST}:{api_port}"
+    api = start(serve_api, api_port)
+    try:
+        asyncio.run(wait_until_up(api_root + GET_PATH))
+        results = asyncio.run(benchmark(args, keys, api_root))
+    finally:
+        api.terminate()
+        api.join()
+
+    report = {
+        "magicproxy": magicproxy.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "token_version": args.token_version,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
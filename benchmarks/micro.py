@@ -0,0 +1,114 @@
+"""Per-call time of the functions on the proxy hot path, in isolation
+
+    python benchmarks/micro.py [--rules 10,100,1000] [--repeat 5] [--output results.json]
+
+Each function is timed with timeit (the best of --repeat runs), the results are printed as JSON in microseconds.
+"""
+
+import argparse
+import json
+import os
+import platform
+import timeit
+
+import magicproxy
+from magicproxy import magictoken, queries, scopes
+from magicproxy.cache import TokenCache
+from magicproxy.config import Config, parse_permission
+from magicproxy.headers import clean_request_headers
+from magicproxy.keys import Keys
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "data")
+PATH = "repos/bench/bench/pulls"
+HEADERS = {
+    "Host": "localhost:5000",
+    "Connection": "keep-alive",
+    "Authorization": "Bearer token",
+    "Accept": "application/vnd.github+json",
+    "Accept-Encoding": "gzip, deflate",
+    "User-Agent": "benchmark",
+    "X-GitHub-Api-Version": "2022-11-28",
+}
+
+
+def _integers(value):
+    return [int(item) for item in value.split(",")]
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--rules", type=_integers, default=[10, 100, 1000], help="rule set sizes for validate_request")
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--private-key", default=os.path.join(DATA, "private.pem"))
+parser.add_argument("--certificate", default=os.path.join(DATA, "public.x509.cer"))
+parser.add_argument("--output", help="write the results there instead of stdout")
+
+
+def rule_set(size: int):
+    # the matching rule comes last
+    return [f"GET /repos/org/repo{number}/.*" for number in range(max(size - 1, 0))] + ["GET /repos/bench/.*"]
+
+
+def time_per_call(function, repeat: int) -> float:
+    """Microseconds per call of function, the best of `repeat` runs of about 0.2s"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def benchmarks(keys: Keys, rule_sizes):
+    for version in magictoken.TOKEN_VERSIONS:
+        token = magictoken.create(keys, "api token", allowed=["GET /user"], version=version)
+        yield f"magictoken.create v{version}", lambda: magictoken.create(
+            keys, "api token", allowed=["GET /user"], version=version
+        )
+        yield f"magictoken.decode v{version}", lambda: magictoken.decode(keys, token)
+
+    cache = TokenCache(maxsize=16)
+    cached_token = magictoken.create(keys, "api token", allowed=["GET /user"])
+    yield "magictoken.decode cached", lambda: magictoken.decode(keys, cached_token, cache)
+
+    for size in rule_sizes:
+        rules = rule_set(size)
+        # without the decision cache, every call goes through the matchers
+        config = Config(keys=keys, scopes={"bench": [parse_permission(rule) for rule in rules]}, decision_cache_size=0)
+        yield f"scopes.validate_request scopes {size} rules", lambda: scopes.validate_request(
+            config, "GET", PATH, ["bench"], None
+        )
+        yield f"scopes.validate_request allowed {size} rules", lambda: scopes.validate_request(
+            config, "GET", PATH, None, rules
+        )
+
+    cached_config = Config(keys=keys, scopes={"bench": [parse_permission(rule) for rule in rule_set(10)]})
+    yield "scopes.validate_request scopes decision cached", lambda: scopes.validate_request(
+        cached_config, "GET", PATH, ["bench"], None
+    )
+
+    query_params_to_clean = {"access_token", "client_id", "client_secret"}
+    yield "queries.clean_path_queries", lambda: queries.clean_path_queries(
+        query_params_to_clean, PATH + "?state=open&per_page=100&access_token=secret"
+    )
+    yield "headers.clean_request_headers", lambda: clean_request_headers(HEADERS, {"X-Forwarded-For"})
+
+
+def main():
+    args = parser.parse_args()
+    keys = Keys.from_files(args.private_key, args.certificate)
+
+    results = {name: time_per_call(function, args.repeat) for name, function in benchmarks(keys, args.rules)}
+    report = {
+        "magicproxy": magicproxy.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "unit": "us",
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
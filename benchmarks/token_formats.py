@@ -0,0 +1,52 @@
+"""Per-request CPU cost of decoding v1 and v2 magic tokens
+
+v1: RS256 signature check and RSA-OAEP decryption of the API token
+v2: HS256 signature check and AES-GCM decryption of the API token
+
+    python benchmarks/token_formats.py [--number 2000]
+"""
+
+import argparse
+import json
+import os
+import time
+
+from magicproxy import magictoken
+from magicproxy.keys import Keys
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "data")
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--number", type=int, default=2000, help="decodes per token version")
+parser.add_argument("--private-key", default=os.path.join(DATA, "private.pem"))
+parser.add_argument("--certificate", default=os.path.join(DATA, "public.x509.cer"))
+
+
+def cpu_time_per_call(function, number):
+    start = time.process_time()
+    for _ in range(number):
+        function()
+    return (time.process_time() - start) / number
+
+
+def main():
+    args = parser.parse_args()
+    keys = Keys.from_files(args.private_key, args.certificate)
+
+    results = {}
+    for version in magictoken.TOKEN_VERSIONS:
+        token = magictoken.create(keys, "api token", allowed=["GET /user"], version=version)
+        results[f"v{version}"] = {
+            "decode_us": cpu_time_per_call(lambda: magictoken.decode(keys, token), args.number) * 1e6,
+            "create_us": cpu_time_per_call(
+                lambda: magictoken.create(keys, "api token", allowed=["GET /user"], version=version),
+                args.number // 10 or 1,
+            )
+            * 1e6,
+        }
+    results["decode_speedup"] = results["v1"]["decode_us"] / results["v2"]["decode_us"]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,42 @@
 import json
 import os
-import redis
-import re
+import redis.asyncio as redis
 
 # allows to create a Digital Ocean domain record
 # on a certain domain only and allows to
 # clean up delete it afterwards, and that's it
 # stores state in a redis server
+# async hooks: they don't block the event loop of the async proxy (python -m magicproxy --async)
+# the redis client is made in each call, a client is bound to the event loop it first ran on, and
+# the Flask proxy runs each call of an async hook in its own event loop
 
 DOMAIN = os.environ["DOMAIN"]
-client = redis.Redis.from_url(os.environ["REDIS_URL"])
+REDIS_URL = os.environ["REDIS_URL"]
 domain_records_root = f"/v2/domains/{DOMAIN}/records"
 
 
-def is_request_allowed(method, path):
+async def is_request_allowed(method, path):
     if method == "POST" and path == domain_records_root:
         return True
-    allowed = client.lrange("allowed", 0, -1)
+    async with redis.Redis.from_url(REDIS_URL) as client:
+        allowed = await client.lrange("allowed", 0, -1)
     if not allowed:
         return False
     for allowed_element in allowed:
         try:
             allowed_method, allowed_path = allowed_element.decode("utf-8").split(" ", 1)
-        except:
+        except ValueError:
             continue
         if method == allowed_method and path == allowed_path:
             return True
     return False
 
 
-def response_callback(content: bytes, code, headers):
+async def response_callback(method, path, content: bytes, code, headers):
+    if method != "POST" or path != domain_records_root:
+        return
     data = json.loads(content.decode("utf-8"))
 
     domain_id = data["domain_record"]["id"]
-    client.lpush("allowed", f"DELETE {domain_records_root}/{domain_id}")  # push an 'allow delete' on that id
+    async with redis.Redis.from_url(REDIS_URL) as client:
+        await client.lpush("allowed", f"DELETE {domain_records_root}/{domain_id}")  # push an 'allow delete' on that id
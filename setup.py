@@ -48,6 +48,9 @@ setup(
         "aiohttp",
         "pyopenssl",
     ],
+    extras_require={
+        "redis": ["redis>=4.2"],
+    },
     python_requires=">=3.6",
     project_urls={
         "Bug Reports": "https://github.com/rienafairefr/magic-api-proxy/issues",
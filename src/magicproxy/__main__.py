@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import json
 import logging
+import sys
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG)
@@ -26,14 +28,70 @@ parser.add_argument(
 )
 parser.add_argument("--port", type=int, default=5000)
 parser.add_argument("--host", type=str, default="127.0.0.1")
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="number of pre-forked worker processes, sharing the listening socket",
+)
+subparsers = parser.add_subparsers(dest="command", help="serve (the default) or mint")
+subparsers.add_parser("serve", help="run the proxy")
+mint_parser = subparsers.add_parser(
+    "mint",
+    help="mint tokens locally, without a server",
+    description="Reads one JSON magic token spec per line (like the POST /__magictoken body), "
+    'writes one JSON result per line, {"token": ...} or {"error": ...}, in the same order. '
+    "The keys, scopes and token version come from the proxy config.",
+)
+mint_parser.add_argument(
+    "input", nargs="?", type=argparse.FileType("r"), default="-", help="JSONL specs (default stdin)"
+)
+mint_parser.add_argument("--output", type=argparse.FileType("w"), default="-", help="JSONL results (default stdout)")
+mint_parser.add_argument("--processes", type=int, default=None, help="signing processes (default one per core)")
 
 
-def main():
-    from magicproxy import proxy, async_proxy
+def mint_command(args):
+    from magicproxy.config import load_config
+    from magicproxy.mint import mint
+
+    logger.setLevel(logging.WARNING)
+    try:
+        config = load_config()
+    except RuntimeError as e:
+        sys.exit(f"invalid config: {e}")
+    with args.input, args.output:
+        for result in mint(config, args.input, processes=args.processes):
+            args.output.write(json.dumps(result) + "\n")
+            args.output.flush()
 
+
+def main():
     args = parser.parse_args()
-    module = async_proxy if args.run_async else proxy
-    module.run_app(host=args.host, port=args.port)
+    if args.command == "mint":
+        mint_command(args)
+        return
+
+    # each mode only imports its own server stack
+    if args.run_async:
+        from magicproxy import async_proxy as module
+    else:
+        from magicproxy import proxy as module
+    if args.workers <= 1:
+        module.run_app(host=args.host, port=args.port)
+        return
+
+    from magicproxy import workers
+    from magicproxy.config import load_config
+
+    # loaded once, shared with the workers
+    try:
+        config = load_config()
+    except RuntimeError:
+        # the workers will run, but in degraded mode (503)
+        config = None
+    sock = workers.listening_socket(args.host, args.port)
+    logger.info("listening on %s:%s with %s workers", args.host, args.port, args.workers)
+    workers.serve(lambda: module.run_app(host=args.host, port=args.port, config=config, sock=sock), args.workers)
 
 
 if __name__ == "__main__":
@@ -11,19 +11,35 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import contextlib
+import functools
 import logging
-from typing import Set
+import signal
+import socket
+import threading
+import time
+import traceback
+from typing import Optional, Set
 
 import aiohttp
 import aiohttp.web
 
 import magicproxy
-from magicproxy.magictoken import magictoken_params_validate
-from . import magictoken
+from magicproxy.magictoken import magictoken_batch_results, magictoken_batch_validate, magictoken_params_validate
+from . import limiter
 from . import queries
 from . import scopes
+from .cache import ResponseCache
 from .config import Config, load_config
+from .executor import CryptoExecutor
 from .headers import clean_request_headers, clean_response_headers
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Metrics
+from .plugins import InvalidPluginError
+from .profiling import Profiler
+from .ratelimit import retry_after_headers
+from .reload import ConfigHolder, Reloader
+from .singleflight import SingleFlight
 
 routes = aiohttp.web.RouteTableDef()
 logger = logging.getLogger(__name__)
@@ -34,60 +50,207 @@ custom_request_headers_to_clean: Set[str] = set()
 
 @routes.get("/__magictoken")
 async def magic_token_version(request):
-    CONFIG = request.app["CONFIG"]
+    CONFIG = request.app["CONFIG_HOLDER"].config
     return aiohttp.web.Response(body="magic API proxy for " + CONFIG.api_root + " version " + magicproxy.__version__)
 
 
 @routes.post("/__magictoken")
 async def create_magic_token(request):
-    CONFIG = request.app["CONFIG"]
+    CONFIG = request.app["CONFIG_HOLDER"].config
     params = await request.json()
 
+    if isinstance(params, list):
+        return await create_magic_tokens(request, params)
+
     try:
         magictoken_params_validate(CONFIG, params)
     except ValueError as e:
         raise aiohttp.web.HTTPBadRequest(body=str(e))
 
-    token = magictoken.create(CONFIG.keys, params["token"], params.get("scopes"), params.get("allowed"))
+    token = await request.app["CRYPTO_EXECUTOR"].create(params["token"], params.get("scopes"), params.get("allowed"))
 
     return aiohttp.web.Response(body=token, headers={"Content-Type": "application/jwt"})
 
 
-async def _proxy_request(request, url, headers=None, **kwargs):
+async def create_magic_tokens(request, items: list):
+    """Mints a batch of tokens, the response lists the token or the error of each item"""
+    CONFIG = request.app["CONFIG_HOLDER"].config
+    try:
+        errors = magictoken_batch_validate(CONFIG, items)
+    except ValueError as e:
+        raise aiohttp.web.HTTPBadRequest(body=str(e))
+
+    specs = [item for item, error in zip(items, errors) if error is None]
+    tokens = await request.app["CRYPTO_EXECUTOR"].create_batch(specs) if specs else []
+
+    return aiohttp.web.json_response(magictoken_batch_results(errors, tokens))
+
+
+def _pool_stats(connector: aiohttp.TCPConnector) -> dict:
+    return {
+        "limit": connector.limit,
+        "limit_per_host": connector.limit_per_host,
+        "acquired": len(getattr(connector, "_acquired", ())),
+        "idle": sum(len(connections) for connections in getattr(connector, "_conns", {}).values()),
+    }
+
+
+@routes.get("/__metrics")
+async def show_metrics(request):
+    CONFIG = request.app["CONFIG_HOLDER"].config
+    if CONFIG is None:
+        raise aiohttp.web.HTTPServiceUnavailable(body="magic API proxy version " + magicproxy.__version__)
+    if not CONFIG.metrics_enabled:
+        raise aiohttp.web.HTTPNotFound(body="Metrics disabled")
+    single_flight = request.app["SINGLE_FLIGHT"]
+    stats = {
+        "upstream_pool": _pool_stats(request.app["CLIENT_SESSION"].connector),
+        "crypto_executor": request.app["CRYPTO_EXECUTOR"].stats(),
+        "token_cache": CONFIG.token_cache.stats() if CONFIG.token_cache is not None else None,
+        "response_cache": CONFIG.response_cache.stats() if CONFIG.response_cache is not None else None,
+        "decision_cache": CONFIG.decisions.stats() if CONFIG.decisions is not None else None,
+        "rate_limits": CONFIG.rate_limits.stats() if CONFIG.rate_limits is not None else None,
+        "token_limiter": CONFIG.limiter.stats(),
+        "config_reload": request.app["RELOADER"].stats() if request.app["RELOADER"] is not None else None,
+        "single_flight": single_flight.stats() if single_flight is not None else None,
+        "background_tasks": {"count": len(request.app["BACKGROUND_TASKS"])},
+    }
+    return aiohttp.web.Response(
+        body=request.app["METRICS"].render(stats), headers={"Content-Type": METRICS_CONTENT_TYPE}
+    )
+
+
+async def _proxy_request(
+    request,
+    url,
+    headers=None,
+    keep_content: Optional[int] = None,
+    response_cache: ResponseCache = None,
+    cache_key: tuple = None,
+    single_flight: SingleFlight = None,
+    flight_key: tuple = None,
+    **kwargs,
+):
+    """Streams the API response to the client
+
+    Args:
+      keep_content: when set, the API response content is also kept, up to that many bytes
+      response_cache, cache_key: the cache the response is revalidated from and stored in
+      single_flight, flight_key: the identical concurrent requests share one API call through single_flight
+
+    Returns:
+      the response served to the client, and the content, code and headers of the API response.
+      The content is None when it was not kept, or when it was larger than keep_content
+    """
+    leading = False
+    if flight_key is not None:
+        call = single_flight.join(flight_key)
+        if call is None:
+            leading = True
+            keep_content = max(keep_content or 0, single_flight.max_size)
+        else:
+            # the shield keeps this request cancellation from cancelling the shared call
+            shared = await asyncio.shield(call)
+            if shared is not None:
+                return await _buffered_response(request, *shared), shared
+
+    shared = None
+    try:
+        response, result = await _fetch(request, url, headers, keep_content, response_cache, cache_key, **kwargs)
+        if leading and result[0] is not None and len(result[0]) <= single_flight.max_size:
+            shared = result
+        return response, result
+    finally:
+        if leading:
+            single_flight.finish(flight_key, shared)
+
+
+async def _buffered_response(request, content: bytes, code: int, headers):
+    response = aiohttp.web.Response(body=content, status=code, headers=clean_response_headers(headers))
+    await response.prepare(request)
+    await response.write_eof()
+    return response
+
+
+async def _fetch(request, url, headers, keep_content, response_cache, cache_key, **kwargs):
     clean_headers = clean_request_headers(request.headers, custom_request_headers_to_clean)
 
     if headers:
         clean_headers.update(headers)
 
+    cached = None
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            clean_headers.update(response_cache.conditional_headers(cached))
+        keep_content = max(keep_content or 0, response_cache.max_entry_size)
+
     logger.debug(f"Proxying to {request.method} {url}\n")
 
-    async with aiohttp.ClientSession() as session:
-        proxied_request = session.request(
-            url=url,
-            method=request.method,
-            headers=clean_headers,
-            params=request.query,
-            data=request.content,
-            **kwargs,
-        )
-        async with proxied_request as proxied_response:
-            response_headers = clean_response_headers(proxied_response.headers)
+    metrics: Metrics = request.app["METRICS"]
+    session: aiohttp.ClientSession = request.app["CLIENT_SESSION"]
+    start = time.perf_counter()
+    proxied_request = session.request(
+        url=url,
+        method=request.method,
+        headers=clean_headers,
+        params=request.query,
+        # streamed from the client as it's sent, never buffered
+        data=request.content if request.body_exists else None,
+        **kwargs,
+    )
+    async with proxied_request as proxied_response:
+        metrics.observe("upstream_ttfb", time.perf_counter() - start)
+        if cached is not None and proxied_response.status == 304:
+            metrics.observe("upstream", time.perf_counter() - start)
+            cached = response_cache.revalidated(cache_key, cached, proxied_response.headers)
+            response = await _buffered_response(request, cached.content, cached.code, cached.headers)
+            return response, (cached.content, cached.code, cached.headers)
+
+        response_headers = clean_response_headers(proxied_response.headers)
+
+        response = aiohttp.web.StreamResponse(status=proxied_response.status, headers=response_headers)
 
-            response = aiohttp.web.StreamResponse(status=proxied_response.status, headers=response_headers)
+        await response.prepare(request)
 
-            await response.prepare(request)
+        content = bytearray() if keep_content is not None else None
+        async for data, last in proxied_response.content.iter_chunks():
+            await response.write(data)
+            if content is not None:
+                content += data
+                if len(content) > keep_content:
+                    logger.debug(f"{request.method} {url} response content larger than {keep_content} bytes")
+                    content = None
+        metrics.observe("upstream", time.perf_counter() - start)
 
-            async for data, last in proxied_response.content.iter_chunks():
-                await response.write(data)
+        await response.write_eof()
 
-            await response.write_eof()
+        if content is not None:
+            content = bytes(content)
+            if cache_key is not None:
+                response_cache.store(cache_key, content, proxied_response.status, proxied_response.headers)
+        return response, (content, proxied_response.status, proxied_response.headers)
 
-            return data, proxied_response.status, proxied_response.headers
+
+async def _response_callback(config: Config, metrics: Metrics, method, path, content, code, headers, token_scopes):
+    try:
+        with metrics.time("response_callback"):
+            await scopes.response_callback_async(config, method, path, content, code, headers, token_scopes)
+    except Exception as e:
+        logger.error("exception in response_callback")
+        logger.error(e)
+        logger.error(traceback.format_exc())
+
+
+def _run_in_background(app, coroutine):
+    task = asyncio.ensure_future(coroutine)
+    app["BACKGROUND_TASKS"].add(task)
+    task.add_done_callback(app["BACKGROUND_TASKS"].discard)
 
 
 @routes.route("*", "/{path:.*}")
 async def proxy_api(request):
-    CONFIG = request.app["CONFIG"]
+    CONFIG = request.app["CONFIG_HOLDER"].config
     path = request.match_info["path"]
 
     auth_token = request.headers.get("Authorization")
@@ -98,42 +261,212 @@ async def proxy_api(request):
     if auth_token.startswith("Bearer "):
         auth_token = auth_token[len("Bearer ") :]
 
+    metrics: Metrics = request.app["METRICS"]
+
     # Validate the magic token
-    token_info = magictoken.decode(CONFIG.keys, auth_token)
+    with metrics.time("decode"):
+        token_info = await request.app["CRYPTO_EXECUTOR"].decode(auth_token)
+    request["TOKEN_SCOPES"] = token_info.scopes
 
     # Validate scopes againt URL and method.
-    if not scopes.validate_request(CONFIG, request.method, request.path, token_info.scopes, token_info.allowed):
+    try:
+        with metrics.time("validate"):
+            allowed = await scopes.validate_request_async(
+                CONFIG, request.method, request.path, token_info.scopes, token_info.allowed
+            )
+    except InvalidPluginError:
+        # a lazy scope plugin that failed to import
+        raise aiohttp.web.HTTPServiceUnavailable(body="Scope plugin unavailable")
+    if not allowed:
         raise aiohttp.web.HTTPForbidden(body="Disallowed by API proxy.")
 
+    token_rate_limit = scopes.rate_limit(CONFIG, token_info.scopes)
+    if token_rate_limit is not None:
+        retry_after = await CONFIG.limiter.check_async(limiter.key(token_info.issued_at, auth_token), *token_rate_limit)
+        if retry_after is not None:
+            raise aiohttp.web.HTTPTooManyRequests(
+                body="Rate limit of the magic token exceeded", headers=retry_after_headers(retry_after)
+            )
+
     path = queries.clean_path_queries(query_params_to_clean, path)
 
-    response = await _proxy_request(
+    if CONFIG.rate_limits is not None:
+        priority = scopes.priority(CONFIG, token_info.scopes)
+        deadline = time.monotonic() + CONFIG.rate_limit_max_wait
+        retry_after = CONFIG.rate_limits.check(token_info.token, path, priority)
+        while retry_after is not None:
+            if time.monotonic() + retry_after > deadline:
+                raise aiohttp.web.HTTPTooManyRequests(
+                    body="API rate limit almost exhausted", headers=retry_after_headers(retry_after)
+                )
+            # queued until the quota resets
+            await asyncio.sleep(retry_after)
+            # checked again: the responses meanwhile may have told another quota
+            retry_after = CONFIG.rate_limits.check(token_info.token, path, priority)
+
+    has_response_callback = scopes.has_response_callback(CONFIG, token_info.scopes)
+
+    cache_key = None
+    if CONFIG.response_cache is not None:
+        cache_key = CONFIG.response_cache.key(
+            request.method, path, request.query_string, request.headers, token_info.token
+        )
+
+    single_flight = request.app["SINGLE_FLIGHT"]
+    flight_key = None
+    if single_flight is not None and not request.body_exists:
+        flight_key = single_flight.key(request.method, path, request.query_string, request.headers, token_info.token)
+
+    response, (content, code, headers) = await _proxy_request(
         request=request,
         url=f"{CONFIG.api_root}/{path}",
         headers={"Authorization": f"Bearer {token_info.token}"},
+        keep_content=CONFIG.response_callback_max_size if has_response_callback else None,
+        response_cache=CONFIG.response_cache,
+        cache_key=cache_key,
+        single_flight=single_flight,
+        flight_key=flight_key,
     )
 
-    try:
-        scopes.response_callback(CONFIG, request.method, path, *response, token_info.scopes)
-    except Exception as e:
-        logger.error(e)
+    if CONFIG.rate_limits is not None:
+        CONFIG.rate_limits.update(token_info.token, path, headers)
+
+    if has_response_callback:
+        if content is None or len(content) > CONFIG.response_callback_max_size:
+            logger.error(f"{request.method} {path} response too large, response_callback not called")
+        else:
+            # the client has its response already, the plugins don't delay it
+            _run_in_background(
+                request.app,
+                _response_callback(CONFIG, metrics, request.method, path, content, code, headers, token_info.scopes),
+            )
     return response
 
 
-async def build_app(config: Config = None):
-    app = aiohttp.web.Application()
+@aiohttp.web.middleware
+async def count_requests(request, handler):
+    """Counts the proxied requests by status and token scopes"""
+    if request.match_info.handler is not proxy_api:
+        return await handler(request)
+    # the server error status, unless the handler returns or raises another one
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except aiohttp.web.HTTPException as e:
+        status = e.status
+        raise
+    except asyncio.CancelledError:
+        # the client went away (the nginx status for it)
+        status = 499
+        raise
+    finally:
+        request.app["METRICS"].count_request(status, request.get("TOKEN_SCOPES"))
+
+
+@aiohttp.web.middleware
+async def profile_requests(request, handler):
+    """Profiles the first proxied requests, when the config asks for it"""
+    profiler = request.app["PROFILER"]
+    if profiler is None or profiler.done or request.match_info.handler is not proxy_api:
+        return await handler(request)
+    with profiler.request():
+        return await handler(request)
+
+
+async def client_session_ctx(app):
+    """Shares one pooled ClientSession to the API between all the requests of the app"""
+    config = app["CONFIG_HOLDER"].config or Config()
+    connector = aiohttp.TCPConnector(
+        limit=config.upstream_limit,
+        limit_per_host=config.upstream_limit_per_host,
+        keepalive_timeout=config.upstream_keepalive_timeout,
+        ttl_dns_cache=config.upstream_dns_cache_ttl,
+    )
+    app["CLIENT_SESSION"] = aiohttp.ClientSession(connector=connector)
+    yield
+    await app["CLIENT_SESSION"].close()
+
+
+async def crypto_executor_ctx(app):
+    """Runs the token crypto in a pool, so that it doesn't block the event loop"""
+    executor = CryptoExecutor(app["CONFIG_HOLDER"].config or Config())
+    app["CRYPTO_EXECUTOR"] = executor
+    yield
+    executor.shutdown()
+
+
+async def background_tasks_ctx(app):
+    """Tracks the tasks that outlive their request, they are awaited on shutdown"""
+    app["BACKGROUND_TASKS"] = set()
+    yield
+    await asyncio.gather(*app["BACKGROUND_TASKS"], return_exceptions=True)
+
+
+def _swap_config(app, config: Config):
+    """Makes config the current one, the requests in flight finish with the one they started with"""
+    # decodes with the keys and token cache of the config, in new pools if the keys changed
+    app["CRYPTO_EXECUTOR"].update(config)
+    app["CONFIG_HOLDER"].config = config
+
+
+async def reload_ctx(app):
+    """Reloads the config on SIGHUP, and when its files change if config_reload_interval is set"""
+    reloader: Optional[Reloader] = app["RELOADER"]
+    if reloader is None:
+        yield
+        return
+    loop = asyncio.get_event_loop()
+    on_signal = hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread()
+    if on_signal:
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.run_in_executor(None, reloader.reload))
+    interval = reloader.config.config_reload_interval if reloader.config is not None else 0
+    watcher = asyncio.ensure_future(reloader.watch(interval)) if interval else None
+    yield
+    if watcher is not None:
+        watcher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await watcher
+    if on_signal:
+        loop.remove_signal_handler(signal.SIGHUP)
+
+
+async def build_app(config: Config = None, reload: bool = False):
+    """The aiohttp app, serving config
+
+    Args:
+      reload: the config can be reloaded, from CONFIG_FILE and the environment, through the RELOADER of the app
+    """
+    app = aiohttp.web.Application(middlewares=[count_requests, profile_requests])
     if config is None:
         try:
             config = load_config()
         except RuntimeError:
             # will run, but in degraded mode (503)
             pass
-    app["CONFIG"] = config
+    # the app state can't change once it runs, a reload swaps the config in the holder
+    app["CONFIG_HOLDER"] = ConfigHolder(config)
+    app["RELOADER"] = Reloader(config, functools.partial(_swap_config, app)) if reload else None
+    app["METRICS"] = Metrics()
+    app["PROFILER"] = None
+    if config is not None and config.profile_requests:
+        # the requests interleave on the event loop, they share one profile
+        app["PROFILER"] = Profiler(config.profile_requests, config.profile_output, shared=True)
+    app["SINGLE_FLIGHT"] = SingleFlight(config.coalesce_max_size) if config and config.coalesce_requests else None
+    app.cleanup_ctx.append(client_session_ctx)
+    app.cleanup_ctx.append(crypto_executor_ctx)
+    app.cleanup_ctx.append(background_tasks_ctx)
+    app.cleanup_ctx.append(reload_ctx)
     app.add_routes(routes)
     return app
 
 
-def run_app(host, port, config: Config = None):
-    app = build_app(config)
-    aiohttp.web.run_app(app, host=host, port=port)
+def run_app(host, port, config: Config = None, sock: socket.socket = None):
+    app = build_app(config, reload=True)
+    if sock is not None:
+        # a worker process, serving on the socket it inherited
+        aiohttp.web.run_app(app, sock=sock)
+    else:
+        aiohttp.web.run_app(app, host=host, port=port)
     return app
@@ -0,0 +1,222 @@
+import dataclasses
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterator, Mapping, Optional
+
+from magicproxy.types import DecodeResult
+
+
+class LRUCache:
+    """Thread-safe LRU cache, bounded in entries and optionally in weight, with an optional time-to-live
+
+    Args:
+      maxsize: the maximum number of entries kept, the least recently used are evicted first
+      ttl: the default time-to-live of an entry in seconds, None for no expiry
+      maxweight: the maximum total weight of the entries (e.g. their size in bytes), None for no bound
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None, maxweight: Optional[int] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key: Hashable):
+        _, _, weight = self._data.pop(key)
+        self.weight -= weight
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value, deadline, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if deadline is not None and deadline <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, weight: int = 0):
+        """Stores value under key
+
+        The entry lives for the smallest of ttl and the cache default ttl, an entry that would
+        already be expired, or that would be heavier than maxweight on its own, is not stored.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        elif self.ttl is not None:
+            ttl = min(ttl, self.ttl)
+        if ttl is not None and ttl <= 0:
+            return
+        if self.maxweight is not None and weight > self.maxweight:
+            return
+        deadline = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, deadline, weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+        return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "weight": self.weight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class TokenCache(LRUCache):
+    """Cache of verified magic tokens
+
+    Entries are keyed by the SHA-256 digest of the magic token, they never outlive the token
+    'exp' claim. The decrypted API token only ever lives in this process memory.
+    """
+
+    @staticmethod
+    def fingerprint(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get_token(self, token: str) -> Optional[DecodeResult]:
+        return self.get(self.fingerprint(token))
+
+    def set_token(self, token: str, result: DecodeResult):
+        ttl = None if result.expires_at is None else result.expires_at - time.time()
+        self.set(self.fingerprint(token), result, ttl=ttl)
+
+
+def _header(headers: Mapping, name: str) -> Optional[str]:
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+@dataclasses.dataclass
+class CachedResponse:
+    content: bytes
+    code: int
+    headers: dict
+
+
+class ResponseCache(LRUCache):
+    """Cache of the API GET responses, revalidated with conditional requests
+
+    Entries are keyed by path, query, the request headers the content depends on, and a SHA-256
+    digest of the API token, a response is only ever served again to the token that got it.
+    Only the responses with an ETag or a Last-Modified header are kept, they are served again when
+    the API answers a conditional request with a 304 Not Modified.
+
+    Args:
+      maxsize: the maximum number of responses kept
+      maxweight: the maximum total size of the contents kept, in bytes
+      max_entry_size: the maximum size of one content kept, in bytes
+    """
+
+    # the response content depends on these request headers, they are part of the key
+    KEY_REQUEST_HEADERS = ("Accept", "X-GitHub-Api-Version")
+    # requests that ask for something else than the whole current content
+    BYPASS_REQUEST_HEADERS = ("If-None-Match", "If-Modified-Since", "If-Range", "Range", "Cache-Control")
+    # a response can still be kept if it varies on these (the token is in the key, the content is decoded)
+    VARY_HEADERS = {name.lower() for name in KEY_REQUEST_HEADERS + ("Authorization", "Accept-Encoding")}
+    # the headers of a 304 Not Modified that must not replace the cached ones
+    CONTENT_HEADERS = {"content-length", "content-type", "content-encoding", "transfer-encoding"}
+
+    def __init__(self, maxsize: int, maxweight: int, max_entry_size: int):
+        super().__init__(maxsize=maxsize, maxweight=maxweight)
+        self.max_entry_size = max_entry_size
+
+    def key(self, method: str, path: str, query_string, request_headers: Mapping, api_token: str) -> Optional[tuple]:
+        """The cache key of a request, None if its response can't be cached"""
+        if method != "GET":
+            return None
+        if any(name in request_headers for name in self.BYPASS_REQUEST_HEADERS):
+            return None
+        token_digest = hashlib.sha256(api_token.encode("utf-8")).hexdigest()
+        headers = tuple(request_headers.get(name) for name in self.KEY_REQUEST_HEADERS)
+        return (path, str(query_string), token_digest) + headers
+
+    @staticmethod
+    def conditional_headers(cached: CachedResponse) -> dict:
+        headers = {}
+        etag = _header(cached.headers, "ETag")
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        last_modified = _header(cached.headers, "Last-Modified")
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def cacheable(self, code: int, headers: Mapping) -> bool:
+        if code != 200:
+            return False
+        if _header(headers, "ETag") is None and _header(headers, "Last-Modified") is None:
+            return False
+        if "no-store" in (_header(headers, "Cache-Control") or "").lower():
+            return False
+        vary = {name.strip().lower() for name in (_header(headers, "Vary") or "").split(",") if name.strip()}
+        return vary <= self.VARY_HEADERS
+
+    def store(self, key: tuple, content: bytes, code: int, headers: Mapping):
+        if len(content) > self.max_entry_size or not self.cacheable(code, headers):
+            return
+        self.set(key, CachedResponse(content, code, dict(headers)), weight=len(content))
+
+    def tee(self, key: tuple, chunks: Iterator[bytes], code: int, headers: Mapping) -> Iterator[bytes]:
+        """Passes the chunks through, and stores the content once they have all been read"""
+        content: Optional[bytearray] = bytearray() if self.cacheable(code, headers) else None
+        try:
+            for chunk in chunks:
+                yield chunk
+                if content is not None:
+                    content += chunk
+                    if len(content) > self.max_entry_size:
+                        content = None
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+        if content is not None:
+            self.store(key, bytes(content), code, headers)
+
+    def revalidated(self, key: tuple, cached: CachedResponse, headers: Mapping) -> CachedResponse:
+        """The cached response, updated with the headers of the 304 Not Modified that revalidated it"""
+        updated = {name: value for name, value in headers.items() if name.lower() not in self.CONTENT_HEADERS}
+        updated_names = {name.lower() for name in updated}
+        merged = {name: value for name, value in cached.headers.items() if name.lower() not in updated_names}
+        merged.update(updated)
+        revalidated = CachedResponse(cached.content, cached.code, merged)
+        self.set(key, revalidated, weight=len(cached.content))
+        return revalidated
@@ -6,11 +6,17 @@ import pathlib
 import types
 import typing
 from collections.abc import Mapping
-from typing import Union
+from typing import TYPE_CHECKING, Union
 
-from magicproxy.keys import Keys
+from magicproxy.cache import LRUCache, ResponseCache, TokenCache
+from magicproxy.limiter import MemoryLimiter, RedisLimiter, create_limiter
+from magicproxy.matcher import PermissionMatcher, compile_scopes
 from magicproxy.plugins import load_plugins
-from magicproxy.types import Permission
+from magicproxy.ratelimit import RateLimits
+from magicproxy.types import Permission, ScopeSettings
+
+if TYPE_CHECKING:
+    from magicproxy.keys import Keys
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +26,24 @@ DEFAULT_PRIVATE_KEY_LOCATION = os.path.join(DEFAULT_KEYS_LOCATION, "private.pem"
 DEFAULT_PUBLIC_KEY_LOCATION = os.path.join(DEFAULT_KEYS_LOCATION, "public.pem")
 DEFAULT_PUBLIC_CERTIFICATE_LOCATION = os.path.join(DEFAULT_KEYS_LOCATION, "public.x509.cer")
 DEFAULT_PUBLIC_ACCESS = "http://localhost:5000"
+DEFAULT_TOKEN_CACHE_TTL = 300
+DEFAULT_UPSTREAM_LIMIT = 100
+DEFAULT_UPSTREAM_LIMIT_PER_HOST = 0
+DEFAULT_UPSTREAM_KEEPALIVE_TIMEOUT = 15
+DEFAULT_UPSTREAM_DNS_CACHE_TTL = 10
+DEFAULT_UPSTREAM_POOL_CONNECTIONS = 10
+DEFAULT_UPSTREAM_POOL_MAXSIZE = 10
+DEFAULT_RESPONSE_CALLBACK_MAX_SIZE = 10 * 1024 * 1024
+DEFAULT_RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_RESPONSE_CACHE_MAX_ENTRY_SIZE = 1024 * 1024
+DEFAULT_COALESCE_MAX_SIZE = 1024 * 1024
+DEFAULT_PROFILE_OUTPUT = "magicproxy.prof"
+DEFAULT_MAGICTOKEN_BATCH_MAX_SIZE = 1000
+DEFAULT_DECISION_CACHE_SIZE = 4096
+DEFAULT_TOKEN_LIMITER_SIZE = 100000
+DEFAULT_PLUGIN_IMPORT_BUDGET = 0.5
+# the decisions are keyed by the allowed list of the token, this bounds the total number of rules in their keys
+DECISION_CACHE_MAX_RULES = 1024 * 1024
 
 DEFAULT_CONFIG = dict(
     api_root=DEFAULT_API_ROOT,
@@ -28,8 +52,46 @@ DEFAULT_CONFIG = dict(
     public_certificate_location=DEFAULT_PUBLIC_CERTIFICATE_LOCATION,
     public_access=DEFAULT_PUBLIC_ACCESS,
     plugins_location=None,
+    plugins_lazy=False,
+    plugin_import_budget=DEFAULT_PLUGIN_IMPORT_BUDGET,
     scopes={},
+    scope_settings={},
     keys=None,
+    token_cache_size=0,
+    token_cache_ttl=DEFAULT_TOKEN_CACHE_TTL,
+    token_cache=None,
+    upstream_limit=DEFAULT_UPSTREAM_LIMIT,
+    upstream_limit_per_host=DEFAULT_UPSTREAM_LIMIT_PER_HOST,
+    upstream_keepalive_timeout=DEFAULT_UPSTREAM_KEEPALIVE_TIMEOUT,
+    upstream_dns_cache_ttl=DEFAULT_UPSTREAM_DNS_CACHE_TTL,
+    upstream_pool_connections=DEFAULT_UPSTREAM_POOL_CONNECTIONS,
+    upstream_pool_maxsize=DEFAULT_UPSTREAM_POOL_MAXSIZE,
+    stream_responses=False,
+    token_version=1,
+    crypto_executor="thread",
+    crypto_workers=None,
+    response_callback_max_size=DEFAULT_RESPONSE_CALLBACK_MAX_SIZE,
+    response_cache_size=0,
+    response_cache_max_bytes=DEFAULT_RESPONSE_CACHE_MAX_BYTES,
+    response_cache_max_entry_size=DEFAULT_RESPONSE_CACHE_MAX_ENTRY_SIZE,
+    response_cache=None,
+    coalesce_requests=False,
+    coalesce_max_size=DEFAULT_COALESCE_MAX_SIZE,
+    metrics_enabled=True,
+    profile_requests=0,
+    profile_output=DEFAULT_PROFILE_OUTPUT,
+    magictoken_batch_max_size=DEFAULT_MAGICTOKEN_BATCH_MAX_SIZE,
+    decision_cache_size=DEFAULT_DECISION_CACHE_SIZE,
+    rate_limit_reserve=None,
+    rate_limit_max_wait=0,
+    rate_limits=None,
+    token_rate_limit=None,
+    token_rate_burst=None,
+    token_limiter_backend="memory",
+    token_limiter_size=DEFAULT_TOKEN_LIMITER_SIZE,
+    token_limiter_redis_url=None,
+    limiter=None,
+    config_reload_interval=0,
 )
 
 
@@ -41,8 +103,75 @@ class Config:
     public_certificate_location: Union[str, pathlib.Path] = DEFAULT_PUBLIC_CERTIFICATE_LOCATION
     public_access: str = DEFAULT_PUBLIC_ACCESS
     plugins_location: Union[str, pathlib.Path] = None
+    plugins_lazy: bool = False
+    plugin_import_budget: float = DEFAULT_PLUGIN_IMPORT_BUDGET
     scopes: typing.Dict[str, Union[Permission, types.ModuleType]] = dataclasses.field(default_factory=lambda: {})
-    keys: Keys = None
+    scope_settings: typing.Dict[str, ScopeSettings] = dataclasses.field(default_factory=lambda: {})
+    keys: "Keys" = None
+    token_cache_size: int = 0
+    token_cache_ttl: float = DEFAULT_TOKEN_CACHE_TTL
+    token_cache: TokenCache = None
+    upstream_limit: int = DEFAULT_UPSTREAM_LIMIT
+    upstream_limit_per_host: int = DEFAULT_UPSTREAM_LIMIT_PER_HOST
+    upstream_keepalive_timeout: float = DEFAULT_UPSTREAM_KEEPALIVE_TIMEOUT
+    upstream_dns_cache_ttl: int = DEFAULT_UPSTREAM_DNS_CACHE_TTL
+    upstream_pool_connections: int = DEFAULT_UPSTREAM_POOL_CONNECTIONS
+    upstream_pool_maxsize: int = DEFAULT_UPSTREAM_POOL_MAXSIZE
+    stream_responses: bool = False
+    token_version: int = 1
+    crypto_executor: str = "thread"
+    crypto_workers: int = None
+    response_callback_max_size: int = DEFAULT_RESPONSE_CALLBACK_MAX_SIZE
+    response_cache_size: int = 0
+    response_cache_max_bytes: int = DEFAULT_RESPONSE_CACHE_MAX_BYTES
+    response_cache_max_entry_size: int = DEFAULT_RESPONSE_CACHE_MAX_ENTRY_SIZE
+    response_cache: ResponseCache = None
+    coalesce_requests: bool = False
+    coalesce_max_size: int = DEFAULT_COALESCE_MAX_SIZE
+    metrics_enabled: bool = True
+    profile_requests: int = 0
+    profile_output: str = DEFAULT_PROFILE_OUTPUT
+    magictoken_batch_max_size: int = DEFAULT_MAGICTOKEN_BATCH_MAX_SIZE
+    decision_cache_size: int = DEFAULT_DECISION_CACHE_SIZE
+    rate_limit_reserve: int = None
+    rate_limit_max_wait: float = 0
+    rate_limits: RateLimits = None
+    token_rate_limit: float = None
+    token_rate_burst: int = None
+    token_limiter_backend: str = "memory"
+    token_limiter_size: int = DEFAULT_TOKEN_LIMITER_SIZE
+    token_limiter_redis_url: str = None
+    limiter: Union[MemoryLimiter, RedisLimiter] = None
+    config_reload_interval: float = 0
+    matchers: typing.Dict[str, PermissionMatcher] = dataclasses.field(default=None, init=False, repr=False)
+    decisions: LRUCache = dataclasses.field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.token_cache is None and self.token_cache_size:
+            self.token_cache = TokenCache(maxsize=self.token_cache_size, ttl=self.token_cache_ttl)
+        if self.response_cache is None and self.response_cache_size:
+            self.response_cache = ResponseCache(
+                maxsize=self.response_cache_size,
+                maxweight=self.response_cache_max_bytes,
+                max_entry_size=self.response_cache_max_entry_size,
+            )
+        if self.rate_limits is None and self.rate_limit_reserve is not None:
+            self.rate_limits = RateLimits(reserve=self.rate_limit_reserve)
+        if self.limiter is None:
+            self.limiter = create_limiter(
+                self.token_limiter_backend, self.token_limiter_size, self.token_limiter_redis_url
+            )
+        self.compile()
+
+    def compile(self):
+        """Compiles the scopes permissions, needed again after changing the scopes
+
+        The cached authorization decisions, made with the previous scopes, are dropped.
+        """
+        self.matchers = compile_scopes(self.scopes)
+        self.decisions = None
+        if self.decision_cache_size:
+            self.decisions = LRUCache(maxsize=self.decision_cache_size, maxweight=DECISION_CACHE_MAX_RULES)
 
     @property
     def serializable(self):
@@ -59,11 +188,63 @@ class Config:
             "public_certificate_location": self.public_certificate_location,
             "public_access": self.public_access,
             "plugins_location": self.plugins_location,
+            "plugins_lazy": self.plugins_lazy,
+            "plugin_import_budget": self.plugin_import_budget,
             "scopes": {k: serializable(scope) for k, scope in self.scopes.items()},
+            "scope_settings": {k: dataclasses.asdict(settings) for k, settings in self.scope_settings.items()},
             "keys": "****",
+            "token_cache_size": self.token_cache_size,
+            "token_cache_ttl": self.token_cache_ttl,
+            "upstream_limit": self.upstream_limit,
+            "upstream_limit_per_host": self.upstream_limit_per_host,
+            "upstream_keepalive_timeout": self.upstream_keepalive_timeout,
+            "upstream_dns_cache_ttl": self.upstream_dns_cache_ttl,
+            "upstream_pool_connections": self.upstream_pool_connections,
+            "upstream_pool_maxsize": self.upstream_pool_maxsize,
+            "stream_responses": self.stream_responses,
+            "token_version": self.token_version,
+            "crypto_executor": self.crypto_executor,
+            "crypto_workers": self.crypto_workers,
+            "response_callback_max_size": self.response_callback_max_size,
+            "response_cache_size": self.response_cache_size,
+            "response_cache_max_bytes": self.response_cache_max_bytes,
+            "response_cache_max_entry_size": self.response_cache_max_entry_size,
+            "coalesce_requests": self.coalesce_requests,
+            "coalesce_max_size": self.coalesce_max_size,
+            "metrics_enabled": self.metrics_enabled,
+            "profile_requests": self.profile_requests,
+            "profile_output": self.profile_output,
+            "magictoken_batch_max_size": self.magictoken_batch_max_size,
+            "decision_cache_size": self.decision_cache_size,
+            "rate_limit_reserve": self.rate_limit_reserve,
+            "rate_limit_max_wait": self.rate_limit_max_wait,
+            "token_rate_limit": self.token_rate_limit,
+            "token_rate_burst": self.token_rate_burst,
+            "token_limiter_backend": self.token_limiter_backend,
+            "token_limiter_size": self.token_limiter_size,
+            "token_limiter_redis_url": "****" if self.token_limiter_redis_url else None,
+            "config_reload_interval": self.config_reload_interval,
         }
 
 
+def _boolean(value: str) -> bool:
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(value)
+
+
+def _env(name, type_=str):
+    value = os.environ.get(name)
+    if value is None:
+        return None
+    try:
+        return type_(value)
+    except ValueError:
+        raise RuntimeError(f"environment variable {name} has an invalid value {value!r}")
+
+
 def from_env():
     keys_location = os.environ.get("KEYS_LOCATION")
     if keys_location is not None:
@@ -80,6 +261,39 @@ def from_env():
         private_key_location=private_key_location,
         public_key_location=public_key_location,
         public_certificate_location=public_certificate_location,
+        plugins_lazy=_env("PLUGINS_LAZY", _boolean),
+        plugin_import_budget=_env("PLUGIN_IMPORT_BUDGET", float),
+        token_cache_size=_env("TOKEN_CACHE_SIZE", int),
+        token_cache_ttl=_env("TOKEN_CACHE_TTL", float),
+        upstream_limit=_env("UPSTREAM_LIMIT", int),
+        upstream_limit_per_host=_env("UPSTREAM_LIMIT_PER_HOST", int),
+        upstream_keepalive_timeout=_env("UPSTREAM_KEEPALIVE_TIMEOUT", float),
+        upstream_dns_cache_ttl=_env("UPSTREAM_DNS_CACHE_TTL", int),
+        upstream_pool_connections=_env("UPSTREAM_POOL_CONNECTIONS", int),
+        upstream_pool_maxsize=_env("UPSTREAM_POOL_MAXSIZE", int),
+        stream_responses=_env("STREAM_RESPONSES", _boolean),
+        token_version=_env("TOKEN_VERSION", int),
+        crypto_executor=_env("CRYPTO_EXECUTOR"),
+        crypto_workers=_env("CRYPTO_WORKERS", int),
+        response_callback_max_size=_env("RESPONSE_CALLBACK_MAX_SIZE", int),
+        response_cache_size=_env("RESPONSE_CACHE_SIZE", int),
+        response_cache_max_bytes=_env("RESPONSE_CACHE_MAX_BYTES", int),
+        response_cache_max_entry_size=_env("RESPONSE_CACHE_MAX_ENTRY_SIZE", int),
+        coalesce_requests=_env("COALESCE_REQUESTS", _boolean),
+        coalesce_max_size=_env("COALESCE_MAX_SIZE", int),
+        metrics_enabled=_env("METRICS_ENABLED", _boolean),
+        profile_requests=_env("PROFILE_REQUESTS", int),
+        profile_output=_env("PROFILE_OUTPUT"),
+        magictoken_batch_max_size=_env("MAGICTOKEN_BATCH_MAX_SIZE", int),
+        decision_cache_size=_env("DECISION_CACHE_SIZE", int),
+        rate_limit_reserve=_env("RATE_LIMIT_RESERVE", int),
+        rate_limit_max_wait=_env("RATE_LIMIT_MAX_WAIT", float),
+        token_rate_limit=_env("TOKEN_RATE_LIMIT", float),
+        token_rate_burst=_env("TOKEN_RATE_BURST", int),
+        token_limiter_backend=_env("TOKEN_LIMITER_BACKEND"),
+        token_limiter_size=_env("TOKEN_LIMITER_SIZE", int),
+        token_limiter_redis_url=_env("TOKEN_LIMITER_REDIS_URL"),
+        config_reload_interval=_env("CONFIG_RELOAD_INTERVAL", float),
     )
 
 
@@ -95,15 +309,20 @@ def from_file(config_file=None):
     except ValueError:
         raise RuntimeError("config file should be a valid JSON file")
 
-    scopes = config.get("scopes", {})
-    for scope_key in scopes:
+    scopes = {}
+    scope_settings = {}
+    for scope_key, scope in config.get("scopes", {}).items():
+        if isinstance(scope, Mapping):
+            # {"permissions": [...], "priority": ...}, the permissions are left out for the settings of a plugin scope
+            scope_settings[scope_key] = parse_scope_settings(scope)
+            scope = scope.get("permissions")
+            if scope is None:
+                continue
         scope_elements = []
-        for scope_element in scopes[scope_key]:
+        for scope_element in scope:
             scope_elements.append(parse_permission(scope_element))
         scopes[scope_key] = scope_elements
     plugins_location = config.get("plugins_location")
-    if plugins_location:
-        scopes.update(**load_plugins(plugins_location))
 
     keys_location = config.get("keys_location")
     if keys_location is not None:
@@ -121,7 +340,41 @@ def from_file(config_file=None):
         public_certificate_location=public_certificate_location,
         public_access=config.get("public_access"),
         plugins_location=plugins_location,
+        plugins_lazy=config.get("plugins_lazy"),
+        plugin_import_budget=config.get("plugin_import_budget"),
         scopes=scopes,
+        scope_settings=scope_settings,
+        token_cache_size=config.get("token_cache_size"),
+        token_cache_ttl=config.get("token_cache_ttl"),
+        upstream_limit=config.get("upstream_limit"),
+        upstream_limit_per_host=config.get("upstream_limit_per_host"),
+        upstream_keepalive_timeout=config.get("upstream_keepalive_timeout"),
+        upstream_dns_cache_ttl=config.get("upstream_dns_cache_ttl"),
+        upstream_pool_connections=config.get("upstream_pool_connections"),
+        upstream_pool_maxsize=config.get("upstream_pool_maxsize"),
+        stream_responses=config.get("stream_responses"),
+        token_version=config.get("token_version"),
+        crypto_executor=config.get("crypto_executor"),
+        crypto_workers=config.get("crypto_workers"),
+        response_callback_max_size=config.get("response_callback_max_size"),
+        response_cache_size=config.get("response_cache_size"),
+        response_cache_max_bytes=config.get("response_cache_max_bytes"),
+        response_cache_max_entry_size=config.get("response_cache_max_entry_size"),
+        coalesce_requests=config.get("coalesce_requests"),
+        coalesce_max_size=config.get("coalesce_max_size"),
+        metrics_enabled=config.get("metrics_enabled"),
+        profile_requests=config.get("profile_requests"),
+        profile_output=config.get("profile_output"),
+        magictoken_batch_max_size=config.get("magictoken_batch_max_size"),
+        decision_cache_size=config.get("decision_cache_size"),
+        rate_limit_reserve=config.get("rate_limit_reserve"),
+        rate_limit_max_wait=config.get("rate_limit_max_wait"),
+        token_rate_limit=config.get("token_rate_limit"),
+        token_rate_burst=config.get("token_rate_burst"),
+        token_limiter_backend=config.get("token_limiter_backend"),
+        token_limiter_size=config.get("token_limiter_size"),
+        token_limiter_redis_url=config.get("token_limiter_redis_url"),
+        config_reload_interval=config.get("config_reload_interval"),
     )
 
 
@@ -132,6 +385,8 @@ def load_config(_load_keys=True, **kwargs):
 
     config = {}
     for field in dataclasses.fields(Config):
+        if not field.init:
+            continue
         if kwargs_config.get(field.name) is not None:
             config[field.name] = kwargs[field.name]
         elif env_config.get(field.name) is not None:
@@ -141,9 +396,19 @@ def load_config(_load_keys=True, **kwargs):
         else:
             config[field.name] = DEFAULT_CONFIG[field.name]
 
+    if config["plugins_location"]:
+        # loaded once the layers are merged, with the plugin settings of whichever one sets them
+        plugins = load_plugins(
+            config["plugins_location"], lazy=config["plugins_lazy"], budget=config["plugin_import_budget"]
+        )
+        config["scopes"] = {**(config["scopes"] or {}), **plugins}
+
     config = Config(**config)
 
     if _load_keys:
+        # the crypto libraries are only imported when the keys are needed
+        from magicproxy.keys import Keys
+
         config.keys = Keys.from_files(config.private_key_location, config.public_certificate_location)
 
     logger.debug("config %s", json.dumps(config.serializable, indent=2))
@@ -164,3 +429,20 @@ def parse_permission(element: Union[str, Mapping]) -> Permission:
             return Permission(method=element["method"], path=element["path"])
         else:
             raise ValueError("a scope mapping should be a mapping with method, path keys")
+
+
+def parse_scope_settings(element: Mapping) -> ScopeSettings:
+    settings = {key: value for key, value in element.items() if key != "permissions"}
+    try:
+        scope_settings = ScopeSettings(**settings)
+    except TypeError as e:
+        raise ValueError(f"unknown scope settings in {sorted(settings)}") from e
+    if not isinstance(scope_settings.priority, int) or scope_settings.priority < 0:
+        raise ValueError("a scope priority should be a positive integer")
+    if scope_settings.rate_limit is not None and (
+        not isinstance(scope_settings.rate_limit, (int, float)) or scope_settings.rate_limit <= 0
+    ):
+        raise ValueError("a scope rate_limit should be a positive number of requests per second")
+    if scope_settings.burst is not None and (not isinstance(scope_settings.burst, int) or scope_settings.burst < 1):
+        raise ValueError("a scope burst should be a positive integer")
+    return scope_settings
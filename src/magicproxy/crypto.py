@@ -1,12 +1,13 @@
 import os
 from urllib.parse import urlparse
 
-from OpenSSL import crypto
-
 from magicproxy.config import Config
 
 
 def generate_keys(config: Config):
+    # pyOpenSSL is only needed here
+    from OpenSSL import crypto
+
     os.makedirs(os.path.dirname(config.private_key_location), exist_ok=True)
     os.makedirs(os.path.dirname(config.public_key_location), exist_ok=True)
     os.makedirs(os.path.dirname(config.public_certificate_location), exist_ok=True)
@@ -0,0 +1,250 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
+from typing import Callable, Iterator, List, Optional
+
+from magicproxy import magictoken
+from magicproxy.config import Config
+from magicproxy.keys import Keys
+from magicproxy.types import DecodeResult
+
+EXECUTOR_KINDS = ("thread", "process", "none")
+
+# the keys of a process pool worker, loaded once by init_process
+_process_keys: Optional[Keys] = None
+
+
+def init_process(private_key_pem: bytes, certificate_pem: bytes):
+    """The initializer of a process pool signing or decoding tokens, see process_initargs"""
+    global _process_keys
+    _process_keys = Keys.from_pem(private_key_pem, certificate_pem)
+
+
+def process_initargs(config: Config) -> tuple:
+    """The keys of the config, for init_process: the same ones, even when they don't come from files"""
+    return config.keys.private_key_pem(), config.keys.certificate_pem
+
+
+def decode_in_process(token: str) -> DecodeResult:
+    """magictoken.verify, in a process set up by init_process"""
+    return magictoken.verify(_process_keys, token)
+
+
+def create_in_process(token: str, scopes: Optional[List[str]], allowed: Optional[List[str]], version: int) -> str:
+    """magictoken.create, in a process set up by init_process"""
+    return magictoken.create(_process_keys, token, scopes, allowed, version=version)
+
+
+def process_pool(config: Config) -> concurrent.futures.ProcessPoolExecutor:
+    """A pool of crypto_workers processes (one per core by default), each loading the keys once"""
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=config.crypto_workers,
+        initializer=init_process,
+        initargs=process_initargs(config),
+    )
+
+
+def map_batch(pool: concurrent.futures.Executor, specs: List[dict], version: int) -> Iterator[str]:
+    """Submits the minting of a token for each spec (validated magic token params) to the process pool
+
+    Returns:
+      the tokens, in order, as they are minted
+    """
+    chunksize = max(1, len(specs) // (4 * (getattr(pool, "_max_workers", None) or 1)))
+    return pool.map(
+        create_in_process,
+        [spec["token"] for spec in specs],
+        [spec.get("scopes") for spec in specs],
+        [spec.get("allowed") for spec in specs],
+        [version] * len(specs),
+        chunksize=chunksize,
+    )
+
+
+def create_batch(pool: concurrent.futures.Executor, specs: List[dict], version: int) -> List[str]:
+    """Mints a token for each spec (validated magic token params) in the process pool"""
+    return list(map_batch(pool, specs, version))
+
+
+def _same_keys(previous: Config, config: Config) -> bool:
+    if previous.keys is None or config.keys is None:
+        return previous.keys is config.keys
+    return previous.keys.certificate_pem == config.keys.certificate_pem
+
+
+class BatchPool:
+    """The process pool minting the batches of tokens of the sync proxy
+
+    It is started on the first batch, with the config of that request, and again when a batch comes with
+    other keys or crypto_workers.
+    """
+
+    def __init__(self):
+        # held while the pool is read or replaced
+        self._lock = threading.Lock()
+        self._config: Optional[Config] = None
+        self._pool: Optional[concurrent.futures.Executor] = None
+
+    def create_batch(self, config: Config, specs: List[dict]) -> List[str]:
+        """Mints a token for each spec (validated magic token params) with the keys of config"""
+        previous = None
+        with self._lock:
+            if (
+                self._pool is None
+                or not _same_keys(self._config, config)
+                or self._config.crypto_workers != config.crypto_workers
+            ):
+                previous, self._pool = self._pool, process_pool(config)
+            self._config = config
+            # submitted now, a pool replaced by a batch with other keys still runs them
+            results = map_batch(self._pool, specs, config.token_version)
+        if previous is not None:
+            previous.shutdown(wait=False)
+        return list(results)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+class CryptoExecutor:
+    """Runs the magic token crypto in a pool, away from the event loop
+
+    Args:
+      config: the proxy config, its crypto_executor is "thread", "process" (the keys are sent
+        to each process) or "none" (on the event loop), its crypto_workers is the size of the pool
+    """
+
+    def __init__(self, config: Config):
+        # calls submitted to the pool and not finished yet
+        self.queue_depth = 0
+        # held while the pools are read or replaced
+        self._lock = threading.Lock()
+        self._start(config)
+
+    def _start(self, config: Config):
+        kind = config.crypto_executor
+        executor: Optional[concurrent.futures.Executor]
+        if kind == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.crypto_workers, thread_name_prefix="magicproxy-crypto"
+            )
+        elif kind == "process":
+            executor = process_pool(config)
+        elif kind == "none":
+            executor = None
+        else:
+            raise ValueError(f"crypto_executor should be one of {EXECUTOR_KINDS}")
+        self.config = config
+        self.kind = kind
+        self.max_workers = config.crypto_workers
+        self._executor = executor
+        # the process pool of the batches, when the crypto doesn't already run in one
+        self._batch_executor: Optional[concurrent.futures.Executor] = None
+
+    def update(self, config: Config):
+        """Makes config the current one, the pools are started again when its keys or executor settings changed
+
+        The calls already submitted finish in the previous pools.
+        """
+        with self._lock:
+            same_settings = (config.crypto_executor, config.crypto_workers) == (self.kind, self.max_workers)
+            if same_settings and _same_keys(self.config, config):
+                self.config = config
+                return
+            previous = (self._executor, self._batch_executor)
+            self._start(config)
+        for pool in previous:
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+    async def _run(self, plan: Callable[[str, Optional[concurrent.futures.Executor], Keys], tuple]):
+        """Runs the call of plan(kind, pool, keys) -> (executor, call): in that executor, on the event loop for "none"
+
+        The pools are read and the call submitted under the lock, a reload doesn't shut them down in between.
+        """
+        with self._lock:
+            kind = self.kind
+            executor, call = plan(kind, self._executor, self.config.keys)
+            if kind != "none":
+                future = asyncio.get_event_loop().run_in_executor(executor, call)
+        if kind == "none":
+            return call()
+        self.queue_depth += 1
+        try:
+            return await future
+        finally:
+            self.queue_depth -= 1
+
+    def _verify_in_process(self, token: str) -> DecodeResult:
+        with self._lock:
+            if self.kind == "process":
+                future = self._executor.submit(decode_in_process, token)
+            else:
+                # the executor changed meanwhile
+                future, keys = None, self.config.keys
+        return future.result() if future is not None else magictoken.verify(keys, token)
+
+    async def decode(self, token: str) -> DecodeResult:
+        """magictoken.decode, with the token cache of the config"""
+        cache = self.config.token_cache
+
+        def plan(kind, pool, keys):
+            if kind == "process":
+                # the cache is in this process: a thread looks it up and fills it, the pool processes only verify
+                return None, functools.partial(magictoken.decode_cached, self._verify_in_process, token, cache)
+            return pool, functools.partial(magictoken.decode, keys, token, cache)
+
+        return await self._run(plan)
+
+    async def create(self, token: str, scopes: Optional[List[str]] = None, allowed: Optional[List[str]] = None) -> str:
+        version = self.config.token_version
+
+        def plan(kind, pool, keys):
+            if kind == "process":
+                return pool, functools.partial(create_in_process, token, scopes, allowed, version)
+            return pool, functools.partial(magictoken.create, keys, token, scopes, allowed, version=version)
+
+        return await self._run(plan)
+
+    async def create_batch(self, specs: List[dict]) -> List[str]:
+        """Mints a token for each spec (validated magic token params), in parallel on a process pool
+
+        With the "none" executor, they are minted one after the other on the event loop.
+        """
+        version = self.config.token_version
+        with self._lock:
+            if self.kind == "process":
+                pool = self._executor
+            elif self.kind == "thread":
+                if self._batch_executor is None:
+                    self._batch_executor = process_pool(self.config)
+                pool = self._batch_executor
+            else:
+                pool = None
+            keys = self.config.keys
+            # submitted now, a pool replaced by a reload still runs them
+            results = map_batch(pool, specs, version) if pool is not None else None
+        if results is None:
+            return [
+                magictoken.create(keys, spec["token"], spec.get("scopes"), spec.get("allowed"), version)
+                for spec in specs
+            ]
+        self.queue_depth += len(specs)
+        try:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, list, results)
+        finally:
+            self.queue_depth -= len(specs)
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "max_workers": self.max_workers, "queue_depth": self.queue_depth}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._batch_executor is not None:
+            self._batch_executor.shutdown(wait=False)
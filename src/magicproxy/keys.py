@@ -4,6 +4,7 @@ from cryptography import x509
 from cryptography.hazmat import backends
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 from magicproxy.types import _Keys
 
@@ -11,27 +12,48 @@ _BACKEND = backends.default_backend()
 _PADDING = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
 
 
+def derive_key(private_key, purpose: bytes) -> bytes:
+    """Derives a 256 bits symmetric key, dedicated to one purpose, from the private key"""
+    private_key_der = private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=purpose, backend=_BACKEND).derive(private_key_der)
+
+
 class Keys(_Keys):
     @classmethod
     def from_files(cls, private_key_file, certificate_file):
         try:
             with open(private_key_file, "rb") as fh:
                 private_key_bytes = fh.read()
-                private_key = serialization.load_pem_private_key(private_key_bytes, password=None, backend=_BACKEND)
-                private_key_signer = google.auth.crypt.RSASigner.from_string(private_key_bytes)
-
             with open(certificate_file, "rb") as fh:
                 certificate_pem = fh.read()
-                certificate = x509.load_pem_x509_certificate(certificate_pem, _BACKEND)
-                public_key = certificate.public_key()
         except IOError:
             raise RuntimeError("I/O error, config file should be readable")
+        return cls.from_pem(private_key_bytes, certificate_pem)
+
+    @classmethod
+    def from_pem(cls, private_key_bytes: bytes, certificate_pem: bytes):
+        private_key = serialization.load_pem_private_key(private_key_bytes, password=None, backend=_BACKEND)
+        private_key_signer = google.auth.crypt.RSASigner.from_string(private_key_bytes)
+        certificate = x509.load_pem_x509_certificate(certificate_pem, _BACKEND)
         return cls(
             private_key=private_key,
             private_key_signer=private_key_signer,
-            public_key=public_key,
+            public_key=certificate.public_key(),
             certificate=certificate,
             certificate_pem=certificate_pem,
+            token_sealing_key=derive_key(private_key, b"magicproxy token v2 sealing"),
+            token_signing_key=derive_key(private_key, b"magicproxy token v2 signing"),
+        )
+
+    def private_key_pem(self) -> bytes:
+        return self.private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
         )
 
 
@@ -0,0 +1,126 @@
+import dataclasses
+import hashlib
+import threading
+import time
+from typing import Hashable, Optional
+
+from magicproxy.cache import LRUCache
+
+DEFAULT_MAXSIZE = 100000
+REDIS_KEY_PREFIX = "magicproxy:bucket:"
+
+# the bucket refilled since its last update, one request taken out of it if there is room,
+# it expires once it would be full again
+REDIS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = burst
+if bucket[1] then
+  tokens = math.min(burst, tonumber(bucket[1]) + math.max(0, now - tonumber(bucket[2])) * rate)
+end
+if tokens < 1 then
+  return {0, tostring((1 - tokens) / rate)}
+end
+tokens = tokens - 1
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1)
+return {1, "0"}
+"""
+
+
+def key(issued_at: Optional[int], magic_token: str) -> str:
+    """The bucket of a magic token, by its iat claim and a digest of its signature"""
+    signature = magic_token.rsplit(".", 1)[-1]
+    return f"{issued_at}:{hashlib.sha256(signature.encode('utf-8')).hexdigest()}"
+
+
+@dataclasses.dataclass
+class TokenBucket:
+    tokens: float
+    updated: float
+
+
+class MemoryLimiter:
+    """Token buckets in this process memory
+
+    A bucket is evicted once it would be full again, which is the same as a new one,
+    or when there are more than maxsize active tokens, the least recently used first.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE):
+        self.limited = 0
+        self._buckets = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def check(self, bucket_key: Hashable, rate: float, burst: int) -> Optional[float]:
+        """None when the request can go, otherwise the seconds until the bucket has room for it"""
+        with self._lock:
+            now = time.monotonic()
+            bucket: Optional[TokenBucket] = self._buckets.get(bucket_key)
+            tokens = burst if bucket is None else min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            if tokens < 1:
+                self.limited += 1
+                return (1 - tokens) / rate
+            tokens -= 1
+            self._buckets.set(bucket_key, TokenBucket(tokens, now), ttl=(burst - tokens) / rate)
+            return None
+
+    async def check_async(self, bucket_key: Hashable, rate: float, burst: int) -> Optional[float]:
+        return self.check(bucket_key, rate, burst)
+
+    def stats(self) -> dict:
+        return {"buckets": len(self._buckets), "limited": self.limited}
+
+
+class RedisLimiter:
+    """Token buckets in redis, shared by all the workers, each one updated atomically by a Lua script
+
+    Needs the redis package (pip install magic-api-proxy[redis]).
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("the redis token limiter backend needs the redis package") from e
+        self.url = url
+        self.limited = 0
+        self._script = redis.Redis.from_url(url).register_script(REDIS_SCRIPT)
+        # bound to the event loop of the first async request
+        self._async_script = None
+
+    def _result(self, result) -> Optional[float]:
+        allowed, retry_after = result
+        if int(allowed):
+            return None
+        self.limited += 1
+        return float(retry_after)
+
+    def check(self, bucket_key: Hashable, rate: float, burst: int) -> Optional[float]:
+        return self._result(self._script(keys=[REDIS_KEY_PREFIX + str(bucket_key)], args=[rate, burst, time.time()]))
+
+    async def check_async(self, bucket_key: Hashable, rate: float, burst: int) -> Optional[float]:
+        if self._async_script is None:
+            import redis.asyncio
+
+            self._async_script = redis.asyncio.Redis.from_url(self.url).register_script(REDIS_SCRIPT)
+        result = await self._async_script(keys=[REDIS_KEY_PREFIX + str(bucket_key)], args=[rate, burst, time.time()])
+        return self._result(result)
+
+    def stats(self) -> dict:
+        return {"limited": self.limited}
+
+
+LIMITER_BACKENDS = ("memory", "redis")
+
+
+def create_limiter(backend: str, maxsize: int = DEFAULT_MAXSIZE, redis_url: Optional[str] = None):
+    if backend == "memory":
+        return MemoryLimiter(maxsize)
+    if backend == "redis":
+        if not redis_url:
+            raise ValueError("the redis token limiter backend needs token_limiter_redis_url")
+        return RedisLimiter(redis_url)
+    raise ValueError(f"token_limiter_backend should be one of {LIMITER_BACKENDS}")
@@ -15,18 +15,32 @@
 import base64
 import calendar
 import datetime
+import functools
+import hashlib
+import hmac
+import json
+import os
+from typing import Callable, List, Optional
 
 import google.auth.crypt
 import google.auth.jwt
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+from magicproxy.cache import TokenCache
 from magicproxy.config import parse_permission, Config
 from magicproxy.keys import _PADDING
 from magicproxy.types import DecodeResult, _Keys
 
 VALIDITY_PERIOD = 365 * 5  # 5 years.
 
+TOKEN_VERSIONS = (1, 2)
+# v1 tokens are RS256 JWTs, v2 tokens are HS256 JWTs
+V2_ALGORITHM = "HS256"
+_NONCE_SIZE = 12
+
 
 def _datetime_to_secs(value: datetime.datetime) -> int:
     return calendar.timegm(value.utctimetuple())
@@ -47,11 +61,73 @@ def _decrypt(key, cipher_text: bytes) -> bytes:
     )
 
 
-def create(keys: _Keys, token, scopes=None, allowed=None) -> str:
-    # NOTE: This is the *public key* that we use to encrypt this token. It's
-    # *extremely* important that the public key is used here, as we want only
-    # our *private key* to be able to decrypt this value.
-    encrypted_api_token = _encrypt(keys.public_key, token.encode("utf-8"))
+def _seal(key: bytes, plain_text: bytes) -> bytes:
+    nonce = os.urandom(_NONCE_SIZE)
+    return nonce + AESGCM(key).encrypt(nonce, plain_text, None)
+
+
+def _unseal(key: bytes, sealed_text: bytes) -> bytes:
+    try:
+        return AESGCM(key).decrypt(sealed_text[:_NONCE_SIZE], sealed_text[_NONCE_SIZE:], None)
+    except InvalidTag as e:
+        raise ValueError("Could not decrypt the token") from e
+
+
+def _b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _b64url_decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+def _encode_v2(keys: _Keys, claims: dict) -> str:
+    header = {"typ": "JWT", "alg": V2_ALGORITHM}
+    signed_section = (
+        _b64url_encode(json.dumps(header).encode("utf-8")) + b"." + _b64url_encode(json.dumps(claims).encode("utf-8"))
+    )
+    signature = hmac.new(keys.token_signing_key, signed_section, hashlib.sha256).digest()
+    return (signed_section + b"." + _b64url_encode(signature)).decode("utf-8")
+
+
+def _decode_v2(keys: _Keys, token: str) -> dict:
+    try:
+        signed_section, signature = token.encode("utf-8").rsplit(b".", 1)
+        _, payload = signed_section.split(b".")
+        expected_signature = hmac.new(keys.token_signing_key, signed_section, hashlib.sha256).digest()
+        if not hmac.compare_digest(_b64url_decode(signature), expected_signature):
+            raise ValueError("Could not verify the token signature")
+        claims = json.loads(_b64url_decode(payload))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid token: {e}") from e
+
+    now = _datetime_to_secs(datetime.datetime.utcnow())
+    if "iat" not in claims or "exp" not in claims:
+        raise ValueError("Token does not contain the required iat and exp claims")
+    if now < claims["iat"]:
+        raise ValueError(f"Token used too early, {now} < {claims['iat']}")
+    if claims["exp"] < now:
+        raise ValueError(f"Token expired, {claims['exp']} < {now}")
+    return claims
+
+
+def create(keys: _Keys, token, scopes=None, allowed=None, version=1) -> str:
+    """Creates a magic token
+
+    v1 tokens are RS256 JWTs, the API token encrypted with RSA-OAEP, the default.
+    v2 tokens are HS256 JWTs, the API token sealed with AES-GCM, both keys derived from the
+    private key. They are much cheaper to decode, but can't be verified with the public certificate.
+    """
+    if version not in TOKEN_VERSIONS:
+        raise ValueError(f"token version should be one of {TOKEN_VERSIONS}")
+
+    if version == 2:
+        encrypted_api_token = _seal(keys.token_sealing_key, token.encode("utf-8"))
+    else:
+        # NOTE: This is the *public key* that we use to encrypt this token. It's
+        # *extremely* important that the public key is used here, as we want only
+        # our *private key* to be able to decrypt this value.
+        encrypted_api_token = _encrypt(keys.public_key, token.encode("utf-8"))
     encoded_api_token = base64.b64encode(encrypted_api_token).decode("utf-8")
 
     issued_at = datetime.datetime.utcnow()
@@ -68,19 +144,48 @@ def create(keys: _Keys, token, scopes=None, allowed=None) -> str:
 
     claims["scopes"] = scopes
 
+    if version == 2:
+        return _encode_v2(keys, claims)
+
     jwt = google.auth.jwt.encode(keys.private_key_signer, claims)
 
     return jwt.decode("utf-8")
 
 
-def decode(keys, token) -> DecodeResult:
-    claims = dict(google.auth.jwt.decode(token, verify=True, certs=[keys.certificate_pem]))
+def decode(keys, token, cache: Optional[TokenCache] = None) -> DecodeResult:
+    return decode_cached(functools.partial(verify, keys), token, cache)
+
+
+def decode_cached(
+    verify_token: Callable[[str], DecodeResult], token, cache: Optional[TokenCache] = None
+) -> DecodeResult:
+    """verify_token(token), unless the token is in the cache, its result is cached"""
+    if cache is not None:
+        cached = cache.get_token(token)
+        if cached is not None:
+            return cached
+
+    result = verify_token(token)
+
+    if cache is not None:
+        cache.set_token(token, result)
+
+    return result
 
-    decoded_token = base64.b64decode(claims["token"])
-    decrypted_token = _decrypt(keys.private_key, decoded_token).decode("utf-8")
+
+def verify(keys, token) -> DecodeResult:
+    """Verifies and decrypts a magic token"""
+    if google.auth.jwt.decode_header(token).get("alg") == V2_ALGORITHM:
+        claims = _decode_v2(keys, token)
+        decrypted_token = _unseal(keys.token_sealing_key, base64.b64decode(claims["token"])).decode("utf-8")
+    else:
+        claims = dict(google.auth.jwt.decode(token, verify=True, certs=[keys.certificate_pem]))
+        decrypted_token = _decrypt(keys.private_key, base64.b64decode(claims["token"])).decode("utf-8")
     claims["token"] = decrypted_token
 
-    return DecodeResult(claims["token"], claims.get("scopes"), claims.get("allowed"))
+    return DecodeResult(
+        claims["token"], claims.get("scopes"), claims.get("allowed"), claims.get("exp"), claims.get("iat")
+    )
 
 
 def magictoken_params_validate(config: Config, params: dict):
@@ -89,6 +194,8 @@ def magictoken_params_validate(config: Config, params: dict):
 
     if "token" not in params:
         raise ValueError("We need a token for the API behind, in the 'token' field")
+    if not isinstance(params["token"], str):
+        raise ValueError("token must be a string")
 
     if ("scope" in params or "scopes" in params) and "allowed" in params:
         raise ValueError(
@@ -98,6 +205,8 @@ def magictoken_params_validate(config: Config, params: dict):
 
     if "scopes" in params or "scope" in params:
         params_scopes = [params["scope"]] if "scope" in params else []
+        if not isinstance(params.get("scopes", []), list):
+            raise ValueError("scopes must be a list of strings")
         params_scopes.extend(params.pop("scopes", []))
         for params_scope in params_scopes:
             if not isinstance(params_scope, str):
@@ -118,3 +227,32 @@ def magictoken_params_validate(config: Config, params: dict):
             "need one of allowed (spelling out the allowed requests) "
             "OR scopes (naming a scope configured on the proxy)"
         )
+
+
+def magictoken_batch_validate(config: Config, items: list) -> List[Optional[str]]:
+    """Validates each item of a batch like magictoken_params_validate
+
+    Returns:
+      the error of each item, None for the valid ones
+    """
+    if not items:
+        raise ValueError("a batch must be a non-empty list")
+    if len(items) > config.magictoken_batch_max_size:
+        raise ValueError(f"a batch is at most {config.magictoken_batch_max_size} tokens")
+    errors: List[Optional[str]] = []
+    for item in items:
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("each item of a batch must be a json object")
+            magictoken_params_validate(config, item)
+        except ValueError as e:
+            errors.append(str(e))
+        else:
+            errors.append(None)
+    return errors
+
+
+def magictoken_batch_results(errors: List[Optional[str]], tokens: List[str]) -> List[dict]:
+    """The response to a batch: the token of each valid item, in order, the error of the others"""
+    created = iter(tokens)
+    return [{"error": error} if error is not None else {"token": next(created)} for error in errors]
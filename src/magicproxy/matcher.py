@@ -0,0 +1,104 @@
+import itertools
+import re
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+from magicproxy.types import Permission
+
+# numbered back references would point to another group once inside an alternation
+_BACKREFERENCE = re.compile(r"\\[1-9]")
+# a path regex that starts with a literal first segment, "/repos/..." (the "/" after it not quantified)
+_LITERAL_SEGMENT = re.compile(r"/([A-Za-z0-9_-]+)/(?![*?+{])")
+# inline flags could change the meaning of that literal segment, or of the other regexes of an alternation
+_INLINE_FLAGS = re.compile(r"\(\?[aiLmsux-]")
+
+
+def _compile(path: str) -> Pattern:
+    try:
+        return re.compile(path, re.I)
+    except re.error as e:
+        raise ValueError(f"invalid path regex {path!r}: {e}") from e
+
+
+def _keep_apart(path: str) -> bool:
+    # before Python 3.11, a global flag in the middle of a pattern applies to all of it, the other regexes too
+    return bool(_BACKREFERENCE.search(path) or _INLINE_FLAGS.search(path))
+
+
+def compile_paths(paths: List[str]) -> List[Pattern]:
+    """Compiles path regexes in as few patterns as possible
+
+    The patterns are joined in one alternation, so that `pattern.match(path)` is true when one of
+    the regexes matches, like `re.match(path_regex, path, re.I)` would. The regexes that can not
+    keep their meaning inside an alternation are kept apart.
+
+    Each regex is compiled on its own first: an invalid one ("/user)|(?:.*") could otherwise escape
+    its group and make the whole alternation match any path.
+    """
+    compiled = [_compile(path) for path in paths]
+    separate = [pattern for path, pattern in zip(paths, compiled) if _keep_apart(path)]
+    combinable = [(path, pattern) for path, pattern in zip(paths, compiled) if not _keep_apart(path)]
+    if not combinable:
+        return separate
+    try:
+        return [re.compile("|".join(f"(?:{path})" for path, _ in combinable), re.I)] + separate
+    except re.error:
+        # e.g. duplicated group names
+        return [pattern for _, pattern in combinable] + separate
+
+
+def literal_segment(path: str) -> Optional[str]:
+    """The literal first segment that every path matched by the regex starts with, lowercased, if there is one"""
+    if "|" in path or _INLINE_FLAGS.search(path):
+        return None
+    match = _LITERAL_SEGMENT.match(path)
+    return match.group(1).lower() if match else None
+
+
+class PermissionMatcher:
+    """Permissions compiled into matchers indexed by HTTP method and by first path segment
+
+    The regexes that start with a literal segment ("/repos/...") are only tried on the paths starting with it,
+    the others on every path.
+    """
+
+    def __init__(self, permissions: Iterable[Permission]):
+        paths: Dict[str, Tuple[Dict[str, List[str]], List[str]]] = {}
+        for permission in permissions:
+            segments, unindexed = paths.setdefault(permission.method, ({}, []))
+            segment = literal_segment(permission.path)
+            if segment is None:
+                unindexed.append(permission.path)
+            else:
+                segments.setdefault(segment, []).append(permission.path)
+        self._index: Dict[str, Tuple[Dict[str, List[Pattern]], List[Pattern]]] = {
+            method: (
+                {segment: compile_paths(segment_paths) for segment, segment_paths in segments.items()},
+                compile_paths(unindexed),
+            )
+            for method, (segments, unindexed) in paths.items()
+        }
+
+    def _candidates(self, method: str, segment: str) -> Iterable[Pattern]:
+        index = self._index.get(method)
+        if index is None:
+            return ()
+        segments, unindexed = index
+        if not segment.isascii():
+            # a non ASCII character can match an ASCII one, ignoring case (e.g. the Kelvin sign and "k")
+            return itertools.chain(itertools.chain.from_iterable(segments.values()), unindexed)
+        return itertools.chain(segments.get(segment.lower(), ()), unindexed)
+
+    def match(self, method: str, path: str) -> bool:
+        if not path.startswith("/"):
+            path = f"/{path}"
+
+        segment = path[1:].split("/", 1)[0]
+        for pattern in itertools.chain(self._candidates(method, segment), self._candidates("*", segment)):
+            if pattern.match(path):
+                return True
+        return False
+
+
+def compile_scopes(scopes: Dict) -> Dict[str, PermissionMatcher]:
+    """Compiles the permission list scopes, scope plugins are left out"""
+    return {key: PermissionMatcher(scope) for key, scope in scopes.items() if isinstance(scope, list)}
@@ -0,0 +1,135 @@
+import bisect
+import contextlib
+import threading
+import time
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a token cache hit to a slow API call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGES = ("decode", "validate", "upstream_ttfb", "upstream", "response_callback")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: the count in each bucket (the last one is +Inf), and the sum
+        self._values: Dict[tuple, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(tuple(labels[name] for name in self.labelnames), ([0], [0.0]))
+        return sum(counts)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}"
+
+
+class Metrics:
+    """The metrics of a proxy, rendered in the Prometheus text format
+
+    Requests are counted by status and scopes, the time spent in each of the STAGES is a histogram.
+    """
+
+    def __init__(self):
+        self.requests = Counter(
+            "magicproxy_requests_total", "Proxied requests, by status and token scopes", ("status", "scope")
+        )
+        self.stage_seconds = Histogram(
+            "magicproxy_stage_duration_seconds", "Time spent in each stage of a proxied request", ("stage",)
+        )
+
+    def count_request(self, status: int, token_scopes: Optional[Sequence[str]]):
+        self.requests.inc(status=status, scope=",".join(token_scopes) if token_scopes else "none")
+
+    def time(self, stage: str):
+        return self.stage_seconds.time(stage=stage)
+
+    def observe(self, stage: str, seconds: float):
+        self.stage_seconds.observe(seconds, stage=stage)
+
+    def render(self, stats: Mapping[str, Optional[Mapping]] = None) -> str:
+        """The metrics, followed by a gauge for each numeric value of the stats of each component
+
+        Args:
+          stats: component name -> its stats (e.g. {"token_cache": {"hits": 3}} gives magicproxy_token_cache_hits 3)
+        """
+        lines = list(self.requests.render())
+        lines.extend(self.stage_seconds.render())
+        for component, values in (stats or {}).items():
+            for key, value in (values or {}).items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"magicproxy_{component}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,53 @@
+import functools
+import json
+import multiprocessing
+from typing import Iterable, Iterator, Optional, Tuple
+
+from magicproxy import executor
+from magicproxy.config import Config
+from magicproxy.magictoken import magictoken_params_validate
+
+DEFAULT_CHUNKSIZE = 16
+
+
+def _parse(config: Config, lines: Iterable[str]) -> Iterator[Tuple[Optional[dict], Optional[str]]]:
+    """The validated spec, or the error, of each non-blank line"""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            try:
+                params = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"invalid json: {e}")
+            if not isinstance(params, dict):
+                raise ValueError("each line must be a json object")
+            magictoken_params_validate(config, params)
+        except ValueError as e:
+            yield None, str(e)
+        else:
+            yield params, None
+
+
+def _mint(item: Tuple[Optional[dict], Optional[str]], version: int) -> dict:
+    spec, error = item
+    if error is not None:
+        return {"error": error}
+    return {"token": executor.create_in_process(spec["token"], spec.get("scopes"), spec.get("allowed"), version)}
+
+
+def mint(
+    config: Config, lines: Iterable[str], processes: Optional[int] = None, chunksize: int = DEFAULT_CHUNKSIZE
+) -> Iterator[dict]:
+    """Mints a token for each line of JSON magic token params, without a server
+
+    The tokens are signed in a pool of processes (one per core by default) that each load the keys once,
+    the results come in the order of the lines, as they are minted: {"token": ...} or {"error": ...}.
+    """
+    function = functools.partial(_mint, version=config.token_version)
+    with multiprocessing.Pool(
+        processes,
+        initializer=executor.init_process,
+        initargs=executor.process_initargs(config),
+    ) as pool:
+        yield from pool.imap(function, _parse(config, lines), chunksize)
@@ -1,13 +1,27 @@
+import asyncio
+import concurrent.futures
+import functools
 import glob
 import logging
 import os
+import threading
+import time
+import types
 import traceback
 from importlib import util
 import inspect
+from typing import Dict, Optional, Tuple
 
 logger = logging.getLogger()
 
 
+# absolute path -> (mtime, size) of the file, scope key, module: a plugin is only imported again once its file changes
+_loaded: Dict[str, Tuple[Tuple[int, int], str, types.ModuleType]] = {}
+
+# plugins imported at once on startup
+MAX_LOADING_THREADS = 8
+
+
 class InvalidPluginError(Exception):
     pass
 
@@ -24,27 +38,103 @@ def load_module(path):
     return module
 
 
-def load_plugins(plugins_folder):
-    plugins = {}
-    for python_file in glob.glob(f"{plugins_folder}/*.py"):
-        logging.debug("load_plugin %s", python_file)
-        scope_key, module = load_plugin(python_file)
-        plugins[scope_key] = module
-
-    return plugins
-
-
-def load_plugin(python_file):
+def load_plugins(plugins_folder, lazy: bool = False, budget: Optional[float] = None):
+    """The plugins of the folder, by scope key
+
+    Args:
+      lazy: each plugin is a LazyPlugin, imported on first use, the ones already imported and unchanged excepted.
+        Otherwise they are all imported now, in parallel threads
+      budget: the seconds a plugin import should take at most, the slower ones are logged as warnings
+    """
+    python_files = sorted(glob.glob(f"{plugins_folder}/*.py"))
+    if lazy:
+        return dict(_lazy_plugin(python_file, budget) for python_file in python_files)
+
+    load = functools.partial(load_plugin, budget=budget)
+    if len(python_files) <= 1:
+        return dict(map(load, python_files))
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(python_files), MAX_LOADING_THREADS), thread_name_prefix="magicproxy-plugins"
+    ) as pool:
+        return dict(pool.map(load, python_files))
+
+
+def _lazy_plugin(python_file, budget: Optional[float]) -> Tuple[str, types.ModuleType]:
+    loaded = _loaded.get(os.path.abspath(python_file))
+    if loaded is not None and loaded[0] == _version(python_file):
+        return loaded[1], loaded[2]
+    plugin = LazyPlugin(python_file, budget)
+    return plugin.__name__, plugin
+
+
+class LazyPlugin(types.ModuleType):
+    """A plugin imported by the first lookup of one of its attributes, e.g. by the first request naming its scope
+
+    The import errors only show then, and a plugin that fails to import isn't tried again until it's reloaded.
+    """
+
+    def __init__(self, python_file, budget: Optional[float] = None):
+        super().__init__(os.path.splitext(os.path.basename(python_file))[0])
+        self._python_file = python_file
+        self._budget = budget
+        self._module: Optional[types.ModuleType] = None
+        self._error: Optional[Exception] = None
+        self._lock = threading.Lock()
+
+    @property
+    def imported(self) -> bool:
+        """Whether the import was tried already, the attribute lookups don't block then"""
+        return self._module is not None or self._error is not None
+
+    def load(self) -> types.ModuleType:
+        with self._lock:
+            if self._module is None and self._error is None:
+                try:
+                    _, self._module = load_plugin(self._python_file, self._budget)
+                except (InvalidPluginError, PluginNotFoundError) as e:
+                    self._error = e
+        if self._error is not None:
+            raise InvalidPluginError(f"{self.__name__} ({self._python_file}) failed to import") from self._error
+        return self._module
+
+    def __getattr__(self, name):
+        # only called for the attributes this proxy doesn't have itself
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f"<lazy plugin {self.__name__!r} from {self._python_file!r}>"
+
+
+def _version(python_file) -> Tuple[int, int]:
+    stat = os.stat(python_file)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_plugin(python_file, budget: Optional[float] = None):
     scope_key = os.path.splitext(os.path.basename(python_file))[0]
     plugin_str = f"{scope_key} ({python_file})"
     if not os.path.exists(python_file):
         raise PluginNotFoundError("this plugin file does not exist")
+    path = os.path.abspath(python_file)
+    version = _version(path)
+    loaded = _loaded.get(path)
+    if loaded is not None and loaded[0] == version:
+        return loaded[1], loaded[2]
+    logging.debug("load_plugin %s", python_file)
+    start = time.perf_counter()
     try:
         module = load_module(python_file)
     except Exception as e:
         logger.error("%s not importable", plugin_str)
         logger.error(traceback.format_exc())
         raise InvalidPluginError() from e
+    elapsed = time.perf_counter() - start
+    if budget is not None and elapsed > budget:
+        logger.warning("%s imported in %.3fs, over the %.3fs budget", plugin_str, elapsed, budget)
+    else:
+        logger.info("%s imported in %.3fs", plugin_str, elapsed)
 
     has_is_requests_allowed = hasattr(module, "is_request_allowed")
     has_response_callback = hasattr(module, "response_callback")
@@ -72,4 +162,12 @@ def load_plugin(python_file):
     else:
         raise InvalidPluginError("%s no member is_request_allowed or request_callback", plugin_str)
 
+    _loaded[path] = (version, scope_key, module)
     return scope_key, module
+
+
+def call_hook(hook, **kwargs):
+    """Calls a plugin hook, an async hook is run to completion in its own event loop"""
+    if inspect.iscoroutinefunction(hook):
+        return asyncio.run(hook(**kwargs))
+    return hook(**kwargs)
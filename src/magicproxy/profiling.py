@@ -0,0 +1,94 @@
+import contextlib
+import cProfile
+import io
+import logging
+import pstats
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# functions listed in the log once the profile is written
+SUMMARY_LINES = 25
+
+
+class Profiler:
+    """Profiles the next `requests` proxied requests with cProfile, then writes the stats to `output`
+
+    The stats file is read with `python -m pstats` or snakeviz.
+
+    Args:
+      shared: one profile for all the requests, from the first one until the last one is done, for an event loop
+        where the requests interleave. Otherwise each request is profiled on its own thread, and the profiles summed.
+    """
+
+    def __init__(self, requests: int, output: str, shared: bool = False):
+        self.remaining = requests
+        self.output = output
+        self.shared = shared
+        self._stats: Optional[pstats.Stats] = None
+        self._profile: Optional[cProfile.Profile] = None
+        self._running = 0
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self.remaining <= 0
+
+    @contextlib.contextmanager
+    def request(self):
+        if self.done:
+            yield
+        elif self.shared:
+            with self._shared_profile():
+                yield
+        else:
+            profile: Optional[cProfile.Profile] = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # python 3.12+ runs one profiler at a time, the concurrent requests are left out
+                profile = None
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    with self._lock:
+                        self._add(profile)
+
+    @contextlib.contextmanager
+    def _shared_profile(self):
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._running += 1
+        try:
+            yield
+        finally:
+            self._running -= 1
+            self.remaining -= 1
+            if self.done and self._running == 0:
+                self._profile.disable()
+                self._stats = pstats.Stats(self._profile)
+                self._profile = None
+                self._write()
+
+    def _add(self, profile: cProfile.Profile):
+        # the requests that started before the last one was done are left out
+        if self.done:
+            return
+        if self._stats is None:
+            self._stats = pstats.Stats(profile)
+        else:
+            self._stats.add(profile)
+        self.remaining -= 1
+        if self.done:
+            self._write()
+
+    def _write(self):
+        self._stats.dump_stats(self.output)
+        summary = io.StringIO()
+        self._stats.stream = summary
+        self._stats.sort_stats("cumulative").print_stats(SUMMARY_LINES)
+        logger.info(f"profile of the proxied requests written to {self.output}\n{summary.getvalue()}")
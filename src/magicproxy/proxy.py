@@ -11,22 +11,38 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
+import http.cookiejar
 import logging
 import os
+import signal
+import socket
+import threading
+import time
 import traceback
-from typing import Tuple, Set
+from typing import BinaryIO, Iterator, Optional, Tuple, Set, Union
 
 import flask
 import requests
+import requests.adapters
+from werkzeug.serving import make_server
 
 import magicproxy
 import magicproxy.types
+from . import executor
+from . import limiter
 from . import magictoken
 from . import queries
 from . import scopes
+from .cache import ResponseCache
 from .config import Config, load_config
 from .headers import clean_request_headers, clean_response_headers
-from .magictoken import magictoken_params_validate
+from .magictoken import magictoken_batch_results, magictoken_batch_validate, magictoken_params_validate
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Metrics
+from .plugins import InvalidPluginError
+from .profiling import Profiler
+from .ratelimit import retry_after_headers
+from .reload import Reloader
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +52,11 @@ query_params_to_clean: Set[str] = set()
 
 custom_request_headers_to_clean: Set[str] = set()
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
 
 @app.route("/__magictoken", methods=["POST", "GET"])
 def create_magic_token():
@@ -46,44 +67,212 @@ def create_magic_token():
     if flask.request.method == "GET":
         return "magic API proxy for " + api_root + " version " + magicproxy.__version__
     params = flask.request.json
+    if isinstance(params, list):
+        return _create_magic_tokens(config, params)
     try:
         magictoken_params_validate(config, params)
     except ValueError as e:
         return str(e), 400
 
-    token = magictoken.create(config.keys, params["token"], params.get("scopes"), params.get("allowed"))
+    token = magictoken.create(
+        config.keys, params["token"], params.get("scopes"), params.get("allowed"), version=config.token_version
+    )
     return token, 200, {"Content-Type": "application/jwt"}
 
 
-def _proxy_request(request: flask.Request, url: str, headers=None, **kwargs) -> Tuple[bytes, int, dict]:
+def _create_magic_tokens(config: Config, items: list):
+    """Mints a batch of tokens, the response lists the token or the error of each item"""
+    try:
+        errors = magictoken_batch_validate(config, items)
+    except ValueError as e:
+        return str(e), 400
+
+    specs = [item for item, error in zip(items, errors) if error is None]
+    tokens = app.config["BATCH_POOL"].create_batch(config, specs) if specs else []
+
+    return flask.jsonify(magictoken_batch_results(errors, tokens))
+
+
+def _get_session() -> requests.Session:
+    """The connection-pooled session to the API, shared between the threads of this process"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                config: Config = app.config.get("CONFIG") or Config()
+                session = requests.Session()
+                # shared between all the magic tokens, it must never carry cookies from one to another
+                session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=config.upstream_pool_connections,
+                    pool_maxsize=config.upstream_pool_maxsize,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def _pool_stats() -> Optional[dict]:
+    if _session is None:
+        return None
+    pool_manager = _session.get_adapter("https://").poolmanager
+    pools = [pool_manager.pools.get(key) for key in pool_manager.pools.keys()]
+    pools = [pool for pool in pools if pool is not None]
+    return {
+        "hosts": len(pools),
+        "connections": sum(pool.num_connections for pool in pools),
+        "requests": sum(pool.num_requests for pool in pools),
+    }
+
+
+@app.route("/__metrics", methods=["GET"])
+def show_metrics():
+    config: Config = app.config["CONFIG"]
+    if config is None:
+        return "magic API proxy version " + magicproxy.__version__, 503
+    if not config.metrics_enabled:
+        return "Metrics disabled", 404
+    stats = {
+        "upstream_pool": _pool_stats(),
+        "token_cache": config.token_cache.stats() if config.token_cache is not None else None,
+        "response_cache": config.response_cache.stats() if config.response_cache is not None else None,
+        "decision_cache": config.decisions.stats() if config.decisions is not None else None,
+        "rate_limits": config.rate_limits.stats() if config.rate_limits is not None else None,
+        "token_limiter": config.limiter.stats(),
+        "config_reload": app.config["RELOADER"].stats() if app.config["RELOADER"] is not None else None,
+    }
+    return app.config["METRICS"].render(stats), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
+
+def _stream_content(resp: requests.Response, start: float) -> Iterator[bytes]:
+    try:
+        yield from resp.iter_content(STREAM_CHUNK_SIZE)
+    finally:
+        resp.close()
+        app.config["METRICS"].observe("upstream", time.perf_counter() - start)
+
+
+def _read_chunks(stream: BinaryIO) -> Iterator[bytes]:
+    while True:
+        chunk = stream.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+class _RequestBody:
+    """A request body of known length, read from the client as it is sent to the API
+
+    requests sends a Content-Length for it (it has a length) and reads it chunk by chunk (it has a read).
+    """
+
+    def __init__(self, stream: BinaryIO, length: int):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        return self.stream.read(size)
+
+    def __iter__(self) -> Iterator[bytes]:
+        return _read_chunks(self.stream)
+
+
+def _request_body(request: flask.Request) -> Union[None, _RequestBody, Iterator[bytes]]:
+    """The request body, streamed to the API: with its Content-Length when it's known, chunked otherwise"""
+    if request.content_length:
+        return _RequestBody(request.stream, request.content_length)
+    if request.content_length is None and request.environ.get("wsgi.input_terminated"):
+        return _read_chunks(request.stream)
+    return None
+
+
+def _proxy_request(
+    request: flask.Request,
+    url: str,
+    headers=None,
+    stream=False,
+    response_cache: ResponseCache = None,
+    cache_key: tuple = None,
+    **kwargs,
+) -> Tuple[Union[bytes, Iterator[bytes]], int, dict]:
     clean_headers = clean_request_headers(request.headers, custom_request_headers_to_clean)
 
+    # requests frames the streamed body itself
+    clean_headers.pop("Content-Length", None)
+    clean_headers.pop("Transfer-Encoding", None)
+
     if headers:
         clean_headers.update(headers)
 
-    logger.debug(
-        f"Proxying to {request.method} {url}\nHeaders: {clean_headers}\nQuery: {request.args}\nContent: {request.data!r}"
-    )
+    cached = None
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            clean_headers.update(response_cache.conditional_headers(cached))
+
+    logger.debug(f"Proxying to {request.method} {url}\nHeaders: {clean_headers}\nQuery: {request.args}")
+
+    metrics: Metrics = app.config["METRICS"]
 
     # Make the API request
-    resp = requests.request(
+    start = time.perf_counter()
+    resp = _get_session().request(
         url=url,
         method=request.method,
         headers=clean_headers,
         params=dict(request.args),
-        data=request.data,
+        data=_request_body(request),
+        stream=stream,
         **kwargs,
     )
+    metrics.observe("upstream_ttfb", resp.elapsed.total_seconds())
+    if not stream:
+        metrics.observe("upstream", time.perf_counter() - start)
 
     response_headers = clean_response_headers(resp.headers)
 
+    if cached is not None and resp.status_code == 304:
+        resp.close()
+        if stream:
+            metrics.observe("upstream", time.perf_counter() - start)
+        cached = response_cache.revalidated(cache_key, cached, response_headers)
+        return cached.content, cached.code, clean_response_headers(cached.headers)
+
+    if stream:
+        content = _stream_content(resp, start)
+        if cache_key is not None:
+            content = response_cache.tee(cache_key, content, resp.status_code, response_headers)
+        return content, resp.status_code, response_headers
+
     logger.debug(resp, resp.headers, resp.content)
 
+    if cache_key is not None:
+        response_cache.store(cache_key, resp.content, resp.status_code, response_headers)
+
     return resp.content, resp.status_code, response_headers
 
 
+def _profiled(view):
+    """Profiles the first requests to the view, when the config asks for it"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        profiler: Optional[Profiler] = app.config.get("PROFILER")
+        if profiler is None or profiler.done:
+            return view(*args, **kwargs)
+        with profiler.request():
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
 @app.route("/", defaults={"path": ""})
 @app.route("/<path:path>", methods=["POST", "GET", "PATCH", "PUT", "DELETE"])
+@_profiled
 def proxy_api(path):
     config = app.config["CONFIG"]
     if config is None:
@@ -95,29 +284,75 @@ def proxy_api(path):
     if auth_token.startswith("Bearer "):
         auth_token = auth_token[len("Bearer ") :]
 
+    metrics: Metrics = app.config["METRICS"]
     try:
         # Validate the magic token
-        token_info = magictoken.decode(config.keys, auth_token)
+        with metrics.time("decode"):
+            token_info = magictoken.decode(config.keys, auth_token, config.token_cache)
     except ValueError:
         return "Not a valid magic token", 400
+    flask.g.token_scopes = token_info.scopes
 
     # Validate scopes against URL and method.
-    if not scopes.validate_request(config, flask.request.method, path, token_info.scopes, token_info.allowed):
+    try:
+        with metrics.time("validate"):
+            allowed = scopes.validate_request(config, flask.request.method, path, token_info.scopes, token_info.allowed)
+    except InvalidPluginError:
+        # a lazy scope plugin that failed to import
+        return "Scope plugin unavailable", 503
+    if not allowed:
         return (
             "Disallowed by API proxy",
             401,
         )
 
+    token_rate_limit = scopes.rate_limit(config, token_info.scopes)
+    if token_rate_limit is not None:
+        retry_after = config.limiter.check(limiter.key(token_info.issued_at, auth_token), *token_rate_limit)
+        if retry_after is not None:
+            return "Rate limit of the magic token exceeded", 429, retry_after_headers(retry_after)
+
     path = queries.clean_path_queries(query_params_to_clean, path)
 
+    if config.rate_limits is not None:
+        priority = scopes.priority(config, token_info.scopes)
+        deadline = time.monotonic() + config.rate_limit_max_wait
+        retry_after = config.rate_limits.check(token_info.token, path, priority)
+        while retry_after is not None:
+            if time.monotonic() + retry_after > deadline:
+                return "API rate limit almost exhausted", 429, retry_after_headers(retry_after)
+            # queued until the quota resets, holding a server thread meanwhile
+            time.sleep(retry_after)
+            # checked again: the responses meanwhile may have told another quota
+            retry_after = config.rate_limits.check(token_info.token, path, priority)
+
+    # a response_callback needs the whole content, those responses are not streamed
+    stream = config.stream_responses and not scopes.has_response_callback(config, token_info.scopes)
+
+    cache_key = None
+    if config.response_cache is not None:
+        cache_key = config.response_cache.key(
+            flask.request.method, path, flask.request.query_string, flask.request.headers, token_info.token
+        )
+
     response = _proxy_request(
         request=flask.request,
         url=f"{config.api_root}/{path}",
         headers={"Authorization": f"Bearer {token_info.token}"},
+        stream=stream,
+        response_cache=config.response_cache,
+        cache_key=cache_key,
     )
 
+    if config.rate_limits is not None:
+        config.rate_limits.update(token_info.token, path, response[2])
+
+    if stream:
+        return flask.Response(*response)
+
     try:
-        scopes.response_callback(config, flask.request.method, path, *response, token_info.scopes)
+        with metrics.time("response_callback"):
+            scopes.response_callback(config, flask.request.method, path, *response, token_info.scopes)
     except Exception as e:
         logger.error("exception in response_callback")
         logger.error(e)
@@ -126,7 +361,35 @@ def proxy_api(path):
     return response
 
 
-def build_app(config: Config = None):
+@app.after_request
+def count_request(response: flask.Response):
+    if flask.request.endpoint == "proxy_api":
+        app.config["METRICS"].count_request(response.status_code, flask.g.get("token_scopes"))
+    return response
+
+
+def _swap_config(config: Config):
+    """Makes config the current one, the requests in flight finish with the one they started with"""
+    app.config["CONFIG"] = config
+
+
+def _watch_config(reloader: Reloader):
+    """Reloads the config on SIGHUP, and when its files change if config_reload_interval is set"""
+    if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+        # not in the signal handler, the main thread is serving
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reloader.reload).start())
+    interval = reloader.config.config_reload_interval if reloader.config is not None else 0
+    if interval:
+        reloader.watch_in_thread(interval)
+
+
+def build_app(config: Config = None, reload: bool = False):
+    """The flask app, serving config
+
+    Args:
+      reload: the config can be reloaded, from CONFIG_FILE and the environment, through the RELOADER of the app
+    """
+    global _session
     if "COVERAGE_RUN" in os.environ:
         import coverage
 
@@ -138,11 +401,30 @@ def build_app(config: Config = None):
             # will run, but in degraded mode (503)
             pass
     app.config["CONFIG"] = config
+    app.config["RELOADER"] = Reloader(config, _swap_config) if reload else None
+    app.config["METRICS"] = Metrics()
+    app.config["PROFILER"] = None
+    if config is not None and config.profile_requests:
+        app.config["PROFILER"] = Profiler(config.profile_requests, config.profile_output)
+    # the pooled session is (re)created on first use, with the new config
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+    if app.config.get("BATCH_POOL") is not None:
+        app.config["BATCH_POOL"].shutdown()
+    app.config["BATCH_POOL"] = executor.BatchPool()
     return app
 
 
-def run_app(host, port, config: Config = None):
-    build_app(config).run(
+def run_app(host, port, config: Config = None, sock: socket.socket = None):
+    flask_app = build_app(config, reload=True)
+    _watch_config(flask_app.config["RELOADER"])
+    if sock is not None:
+        # a worker process, serving on the socket it inherited
+        make_server(host, port, flask_app, threaded=True, fd=sock.fileno()).serve_forever()
+        return
+    flask_app.run(
         host=host,
         port=port,
         use_reloader=os.environ.get("FLASK_USE_RELOADER") is not None,
@@ -0,0 +1,110 @@
+import dataclasses
+import hashlib
+import math
+import threading
+import time
+from typing import Mapping, Optional
+
+from magicproxy.cache import LRUCache
+
+# the API resources with a rate limit of their own, by path prefix, the other paths count against "core"
+RESOURCES = (("search/code", "code_search"), ("search/", "search"), ("graphql", "graphql"))
+DEFAULT_RESOURCE = "core"
+DEFAULT_MAXSIZE = 10000
+# once a quota down to the reserve resets, the seconds the other requests wait for the first one to tell the new quota
+PROBE_TIMEOUT = 1.0
+
+
+def resource(path: str) -> str:
+    """The rate limited API resource a request path counts against"""
+    path = path.lstrip("/")
+    for prefix, name in RESOURCES:
+        if path.startswith(prefix):
+            return name
+    return DEFAULT_RESOURCE
+
+
+def retry_after_headers(seconds: float) -> dict:
+    return {"Retry-After": str(math.ceil(seconds))}
+
+
+@dataclasses.dataclass
+class Quota:
+    remaining: int
+    # epoch seconds
+    reset: float
+    # a request went out after the reset, to learn the new quota
+    probing: bool = False
+
+
+class RateLimits:
+    """The remaining API quota of each API token, from the X-RateLimit-* headers of its responses
+
+    Quotas are keyed by a SHA-256 digest of the API token and the API resource, they are forgotten when they reset.
+    The quota is counted down locally for each request let through, until the next response tells the actual one.
+    A request is shed when the remaining quota is down to the reserve of its priority, `reserve // (priority + 1)`,
+    and whatever its priority once the quota is exhausted. When a quota down to the reserve resets, a single request
+    goes out first, the others wait for its response (at most PROBE_TIMEOUT seconds) rather than all go at once.
+
+    Args:
+      reserve: the remaining quota below which the requests of priority 0 are shed
+      maxsize: the maximum number of quotas tracked
+    """
+
+    def __init__(self, reserve: int, maxsize: int = DEFAULT_MAXSIZE):
+        self.reserve = reserve
+        self.shed = 0
+        self._quotas = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(api_token: str, resource_name: str) -> tuple:
+        return hashlib.sha256(api_token.encode("utf-8")).hexdigest(), resource_name
+
+    def threshold(self, priority: int) -> int:
+        return self.reserve // (max(priority, 0) + 1)
+
+    def check(self, api_token: str, path: str, priority: int = 0) -> Optional[float]:
+        """None when the request can go, otherwise the seconds until the quota resets"""
+        with self._lock:
+            quota: Optional[Quota] = self._quotas.get(self._key(api_token, resource(path)))
+            if quota is None:
+                return None
+            now = time.time()
+            if quota.reset <= now:
+                if quota.remaining > self.reserve or now >= quota.reset + PROBE_TIMEOUT:
+                    return None
+                if not quota.probing:
+                    quota.probing = True
+                    return None
+                self.shed += 1
+                return quota.reset + PROBE_TIMEOUT - now
+            retry_after = quota.reset - now
+            if quota.remaining <= self.threshold(priority):
+                self.shed += 1
+                return retry_after
+            quota.remaining -= 1
+            return None
+
+    def update(self, api_token: str, path: str, headers: Mapping):
+        """Records the quota the API reports in the headers of a response"""
+        headers = {name.lower(): value for name, value in headers.items()}
+        now = time.time()
+        try:
+            if "retry-after" in headers:
+                # a secondary rate limit, nothing goes through until then
+                quota = Quota(remaining=0, reset=now + float(headers["retry-after"]))
+            elif "x-ratelimit-remaining" in headers and "x-ratelimit-reset" in headers:
+                quota = Quota(
+                    remaining=int(headers["x-ratelimit-remaining"]), reset=float(headers["x-ratelimit-reset"])
+                )
+            else:
+                return
+        except ValueError:
+            return
+        key = self._key(api_token, headers.get("x-ratelimit-resource") or resource(path))
+        # kept a bit after the reset, for the probe
+        self._quotas.set(key, quota, ttl=quota.reset - now + PROBE_TIMEOUT)
+
+    def stats(self) -> dict:
+        return {"tokens": len(self._quotas), "shed": self.shed}
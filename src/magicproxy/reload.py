@@ -0,0 +1,136 @@
+import asyncio
+import glob
+import logging
+import os
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from magicproxy.config import Config, load_config
+
+logger = logging.getLogger(__name__)
+
+# the state a new config takes over from the previous one, when the settings it was built from are the same
+CARRIED_OVER = {
+    "token_cache": ("token_cache_size", "token_cache_ttl"),
+    "response_cache": ("response_cache_size", "response_cache_max_bytes", "response_cache_max_entry_size"),
+    "rate_limits": ("rate_limit_reserve",),
+    "limiter": ("token_limiter_backend", "token_limiter_size", "token_limiter_redis_url"),
+}
+
+
+def carry_over(previous: Optional[Config], config: Config):
+    """Keeps the warm caches and the rate limit state of the previous config in the new one"""
+    if previous is None:
+        return
+    for name, settings in CARRIED_OVER.items():
+        if getattr(previous, name) is None:
+            continue
+        if any(getattr(previous, setting) != getattr(config, setting) for setting in settings):
+            continue
+        if name == "token_cache" and (previous.keys is None or config.keys is None or not _same_keys(previous, config)):
+            # the cached tokens were verified with the previous keys
+            continue
+        setattr(config, name, getattr(previous, name))
+
+
+def _same_keys(previous: Config, config: Config) -> bool:
+    return previous.keys.certificate_pem == config.keys.certificate_pem
+
+
+class ConfigHolder:
+    """The current config of an app, for the apps whose state can't change once they run"""
+
+    def __init__(self, config: Optional[Config]):
+        self.config = config
+
+
+class Reloader:
+    """Loads the config again, from CONFIG_FILE and the environment, and hands it to `swap`
+
+    The requests in flight finish with the config they started with, the next ones get the new one.
+    A config that fails to load is logged, and the current one kept.
+
+    Args:
+      config: the current config
+      swap: makes the new config the current one
+    """
+
+    def __init__(self, config: Optional[Config], swap: Callable[[Config], None]):
+        self.config = config
+        self.reloads = 0
+        self.failures = 0
+        self._swap = swap
+        self._lock = threading.Lock()
+        self._snapshot = self.snapshot()
+
+    def files(self):
+        """The config file and the plugins of the current config"""
+        files = []
+        config_file = os.environ.get("CONFIG_FILE")
+        if config_file:
+            files.append(config_file)
+        if self.config is not None and self.config.plugins_location:
+            files.extend(sorted(glob.glob(f"{self.config.plugins_location}/*.py")))
+        return files
+
+    def snapshot(self) -> Dict[str, Optional[Tuple[int, int]]]:
+        snapshot = {}
+        for path in self.files():
+            try:
+                stat = os.stat(path)
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                snapshot[path] = None
+        return snapshot
+
+    def changed(self) -> bool:
+        return self.snapshot() != self._snapshot
+
+    def reload(self) -> bool:
+        """Whether the new config was swapped in, a reload already running is not started again"""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            # taken first, a change made while loading is seen by the next poll
+            snapshot = self.snapshot()
+            try:
+                config = load_config()
+            except Exception:
+                logger.exception("config reload failed, keeping the current config")
+                self.failures += 1
+                self._snapshot = snapshot
+                return False
+            carry_over(self.config, config)
+            self._swap(config)
+            self.config = config
+            # the plugins of the new config are watched from now on
+            self._snapshot = {path: snapshot.get(path, stat) for path, stat in self.snapshot().items()}
+            self.reloads += 1
+            logger.info("config reloaded")
+            return True
+        finally:
+            self._lock.release()
+
+    def poll(self) -> bool:
+        return self.changed() and self.reload()
+
+    def watch_in_thread(self, interval: float) -> threading.Event:
+        """Polls the files every `interval` seconds in a daemon thread, until the returned event is set"""
+        stopped = threading.Event()
+
+        def watch():
+            while not stopped.wait(interval):
+                self.poll()
+
+        threading.Thread(target=watch, name="magicproxy-reload", daemon=True).start()
+        return stopped
+
+    async def watch(self, interval: float):
+        """Polls the files every `interval` seconds, the reload runs in the default thread pool"""
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self.poll)
+
+    def stats(self) -> dict:
+        return {"reloads": self.reloads, "failures": self.failures}
@@ -11,28 +11,50 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import functools
+import inspect
 import logging
-import re
+import math
 import types
-from typing import List, Optional
+from typing import Callable, Hashable, Iterator, List, Optional, Tuple
 
-from magicproxy.config import Config
-from magicproxy.types import Permission
+from magicproxy.cache import LRUCache
+from magicproxy.config import Config, parse_permission
+from magicproxy.matcher import PermissionMatcher
+from magicproxy.plugins import LazyPlugin, call_hook
 
 logger = logging.getLogger(__name__)
 
+ALLOWED_MATCHERS_CACHE_SIZE = 1024
 
-def is_request_allowed(permission: Permission, method, path):
-    logger.debug(f"validating request {method} {path} on permission {permission}")
+# compiled matchers of the allowed lists carried by the tokens, by allowed list
+allowed_matchers = LRUCache(maxsize=ALLOWED_MATCHERS_CACHE_SIZE)
+
+
+def allowed_matcher(allowed: List[str]) -> PermissionMatcher:
+    """The compiled matcher for an allowed list of "METHOD path_regex" strings, memoized"""
+    key = tuple(allowed)
+    matcher = allowed_matchers.get(key)
+    if matcher is None:
+        matcher = PermissionMatcher(parse_permission(allowed_item) for allowed_item in allowed)
+        allowed_matchers.set(key, matcher)
+    return matcher
 
-    if not path.startswith("/"):
-        path = f"/{path}"
 
-    if method != permission.method and permission.method != "*":
-        return False
+def _decision_key(config: Config, method: str, path: str, scopes: List[str], allowed: List[str]) -> Optional[Hashable]:
+    """The key of the authorization decision in the config decision cache, None if it can't be cached
 
-    if re.match(permission.path, path, re.I):
-        return True
+    The decisions of the permission list scopes and of the allowed lists only depend on the key, the scope
+    plugins can change their mind, unless they declare `cacheable = True`.
+    """
+    if config.decisions is None:
+        return None
+    for scope_key in scopes:
+        scope_element = config.scopes.get(scope_key)
+        if isinstance(scope_element, types.ModuleType) and not getattr(scope_element, "cacheable", False):
+            return None
+    return tuple(scopes), tuple(allowed), method, path
 
 
 def validate_request(
@@ -62,36 +84,139 @@ def validate_request(
 
     Would allow getting the user info and updating labels on issues on a GitHub repo
     """
-    if allowed is None:
-        allowed = []
+    path, scopes, allowed = _request(path, scopes, allowed)
+
+    key = _decision_key(config, method, path, scopes, allowed)
+    if key is not None:
+        decision = config.decisions.get(key)
+        if decision is not None:
+            return decision
+
+    decision = _validate_request(config, method, path, scopes, allowed)
+    if key is not None:
+        config.decisions.set(key, decision, weight=len(allowed))
+    return decision
 
-    if scopes is None:
-        scopes = []
 
+async def call_hook_async(hook, **kwargs):
+    """Awaits a plugin hook, a sync hook is run in the default thread pool of the event loop"""
+    if inspect.iscoroutinefunction(hook):
+        return await hook(**kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(hook, **kwargs))
+
+
+def _request(path: str, scopes: Optional[List[str]], allowed: Optional[List[str]]) -> Tuple[str, List[str], List[str]]:
     if not path.startswith("/"):
         path = f"/{path}"
+    return path, scopes or [], allowed or []
 
-    # boolean OR: one of the scope allows: it's allowed
+
+def _request_hooks(config: Config, method: str, path: str, scopes: List[str]) -> Iterator[Optional[Callable]]:
+    """The is_request_allowed hooks of the scope plugins, to call in turn, None once a permission list scope allows
+
+    Shared by the sync and the async validation, that only differ in how they call the hooks.
+    """
     for scope_key in scopes:
         scope_element = config.scopes[scope_key]
         if isinstance(scope_element, list):
-            for scope in scope_element:
-                if is_request_allowed(scope, method, path):
-                    return True
+            if config.matchers[scope_key].match(method, path):
+                yield None
         elif isinstance(scope_element, types.ModuleType):
             if hasattr(scope_element, "is_request_allowed"):
-                if scope_element.is_request_allowed(method=method, path=path):
-                    return True
+                yield scope_element.is_request_allowed
         logger.debug(f"not allowed by scope {scope_key}")
 
-    for allowed_item in allowed:
-        allowed_method, allowed_path = allowed_item.split(" ", 1)
-        if is_request_allowed(Permission(method=allowed_method, path=allowed_path), method, path):
+
+def _allowed_by_list(method: str, path: str, allowed: List[str]) -> bool:
+    return bool(allowed) and allowed_matcher(allowed).match(method, path)
+
+
+def _validate_request(config: Config, method: str, path: str, scopes: List[str], allowed: List[str]) -> bool:
+    # boolean OR: one of the scope allows: it's allowed
+    for hook in _request_hooks(config, method, path, scopes):
+        if hook is None or call_hook(hook, method=method, path=path):
+            return True
+    return _allowed_by_list(method, path, allowed)
+
+
+async def _import_plugins_async(config: Config, scopes: List[str]):
+    """Imports the lazy plugins of the named scopes in the default thread pool, not on the event loop"""
+    for scope_key in scopes:
+        scope_element = config.scopes.get(scope_key)
+        if isinstance(scope_element, LazyPlugin) and not scope_element.imported:
+            await asyncio.get_running_loop().run_in_executor(None, scope_element.load)
+
+
+async def validate_request_async(
+    config: Config,
+    method: str,
+    path: str,
+    scopes: List[str] = None,
+    allowed: List[str] = None,
+) -> bool:
+    """validate_request, for the event loop
+
+    The is_request_allowed hooks of the scope plugins are awaited, the sync ones run in a thread pool.
+    """
+    path, scopes, allowed = _request(path, scopes, allowed)
+
+    await _import_plugins_async(config, scopes)
+    key = _decision_key(config, method, path, scopes, allowed)
+    if key is not None:
+        decision = config.decisions.get(key)
+        if decision is not None:
+            return decision
+
+    decision = await _validate_request_async(config, method, path, scopes, allowed)
+    if key is not None:
+        config.decisions.set(key, decision, weight=len(allowed))
+    return decision
+
+
+async def _validate_request_async(
+    config: Config, method: str, path: str, scopes: List[str], allowed: List[str]
+) -> bool:
+    for hook in _request_hooks(config, method, path, scopes):
+        if hook is None or await call_hook_async(hook, method=method, path=path):
             return True
+    return _allowed_by_list(method, path, allowed)
 
+
+def has_response_callback(config: Config, scopes: Optional[List[str]] = None) -> bool:
+    """Whether one of the named scopes needs to see the responses"""
+    for scope in scopes or []:
+        scope_element = config.scopes[scope]
+        if isinstance(scope_element, types.ModuleType) and hasattr(scope_element, "response_callback"):
+            return True
     return False
 
 
+def priority(config: Config, scopes: Optional[List[str]] = None) -> int:
+    """The highest priority of the named scopes, 0 when none is set"""
+    priorities = [config.scope_settings[scope].priority for scope in scopes or [] if scope in config.scope_settings]
+    return max(priorities, default=0)
+
+
+def rate_limit(config: Config, scopes: Optional[List[str]] = None) -> Optional[Tuple[float, int]]:
+    """The highest (requests per second, burst) limit of the named scopes, None when one of them has no limit
+
+    A scope without a rate_limit of its own, like a token without scopes, gets the config default one.
+    """
+    default = (config.token_rate_limit, config.token_rate_burst)
+    limits = []
+    for scope in scopes or [None]:
+        settings = config.scope_settings.get(scope) if scope is not None else None
+        if settings is not None and settings.rate_limit is not None:
+            limits.append((settings.rate_limit, settings.burst))
+        else:
+            limits.append(default)
+    if any(rate is None for rate, _ in limits):
+        return None
+    rate, burst = max(limits, key=lambda limit: limit[0])
+    return rate, burst or max(1, math.ceil(rate))
+
+
 def response_callback(
     config: Config,
     method,
@@ -111,20 +236,36 @@ def response_callback(
     Would allow the proxy to process the response of a request
     e.g. can allow a DELETE on a resource once its :id: is known in the JSON of the reponse
     """
-    if scopes is None:
-        scopes = []
+    path, scopes, _ = _request(path, scopes, None)
+
+    for hook in _response_hooks(config, scopes):
+        call_hook(hook, method=method, path=path, content=content, code=code, headers=headers)
 
-    if not path.startswith("/"):
-        path = f"/{path}"
 
+def _response_hooks(config: Config, scopes: List[str]) -> Iterator[Callable]:
+    """The response_callback hooks of the scope plugins, in order"""
     for scope in scopes:
         scope_element = config.scopes[scope]
         if isinstance(scope_element, types.ModuleType):
             if hasattr(scope_element, "response_callback"):
-                scope_element.response_callback(
-                    method=method,
-                    path=path,
-                    content=content,
-                    code=code,
-                    headers=headers,
-                )
+                yield scope_element.response_callback
+
+
+async def response_callback_async(
+    config: Config,
+    method,
+    path,
+    content,
+    code,
+    headers,
+    scopes: Optional[List[str]] = None,
+):
+    """response_callback, for the event loop
+
+    The response_callback hooks of the scope plugins are awaited, the sync ones run in a thread pool.
+    """
+    path, scopes, _ = _request(path, scopes, None)
+
+    await _import_plugins_async(config, scopes)
+    for hook in _response_hooks(config, scopes):
+        await call_hook_async(hook, method=method, path=path, content=content, code=code, headers=headers)
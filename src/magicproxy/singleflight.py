@@ -0,0 +1,63 @@
+import asyncio
+import hashlib
+from typing import Dict, Hashable, Mapping, Optional
+
+
+class SingleFlight:
+    """Shares one in-flight API call between the identical concurrent requests
+
+    The first request of a key leads: it makes the API call, then hands its result to the
+    requests of the same key that came in meanwhile. A None result tells them to make their own call.
+
+    Args:
+      max_size: the largest response content shared, in bytes
+    """
+
+    # request headers that don't change the API response, left out of the key, the magic token too:
+    # the API token it stands for is part of the key
+    IGNORED_REQUEST_HEADERS = {
+        "authorization",
+        "user-agent",
+        "accept-encoding",
+        "content-length",
+        "x-request-id",
+        "x-forwarded-for",
+    }
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.leaders = 0
+        self.followers = 0
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def key(self, method: str, path: str, query_string, request_headers: Mapping, api_token: str) -> Optional[tuple]:
+        """The key of a request, None if it can't share a call"""
+        if method != "GET":
+            return None
+        token_digest = hashlib.sha256(api_token.encode("utf-8")).hexdigest()
+        headers = tuple(
+            sorted(
+                (name.lower(), value)
+                for name, value in request_headers.items()
+                if name.lower() not in self.IGNORED_REQUEST_HEADERS
+            )
+        )
+        return path, str(query_string), token_digest, headers
+
+    def join(self, key: Hashable) -> Optional[asyncio.Future]:
+        """The call in flight for that key, to await, None if the caller should lead it"""
+        call = self._calls.get(key)
+        if call is not None:
+            self.followers += 1
+            return call
+        self.leaders += 1
+        self._calls[key] = asyncio.get_event_loop().create_future()
+        return None
+
+    def finish(self, key: Hashable, result):
+        call = self._calls.pop(key, None)
+        if call is not None and not call.done():
+            call.set_result(result)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "followers": self.followers}
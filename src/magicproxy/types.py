@@ -1,11 +1,11 @@
 from dataclasses import dataclass
-from typing import Optional, List, Union
+from typing import TYPE_CHECKING, Optional, List, Union
 
-import google.auth
-import google.auth.crypt
-import google.auth.jwt
-from cryptography import x509
-from cryptography.hazmat.primitives.asymmetric import rsa
+if TYPE_CHECKING:
+    # only for the annotations, importing them is slow and not needed to read a config
+    import google.auth.crypt
+    from cryptography import x509
+    from cryptography.hazmat.primitives.asymmetric import rsa
 
 
 @dataclass
@@ -14,17 +14,30 @@ class Permission:
     path: str
 
 
+@dataclass
+class ScopeSettings:
+    # the requests of the higher priorities are the last ones shed when the upstream rate limit runs low
+    priority: int = 0
+    # requests per second of each magic token, and the bucket size (at least one second of requests by default)
+    rate_limit: Optional[float] = None
+    burst: Optional[int] = None
+
+
 @dataclass
 class DecodeResult:
     token: str
     scopes: Optional[str]
     allowed: Optional[List[Union[str, Permission]]]
+    expires_at: Optional[int] = None
+    issued_at: Optional[int] = None
 
 
 @dataclass
 class _Keys:
-    private_key: rsa.RSAPrivateKey = None
-    private_key_signer: google.auth.crypt.RSASigner = None
-    public_key: rsa.RSAPublicKey = None
-    certificate: x509.Certificate = None
+    private_key: "rsa.RSAPrivateKey" = None
+    private_key_signer: "google.auth.crypt.RSASigner" = None
+    public_key: "rsa.RSAPublicKey" = None
+    certificate: "x509.Certificate" = None
     certificate_pem: bytes = None
+    token_sealing_key: bytes = None
+    token_signing_key: bytes = None
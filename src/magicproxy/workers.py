@@ -0,0 +1,98 @@
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+RESTART_DELAY = 1
+BACKLOG = 1024
+
+
+def listening_socket(host: str, port: int) -> socket.socket:
+    """Binds the socket that the worker processes will inherit and accept connections on
+
+    SO_REUSEPORT, where available, lets a new server bind the port while the previous one drains.
+    """
+    family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve(run_worker: Callable[[], None], workers: int):
+    """Runs run_worker in `workers` forked processes, until SIGTERM or SIGINT
+
+    Everything loaded before the call (config, keys) is shared with the workers. A worker that
+    exits is replaced by a new one. SIGHUP is passed on to the workers, for them to reload their config.
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("multiple workers need os.fork, not available on this platform")
+
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(number: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            if hasattr(signal, "SIGHUP"):
+                # until the worker handles it
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            status = 0
+            try:
+                run_worker()
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logger.exception("worker %s crashed", number)
+                status = 1
+            finally:
+                os._exit(status)
+        logger.info("started worker %s (pid %s)", number, pid)
+        children[pid] = number
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reload(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload)
+
+    for number in range(workers):
+        spawn(number)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        number = children.pop(pid, None)
+        if number is None or stopping:
+            continue
+        logger.warning("worker %s (pid %s) exited with status %s, restarting it", number, pid, status)
+        time.sleep(RESTART_DELAY)
+        if not stopping:
+            spawn(number)
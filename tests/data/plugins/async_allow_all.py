@@ -0,0 +1,6 @@
+import asyncio
+
+
+async def is_request_allowed(method, path):
+    await asyncio.sleep(0)
+    return True
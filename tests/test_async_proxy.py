@@ -0,0 +1,299 @@
+import asyncio
+import os
+import time
+import types
+
+import aiohttp
+import aiohttp.web
+from aiohttp.test_utils import TestClient, TestServer
+
+import magicproxy.keys
+from magicproxy import async_proxy, magictoken
+from magicproxy.config import Config
+from magicproxy.plugins import LazyPlugin
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+KEYS = magicproxy.keys.Keys.from_files(
+    private_key_file=os.path.join(DATA, "private.pem"),
+    certificate_file=os.path.join(DATA, "public.x509.cer"),
+)
+LARGE_CONTENT = os.urandom(1024 * 1024)
+ETAG_REQUESTS = []
+SLOW_REQUESTS = []
+
+
+def upstream_app():
+    async def route(request):
+        if request.headers.get("Authorization") == "Bearer fake_token":
+            return aiohttp.web.Response(text="authorized by API")
+        return aiohttp.web.Response(text="not authorized by API", status=401)
+
+    async def large(request):
+        return aiohttp.web.Response(body=LARGE_CONTENT)
+
+    async def etag(request):
+        ETAG_REQUESTS.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return aiohttp.web.Response(status=304, headers={"ETag": '"v1"'})
+        return aiohttp.web.Response(text="etag content", headers={"ETag": '"v1"'})
+
+    async def slow(request):
+        SLOW_REQUESTS.append(request.path)
+        await asyncio.sleep(0.2)
+        return aiohttp.web.Response(text="slow content")
+
+    async def limited(request):
+        reset = str(int(time.time()) + 60)
+        return aiohttp.web.Response(
+            text="almost exhausted", headers={"X-RateLimit-Remaining": "1", "X-RateLimit-Reset": reset}
+        )
+
+    async def upload(request):
+        return aiohttp.web.json_response(
+            {
+                "content_length": request.headers.get("Content-Length"),
+                "transfer_encoding": request.headers.get("Transfer-Encoding"),
+                "size": len(await request.read()),
+            }
+        )
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/", route)
+    app.router.add_get("/large", large)
+    app.router.add_get("/etag", etag)
+    app.router.add_get("/slow", slow)
+    app.router.add_get("/limited", limited)
+    app.router.add_put("/upload", upload)
+    return app
+
+
+def run_with_proxy(test, **config_kwargs):
+    async def runner():
+        async with TestServer(upstream_app()) as upstream:
+            config = Config(api_root=str(upstream.make_url("")).rstrip("/"), keys=KEYS, **config_kwargs)
+            app = await async_proxy.build_app(config)
+            async with TestClient(TestServer(app)) as client:
+                await test(client, app)
+
+    asyncio.run(runner())
+
+
+def test_proxy_shares_pooled_session():
+    token = magictoken.create(KEYS, "fake_token", allowed=["GET /.*"])
+
+    async def test(client, app):
+        session = app["CLIENT_SESSION"]
+        assert session.connector.limit == 7
+        assert session.connector.limit_per_host == 3
+
+        for _ in range(3):
+            response = await client.get("/", headers={"Authorization": f"Bearer {token}"})
+            assert response.status == 200
+            assert await response.text() == "authorized by API"
+
+        assert app["CLIENT_SESSION"] is session
+
+    run_with_proxy(test, upstream_limit=7, upstream_limit_per_host=3)
+
+
+def callback_plugin(contents):
+    plugin = types.ModuleType("callback_plugin")
+
+    def is_request_allowed(method, path):
+        return True
+
+    async def response_callback(method, path, content, code, headers):
+        contents.append(content)
+
+    plugin.is_request_allowed = is_request_allowed
+    plugin.response_callback = response_callback
+    return plugin
+
+
+def test_response_callback_gets_whole_content():
+    contents = []
+    token = magictoken.create(KEYS, "fake_token", scopes=["callback_plugin"])
+
+    async def test(client, app):
+        response = await client.get("/large", headers={"Authorization": f"Bearer {token}"})
+        assert await response.read() == LARGE_CONTENT
+        await asyncio.gather(*app["BACKGROUND_TASKS"])
+        assert contents == [LARGE_CONTENT]
+
+    run_with_proxy(test, scopes={"callback_plugin": callback_plugin(contents)})
+
+
+def test_response_callback_content_too_large():
+    contents = []
+    token = magictoken.create(KEYS, "fake_token", scopes=["callback_plugin"])
+
+    async def test(client, app):
+        response = await client.get("/large", headers={"Authorization": f"Bearer {token}"})
+        assert await response.read() == LARGE_CONTENT
+        await asyncio.gather(*app["BACKGROUND_TASKS"])
+        assert contents == []
+
+    run_with_proxy(
+        test, scopes={"callback_plugin": callback_plugin(contents)}, response_callback_max_size=len(LARGE_CONTENT) - 1
+    )
+
+
+def test_proxy_revalidates_cached_responses():
+    token = magictoken.create(KEYS, "fake_token", allowed=["GET /.*"])
+    ETAG_REQUESTS.clear()
+
+    async def test(client, app):
+        for _ in range(3):
+            response = await client.get("/etag", headers={"Authorization": f"Bearer {token}"})
+            assert response.status == 200
+            assert await response.text() == "etag content"
+
+        assert ETAG_REQUESTS == [None, '"v1"', '"v1"']
+
+    run_with_proxy(test, response_cache_size=10)
+
+
+def test_proxy_coalesces_concurrent_requests():
+    # different magic tokens, for the same API token
+    tokens = [magictoken.create(KEYS, "fake_token", allowed=["GET /.*", f"GET /{number}"]) for number in range(5)]
+    SLOW_REQUESTS.clear()
+
+    async def test(client, app):
+        async def get(token):
+            response = await client.get("/slow", headers={"Authorization": f"Bearer {token}"})
+            return response.status, await response.text()
+
+        results = await asyncio.gather(*(get(token) for token in tokens))
+        assert results == [(200, "slow content")] * 5
+        assert SLOW_REQUESTS == ["/slow"]
+        assert app["SINGLE_FLIGHT"].stats() == {"in_flight": 0, "leaders": 1, "followers": 4}
+
+    run_with_proxy(test, coalesce_requests=True)
+
+
+def test_proxy_coalesced_content_too_large():
+    token = magictoken.create(KEYS, "fake_token", allowed=["GET /.*"])
+    SLOW_REQUESTS.clear()
+
+    async def test(client, app):
+        async def get():
+            response = await client.get("/slow", headers={"Authorization": f"Bearer {token}"})
+            return await response.text()
+
+        assert await asyncio.gather(get(), get()) == ["slow content"] * 2
+        assert SLOW_REQUESTS == ["/slow", "/slow"]
+
+    run_with_proxy(test, coalesce_requests=True, coalesce_max_size=4)
+
+
+def test_proxy_streams_request_body():
+    token = magictoken.create(KEYS, "fake_token", allowed=["PUT /upload"])
+
+    async def test(client, app):
+        response = await client.put("/upload", data=LARGE_CONTENT, headers={"Authorization": f"Bearer {token}"})
+        assert await response.json() == {
+            "content_length": str(len(LARGE_CONTENT)),
+            "transfer_encoding": None,
+            "size": len(LARGE_CONTENT),
+        }
+
+    run_with_proxy(test)
+
+
+def test_metrics():
+    token = magictoken.create(KEYS, "fake_token", allowed=["GET /.*"])
+
+    async def test(client, app):
+        response = await client.get("/", headers={"Authorization": f"Bearer {token}"})
+        assert response.status == 200
+        response = await client.get("/")
+        assert response.status == 403
+
+        response = await client.get("/__metrics")
+        assert response.status == 200
+        metrics = await response.text()
+        assert 'magicproxy_requests_total{status="200",scope="none"} 1' in metrics
+        assert 'magicproxy_requests_total{status="403",scope="none"} 1' in metrics
+        for stage in ("decode", "validate", "upstream_ttfb", "upstream"):
+            assert f'magicproxy_stage_duration_seconds_count{{stage="{stage}"}} 1' in metrics
+        assert "magicproxy_crypto_executor_queue_depth 0" in metrics
+        assert "magicproxy_upstream_pool_limit 100" in metrics
+
+    run_with_proxy(test)
+
+
+def test_create_magic_tokens_batch():
+    async def test(client, app):
+        response = await client.post(
+            "/__magictoken",
+            json=[{"token": "first_token", "allowed": ["GET /user"]}, {"token": "second_token", "scopes": ["unknown"]}],
+        )
+        assert response.status == 200
+        first, unknown_scope = await response.json()
+        assert magictoken.decode(KEYS, first["token"]).token == "first_token"
+        assert "scope must be configured" in unknown_scope["error"]
+
+    run_with_proxy(
+        test,
+        private_key_location=os.path.join(DATA, "private.pem"),
+        public_certificate_location=os.path.join(DATA, "public.x509.cer"),
+    )
+
+
+def test_proxy_sheds_requests_when_rate_limit_runs_low():
+    token = magictoken.create(KEYS, "fake_token", allowed=["GET /.*"])
+
+    async def test(client, app):
+        response = await client.get("/limited", headers={"Authorization": f"Bearer {token}"})
+        assert response.status == 200
+
+        response = await client.get("/limited", headers={"Authorization": f"Bearer {token}"})
+        assert response.status == 429
+        assert 0 < int(response.headers["Retry-After"]) <= 60
+
+        response = await client.get("/__metrics")
+        assert "magicproxy_rate_limits_shed 1" in await response.text()
+
+    run_with_proxy(test, rate_limit_reserve=1)
+
+
+def test_proxy_limits_magic_token_rate():
+    token = magictoken.create(KEYS, "fake_token", allowed=["GET /.*"])
+
+    async def test(client, app):
+        for _ in range(2):
+            response = await client.get("/", headers={"Authorization": f"Bearer {token}"})
+            assert response.status == 200
+        response = await client.get("/", headers={"Authorization": f"Bearer {token}"})
+        assert response.status == 429
+        assert 0 < int(response.headers["Retry-After"]) <= 10
+
+    run_with_proxy(test, token_rate_limit=0.1, token_rate_burst=2)
+
+
+def test_proxy_lazy_plugin_import_failure(tmp_path):
+    plugin_path = tmp_path / "broken.py"
+    plugin_path.write_text("raise ImportError('missing dependency')\n")
+    token = magictoken.create(KEYS, "fake_token", scopes=["broken"])
+
+    async def test(client, app):
+        for _ in range(2):
+            response = await client.get("/", headers={"Authorization": f"Bearer {token}"})
+            assert response.status == 503
+
+    run_with_proxy(test, scopes={"broken": LazyPlugin(plugin_path)})
+
+
+def test_metrics_without_config(monkeypatch, tmp_path):
+    monkeypatch.delenv("CONFIG_FILE", raising=False)
+    monkeypatch.setenv("PRIVATE_KEY_LOCATION", str(tmp_path / "missing.pem"))
+
+    async def test():
+        # degraded mode, the keys can't be loaded
+        app = await async_proxy.build_app()
+        assert app["CONFIG_HOLDER"].config is None
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get("/__metrics")
+            assert response.status == 503
+
+    asyncio.run(test())
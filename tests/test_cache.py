@@ -0,0 +1,109 @@
+import time
+
+from magicproxy.cache import LRUCache, ResponseCache, TokenCache
+from magicproxy.types import DecodeResult
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "maxsize": 2, "weight": 0, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    cache = LRUCache(maxsize=10, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=5)
+    cache.set("c", 3, ttl=60)
+
+    now[0] += 6
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    now[0] += 5
+    assert cache.get("a") is None
+    # capped by the cache ttl
+    assert cache.get("c") is None
+
+
+def test_token_cache_does_not_outlive_exp():
+    cache = TokenCache(maxsize=10, ttl=300)
+    cache.set_token("expired", DecodeResult("api-token", ["a"], None, expires_at=int(time.time()) - 1))
+    cache.set_token("valid", DecodeResult("api-token", ["a"], None, expires_at=int(time.time()) + 3600))
+
+    assert cache.get_token("expired") is None
+    assert cache.get_token("valid").token == "api-token"
+
+
+def test_token_cache_keys_are_hashed():
+    cache = TokenCache(maxsize=10)
+    cache.set_token("magic-token", DecodeResult("api-token", None, None))
+
+    assert "magic-token" not in cache._data
+    assert TokenCache.fingerprint("magic-token") in cache._data
+
+
+def test_response_cache_key():
+    cache = ResponseCache(maxsize=10, maxweight=1000, max_entry_size=100)
+
+    key = cache.key("GET", "/repos", "page=1", {"Accept": "application/json"}, "api-token")
+    assert key == cache.key("GET", "/repos", "page=1", {"Accept": "application/json"}, "api-token")
+    assert key != cache.key("GET", "/repos", "page=1", {"Accept": "application/json"}, "other-token")
+    assert key != cache.key("GET", "/repos", "page=2", {"Accept": "application/json"}, "api-token")
+    assert key != cache.key("GET", "/repos", "page=1", {"Accept": "text/html"}, "api-token")
+    assert "api-token" not in key
+
+    assert cache.key("POST", "/repos", "", {}, "api-token") is None
+    assert cache.key("GET", "/repos", "", {"If-None-Match": '"etag"'}, "api-token") is None
+
+
+def test_response_cache_store_and_revalidate():
+    cache = ResponseCache(maxsize=10, maxweight=1000, max_entry_size=100)
+    key = cache.key("GET", "/repos", "", {}, "api-token")
+
+    cache.store(key, b"no validator", 200, {"Content-Type": "application/json"})
+    assert cache.get(key) is None
+    cache.store(key, b"error", 404, {"ETag": '"a"'})
+    assert cache.get(key) is None
+    cache.store(key, b"x" * 101, 200, {"ETag": '"a"'})
+    assert cache.get(key) is None
+    cache.store(key, b"varies", 200, {"ETag": '"a"', "Vary": "Cookie"})
+    assert cache.get(key) is None
+
+    cache.store(
+        key, b"content", 200, {"ETag": '"a"', "Content-Type": "application/json", "X-RateLimit-Remaining": "10"}
+    )
+    cached = cache.get(key)
+    assert cached.content == b"content"
+    assert cache.conditional_headers(cached) == {"If-None-Match": '"a"'}
+
+    revalidated = cache.revalidated(key, cached, {"etag": '"a"', "x-ratelimit-remaining": "9", "Content-Length": "0"})
+    assert revalidated.content == b"content"
+    assert revalidated.headers == {"Content-Type": "application/json", "etag": '"a"', "x-ratelimit-remaining": "9"}
+    assert cache.get(key) is revalidated
+
+
+def test_response_cache_bounded_in_bytes():
+    cache = ResponseCache(maxsize=10, maxweight=10, max_entry_size=10)
+    for i in range(3):
+        cache.store(("key", i), b"12345", 200, {"ETag": str(i)})
+
+    assert cache.get(("key", 0)) is None
+    assert cache.weight == 10
+
+
+def test_response_cache_tee():
+    cache = ResponseCache(maxsize=10, maxweight=1000, max_entry_size=100)
+    chunks = iter([b"con", b"tent"])
+
+    assert b"".join(cache.tee("key", chunks, 200, {"ETag": '"a"'})) == b"content"
+    assert cache.get("key").content == b"content"
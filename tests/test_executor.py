@@ -0,0 +1,158 @@
+import asyncio
+import os
+
+import pytest
+
+import magicproxy.keys
+from magicproxy import magictoken
+from magicproxy.config import Config
+from magicproxy.crypto import generate_keys
+from magicproxy.executor import EXECUTOR_KINDS, BatchPool, CryptoExecutor
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+PRIVATE_KEY_LOCATION = os.path.join(DATA, "private.pem")
+PUBLIC_CERTIFICATE_LOCATION = os.path.join(DATA, "public.x509.cer")
+KEYS = magicproxy.keys.Keys.from_files(PRIVATE_KEY_LOCATION, PUBLIC_CERTIFICATE_LOCATION)
+
+
+def make_config(**kwargs):
+    return Config(
+        private_key_location=PRIVATE_KEY_LOCATION,
+        public_certificate_location=PUBLIC_CERTIFICATE_LOCATION,
+        keys=KEYS,
+        crypto_workers=2,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("kind", EXECUTOR_KINDS)
+def test_create_and_decode(kind):
+    executor = CryptoExecutor(make_config(crypto_executor=kind))
+
+    async def test():
+        tokens = await asyncio.gather(*(executor.create(f"token {i}", allowed=["GET /.*"]) for i in range(4)))
+        decoded = await asyncio.gather(*(executor.decode(token) for token in tokens))
+        assert [d.token for d in decoded] == [f"token {i}" for i in range(4)]
+        assert executor.stats()["queue_depth"] == 0
+
+    try:
+        asyncio.run(test())
+    finally:
+        executor.shutdown()
+
+
+def test_queue_depth():
+    executor = CryptoExecutor(make_config(crypto_executor="thread"))
+
+    async def test():
+        token = await executor.create("token", allowed=["GET /.*"])
+        decodes = [asyncio.ensure_future(executor.decode(token)) for _ in range(8)]
+        await asyncio.sleep(0)
+        assert executor.queue_depth == 8
+        await asyncio.gather(*decodes)
+        assert executor.queue_depth == 0
+
+    try:
+        asyncio.run(test())
+    finally:
+        executor.shutdown()
+
+
+def test_decode_uses_token_cache():
+    executor = CryptoExecutor(make_config(crypto_executor="process", token_cache_size=10))
+
+    async def test():
+        token = await executor.create("token", allowed=["GET /.*"])
+        first = await executor.decode(token)
+        assert await executor.decode(token) is first
+
+    try:
+        asyncio.run(test())
+    finally:
+        executor.shutdown()
+    assert executor.config.token_cache.stats()["hits"] == 1
+
+
+def test_invalid_kind():
+    with pytest.raises(ValueError):
+        CryptoExecutor(make_config(crypto_executor="fibers"))
+
+
+def test_process_pool_uses_config_keys(tmp_path):
+    # a config built in code, its key files don't exist
+    config = Config(
+        private_key_location=str(tmp_path / "private.pem"),
+        public_certificate_location=str(tmp_path / "public.x509.cer"),
+        keys=KEYS,
+        crypto_executor="process",
+        crypto_workers=1,
+    )
+    executor = CryptoExecutor(config)
+
+    async def test():
+        token = await executor.create("token", allowed=["GET /.*"])
+        assert (await executor.decode(token)).token == "token"
+        assert (await executor.create_batch([{"token": "batch token", "allowed": ["GET /.*"]}]))[0]
+
+    try:
+        asyncio.run(test())
+    finally:
+        executor.shutdown()
+
+
+def test_update_restarts_pools_on_new_keys(tmp_path):
+    key_files = dict(
+        private_key_location=str(tmp_path / "private.pem"),
+        public_key_location=str(tmp_path / "public.pem"),
+        public_certificate_location=str(tmp_path / "public.x509.cer"),
+    )
+    generate_keys(Config(**key_files))
+    new_keys = magicproxy.keys.Keys.from_files(
+        key_files["private_key_location"], key_files["public_certificate_location"]
+    )
+    executor = CryptoExecutor(make_config(crypto_executor="process"))
+    pool = executor._executor
+
+    # same keys and settings, same pool
+    executor.update(make_config(crypto_executor="process"))
+    assert executor._executor is pool
+
+    executor.update(Config(keys=new_keys, crypto_executor="process", crypto_workers=2))
+    assert executor._executor is not pool
+
+    async def test():
+        token = await executor.create("token", allowed=["GET /.*"])
+        assert magictoken.decode(new_keys, token).token == "token"
+        with pytest.raises(ValueError):
+            await executor.decode(magictoken.create(KEYS, "token", allowed=["GET /.*"]))
+
+    try:
+        asyncio.run(test())
+    finally:
+        executor.shutdown()
+
+
+def test_batch_pool_uses_the_keys_of_each_batch(tmp_path):
+    key_files = dict(
+        private_key_location=str(tmp_path / "private.pem"),
+        public_key_location=str(tmp_path / "public.pem"),
+        public_certificate_location=str(tmp_path / "public.x509.cer"),
+    )
+    generate_keys(Config(**key_files))
+    new_keys = magicproxy.keys.Keys.from_files(
+        key_files["private_key_location"], key_files["public_certificate_location"]
+    )
+    specs = [{"token": "batch token", "allowed": ["GET /.*"]}]
+    batch_pool = BatchPool()
+    try:
+        (token,) = batch_pool.create_batch(make_config(), specs)
+        assert magictoken.decode(KEYS, token).token == "batch token"
+        pool = batch_pool._pool
+        batch_pool.create_batch(make_config(), specs)
+        assert batch_pool._pool is pool
+
+        (token,) = batch_pool.create_batch(Config(keys=new_keys, crypto_workers=2), specs)
+        assert batch_pool._pool is not pool
+        assert magictoken.decode(new_keys, token).token == "batch token"
+    finally:
+        batch_pool.shutdown()
@@ -0,0 +1,29 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = ("flask", "werkzeug", "requests", "aiohttp", "OpenSSL", "google.auth", "cryptography")
+
+
+def imported_modules(module: str):
+    """The heavy modules that importing module pulls in, in a fresh interpreter"""
+    code = f"import json, sys, {module}; print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))"
+    output = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output)
+
+
+@pytest.mark.parametrize(
+    "module, expected",
+    [
+        ("magicproxy.config", []),
+        ("magicproxy.crypto", []),
+        ("magicproxy.__main__", []),
+        ("magicproxy.mint", ["google.auth", "cryptography"]),
+        ("magicproxy.proxy", ["flask", "werkzeug", "requests", "google.auth", "cryptography"]),
+        ("magicproxy.async_proxy", ["aiohttp", "google.auth", "cryptography"]),
+    ],
+)
+def test_imports_only_what_is_used(module, expected):
+    assert imported_modules(module) == expected
@@ -0,0 +1,121 @@
+import dataclasses
+import os
+import time
+
+import pytest
+
+import magicproxy.keys
+from magicproxy import limiter, magictoken, scopes
+from magicproxy.config import Config
+from magicproxy.limiter import MemoryLimiter, RedisLimiter, create_limiter
+from magicproxy.types import Permission, ScopeSettings
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+KEYS = magicproxy.keys.Keys.from_files(
+    private_key_file=os.path.join(DATA, "private.pem"),
+    certificate_file=os.path.join(DATA, "public.x509.cer"),
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+def test_key_by_issued_at_and_signature():
+    first = magictoken.create(KEYS, "api token", allowed=["GET /user"], version=2)
+    second = magictoken.create(KEYS, "api token", allowed=["GET /repos/.*"], version=2)
+    issued_at = magictoken.decode(KEYS, first).issued_at
+
+    assert abs(issued_at - time.time()) < 60
+    assert limiter.key(issued_at, first).startswith(f"{issued_at}:")
+    assert limiter.key(issued_at, first) == limiter.key(issued_at, first)
+    assert limiter.key(issued_at, first) != limiter.key(issued_at, second)
+
+
+def test_memory_limiter_burst_then_rate(clock):
+    memory_limiter = MemoryLimiter()
+
+    assert memory_limiter.check("token", rate=2, burst=3) is None
+    assert memory_limiter.check("token", rate=2, burst=3) is None
+    assert memory_limiter.check("token", rate=2, burst=3) is None
+    assert memory_limiter.check("token", rate=2, burst=3) == pytest.approx(0.5)
+    assert memory_limiter.check("other token", rate=2, burst=3) is None
+
+    clock.now += 0.5
+    assert memory_limiter.check("token", rate=2, burst=3) is None
+    assert memory_limiter.check("token", rate=2, burst=3) == pytest.approx(0.5)
+    assert memory_limiter.stats() == {"buckets": 2, "limited": 2}
+
+
+def test_memory_limiter_evicts_idle_buckets(clock):
+    memory_limiter = MemoryLimiter()
+    memory_limiter.check("token", rate=1, burst=2)
+    assert memory_limiter.stats()["buckets"] == 1
+
+    # full again
+    clock.now += 1
+    assert memory_limiter.stats()["buckets"] == 1
+    assert memory_limiter.check("token", rate=1, burst=2) is None
+    clock.now += 1
+    memory_limiter._buckets.get("token")
+    assert memory_limiter.stats()["buckets"] == 0
+
+
+def test_memory_limiter_bounded():
+    memory_limiter = MemoryLimiter(maxsize=2)
+    for token in ("first", "second", "third"):
+        memory_limiter.check(token, rate=1, burst=1)
+    assert memory_limiter.stats()["buckets"] == 2
+
+
+def test_scope_rate_limit():
+    config = Config(
+        scopes={
+            "bot": [Permission("GET", "/.*")],
+            "app": [Permission("GET", "/.*")],
+            "any": [Permission("GET", "/.*")],
+        },
+        scope_settings={"bot": ScopeSettings(rate_limit=0.5), "app": ScopeSettings(rate_limit=10, burst=50)},
+    )
+    assert scopes.rate_limit(config, ["bot"]) == (0.5, 1)
+    assert scopes.rate_limit(config, ["bot", "app"]) == (10, 50)
+    assert scopes.rate_limit(config, ["any"]) is None
+    # a scope without a limit lifts it
+    assert scopes.rate_limit(config, ["bot", "any"]) is None
+    assert scopes.rate_limit(config, None) is None
+
+    config = dataclasses.replace(config, token_rate_limit=5)
+    assert scopes.rate_limit(config, None) == (5, 5)
+    assert scopes.rate_limit(config, ["bot", "any"]) == (5, 5)
+    assert scopes.rate_limit(config, ["bot", "app"]) == (10, 50)
+
+
+def test_create_limiter():
+    assert isinstance(create_limiter("memory"), MemoryLimiter)
+    with pytest.raises(ValueError):
+        create_limiter("memcached")
+    with pytest.raises(ValueError):
+        create_limiter("redis")
+
+
+@pytest.mark.skipif("REDIS_URL" not in os.environ, reason="needs a redis server at REDIS_URL")
+def test_redis_limiter():
+    pytest.importorskip("redis")
+    redis_limiter = RedisLimiter(os.environ["REDIS_URL"])
+    bucket_key = f"test:{time.time()}"
+
+    assert redis_limiter.check(bucket_key, rate=1, burst=2) is None
+    assert redis_limiter.check(bucket_key, rate=1, burst=2) is None
+    assert 0 < redis_limiter.check(bucket_key, rate=1, burst=2) <= 1
+    assert redis_limiter.stats() == {"limited": 1}
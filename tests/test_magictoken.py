@@ -12,10 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import json
 import os
 
+import pytest
+
 import magicproxy.keys
 from magicproxy import magictoken
+from magicproxy.cache import TokenCache
 
 HERE = os.path.dirname(__file__)
 DATA = os.path.join(HERE, "data")
@@ -57,3 +62,56 @@ def test_get_from_env_and_decode():
 
     assert decoded.token == token
     assert scopes == scopes
+
+
+def test_decode_cached(monkeypatch):
+    api_token = "this is a token"
+    cache = TokenCache(maxsize=10)
+
+    result = magictoken.create(KEYS, api_token, ["a"])
+    decoded = magictoken.decode(KEYS, result, cache)
+    assert cache.stats()["misses"] == 1
+
+    def no_decrypt(*args, **kwargs):
+        raise AssertionError("should have been served from the cache")
+
+    monkeypatch.setattr(magictoken, "_decrypt", no_decrypt)
+
+    assert magictoken.decode(KEYS, result, cache) is decoded
+    assert cache.stats()["hits"] == 1
+    assert decoded.expires_at is not None
+
+
+def test_create_and_decode_v2():
+    api_token = "this is a token"
+    allowed = ["GET /this"]
+
+    result = magictoken.create(KEYS, api_token, allowed=allowed, version=2)
+    assert api_token not in result
+
+    decoded = magictoken.decode(KEYS, result)
+    assert decoded.token == api_token
+    assert decoded.allowed == allowed
+    assert decoded.expires_at is not None
+
+    # v1 tokens are still accepted
+    assert magictoken.decode(KEYS, magictoken.create(KEYS, api_token, allowed=allowed)).token == api_token
+
+
+def test_decode_v2_tampered():
+    result = magictoken.create(KEYS, "this is a token", allowed=["GET /this"], version=2)
+    header, payload, signature = result.split(".")
+    claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    claims["allowed"] = ["DELETE /.*"]
+    tampered_payload = base64.urlsafe_b64encode(json.dumps(claims).encode("utf-8")).decode("utf-8").rstrip("=")
+
+    with pytest.raises(ValueError):
+        magictoken.decode(KEYS, ".".join((header, tampered_payload, signature)))
+
+
+def test_decode_v2_expired(monkeypatch):
+    monkeypatch.setattr(magictoken, "VALIDITY_PERIOD", -1)
+    result = magictoken.create(KEYS, "this is a token", allowed=["GET /this"], version=2)
+
+    with pytest.raises(ValueError):
+        magictoken.decode(KEYS, result)
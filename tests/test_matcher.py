@@ -0,0 +1,120 @@
+import itertools
+import re
+
+import pytest
+
+from magicproxy.config import Config
+from magicproxy.matcher import PermissionMatcher, compile_paths, literal_segment
+from magicproxy.scopes import allowed_matcher
+from magicproxy.types import Permission
+
+PERMISSIONS = [
+    Permission(method="GET", path="/this"),
+    Permission(method="GET", path="/subpath/*"),
+    Permission(method="POST", path="/repos/+?/+?/issues/+?/labels"),
+    Permission(method="*", path="/anything/.+"),
+    Permission(method="PUT", path=r"/(?P<owner>\w+)/(?P=owner)$"),
+    Permission(method="PUT", path=r"/(?P<owner>\w+)/mirror"),
+    Permission(method="DELETE", path=r"/(\w+)/\1$"),
+    Permission(method="PATCH", path="(?i)/Flags"),
+    Permission(method="GET", path="/repos/.+/pulls"),
+    Permission(method="GET", path="/Users/[a-z]+$"),
+    Permission(method="GET", path="/orgs/*members"),
+    Permission(method="*", path="/gists/|/events/"),
+    Permission(method="POST", path="/repos/[^/]+/[^/]+/issues$"),
+]
+METHODS = ["GET", "POST", "PUT", "DELETE", "PATCH"]
+PATHS = [
+    "/this",
+    "this",
+    "/THIS",
+    "/thisandmore",
+    "/that",
+    "/subpath/works",
+    "/repos/a/b/issues/1/labels",
+    "/anything/",
+    "/anything/goes",
+    "/me/me",
+    "/me/you",
+    "/me/mirror",
+    "/flags",
+    "/repos/a/b/pulls",
+    "/REPOS/a/b/pulls",
+    "/repo\u017f/a/b/pulls",
+    "/reposx/a/pulls",
+    "/repos",
+    "/users/someone",
+    "/users/someone/repos",
+    "/\u212aey",
+    "/orgsmembers",
+    "/orgs//members",
+    "/gists/1",
+    "/events/",
+    "/repos/a/b/issues",
+    "",
+    "/",
+]
+
+
+def matches_one_by_one(permission: Permission, method: str, path: str) -> bool:
+    """The matching of a single permission, a regex at a time"""
+    if not path.startswith("/"):
+        path = f"/{path}"
+    return permission.method in (method, "*") and bool(re.match(permission.path, path, re.I))
+
+
+def test_matches_like_one_by_one():
+    matcher = PermissionMatcher(PERMISSIONS)
+    for method, path in itertools.product(METHODS, PATHS):
+        expected = any(matches_one_by_one(permission, method, path) for permission in PERMISSIONS)
+        assert matcher.match(method, path) == expected, (method, path)
+
+
+def test_compile_paths_combines():
+    assert len(compile_paths(["/a", "/b", "/c"])) == 1
+    # back references are kept apart
+    assert len(compile_paths(["/a", r"/(\w+)/\1"])) == 2
+    # and so are inline flags
+    assert len(compile_paths(["/a", "(?x)/b"])) == 2
+
+
+def test_inline_flags_apply_to_their_regex_only():
+    matcher = PermissionMatcher([Permission("GET", "/user name"), Permission("GET", "(?x)/other")])
+    assert matcher.match("GET", "/user name")
+    assert not matcher.match("GET", "/username")
+    assert matcher.match("GET", "/other")
+
+
+def test_invalid_path_regex():
+    with pytest.raises(ValueError):
+        PermissionMatcher([Permission(method="GET", path="/unbalanced(")])
+
+
+def test_invalid_path_regex_does_not_escape_the_alternation():
+    with pytest.raises(ValueError):
+        compile_paths(["/repos", "/user)|(?:.*"])
+    with pytest.raises(ValueError):
+        Config(
+            scopes={"broken": [Permission(method="GET", path="/this"), Permission(method="GET", path="/user)|(?:.*")]}
+        )
+    # the same rule in the allowed list of a token is rejected too, and never matches an unrelated path
+    with pytest.raises(ValueError):
+        allowed_matcher(["GET /this", "GET /user)|(?:.*"])
+
+
+def test_literal_segment():
+    assert literal_segment("/repos/.+/pulls") == "repos"
+    assert literal_segment("/Users/[a-z]+$") == "users"
+    assert literal_segment("/repos") is None
+    assert literal_segment("/repos?/") is None
+    assert literal_segment("/repos/*") is None
+    assert literal_segment("/gists/|/events/") is None
+    assert literal_segment("/repos/(?i:x)") is None
+    assert literal_segment(".*") is None
+
+
+def test_only_candidate_patterns_are_tried():
+    matcher = PermissionMatcher([Permission(method="GET", path=f"/repos/org/repo{n}/.*") for n in range(100)])
+    assert len(list(matcher._candidates("GET", "users"))) == 0
+    assert len(list(matcher._candidates("GET", "Repos"))) == 1
+    assert matcher.match("GET", "/repos/org/repo42/pulls")
@@ -0,0 +1,47 @@
+from magicproxy.metrics import Counter, Histogram, Metrics
+
+
+def test_counter():
+    counter = Counter("requests_total", "Requests", ("status",))
+    counter.inc(status=200)
+    counter.inc(2, status=200)
+    counter.inc(status=404)
+
+    assert counter.value(status=200) == 3
+    assert list(counter.render()) == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{status="200"} 3',
+        'requests_total{status="404"} 1',
+    ]
+
+
+def test_histogram():
+    histogram = Histogram("duration_seconds", "Duration", ("stage",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage="decode")
+    histogram.observe(0.1, stage="decode")
+    histogram.observe(5, stage="decode")
+
+    assert histogram.count(stage="decode") == 3
+    assert list(histogram.render()) == [
+        "# HELP duration_seconds Duration",
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{stage="decode",le="0.1"} 2',
+        'duration_seconds_bucket{stage="decode",le="1.0"} 2',
+        'duration_seconds_bucket{stage="decode",le="+Inf"} 3',
+        'duration_seconds_sum{stage="decode"} 5.15',
+        'duration_seconds_count{stage="decode"} 3',
+    ]
+
+
+def test_metrics_render():
+    metrics = Metrics()
+    metrics.count_request(200, ["repo", "user"])
+    with metrics.time("decode"):
+        pass
+
+    rendered = metrics.render({"token_cache": {"size": 2, "kind": "lru"}, "response_cache": None})
+    assert 'magicproxy_requests_total{status="200",scope="repo,user"} 1' in rendered
+    assert 'magicproxy_stage_duration_seconds_count{stage="decode"} 1' in rendered
+    assert "magicproxy_token_cache_size 2" in rendered
+    assert "kind" not in rendered
@@ -0,0 +1,53 @@
+import json
+import os
+import subprocess
+import sys
+
+from magicproxy import magictoken
+from magicproxy.config import Config, parse_permission
+from magicproxy.keys import Keys
+from magicproxy.mint import mint
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+PRIVATE_KEY = os.path.join(DATA, "private.pem")
+CERTIFICATE = os.path.join(DATA, "public.x509.cer")
+KEYS = Keys.from_files(PRIVATE_KEY, CERTIFICATE)
+
+SPECS = [
+    json.dumps({"token": "first_token", "scopes": ["user"]}),
+    "",
+    "not json",
+    json.dumps({"token": "second_token", "allowed": ["GET /repos/.*"]}),
+]
+
+
+def test_mint():
+    config = Config(
+        keys=KEYS,
+        scopes={"user": [parse_permission("GET /user")]},
+        token_version=2,
+    )
+
+    first, not_json, second = mint(config, SPECS, processes=2)
+
+    assert magictoken.decode(KEYS, first["token"]).scopes == ["user"]
+    assert not_json["error"].startswith("invalid json")
+    decoded = magictoken.decode(KEYS, second["token"])
+    assert (decoded.token, decoded.allowed) == ("second_token", ["GET /repos/.*"])
+
+
+def test_mint_command():
+    env = dict(os.environ, PRIVATE_KEY_LOCATION=PRIVATE_KEY, PUBLIC_CERTIFICATE_LOCATION=CERTIFICATE)
+    env.pop("CONFIG_FILE", None)
+    process = subprocess.run(
+        [sys.executable, "-m", "magicproxy", "mint", "--processes", "1"],
+        input="\n".join(SPECS[1:]) + "\n",
+        env=env,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    not_json, second = [json.loads(line) for line in process.stdout.splitlines()]
+    assert "error" in not_json
+    assert magictoken.decode(KEYS, second["token"]).token == "second_token"
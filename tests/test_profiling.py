@@ -0,0 +1,35 @@
+import pstats
+
+from magicproxy.profiling import Profiler
+
+
+def work():
+    return sum(range(1000))
+
+
+def test_profiler_writes_after_requests(tmp_path):
+    output = str(tmp_path / "requests.prof")
+    profiler = Profiler(2, output)
+
+    with profiler.request():
+        work()
+    assert not profiler.done
+    assert not (tmp_path / "requests.prof").exists()
+
+    with profiler.request():
+        work()
+    assert profiler.done
+    stats = pstats.Stats(output)
+    assert any(function == "work" for _, _, function in stats.stats)
+
+
+def test_shared_profiler_waits_for_running_requests(tmp_path):
+    output = tmp_path / "requests.prof"
+    profiler = Profiler(1, str(output), shared=True)
+
+    with profiler.request():
+        with profiler.request():
+            work()
+        assert profiler.done
+        assert not output.exists()
+    assert output.exists()
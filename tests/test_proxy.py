@@ -0,0 +1,276 @@
+import contextlib
+import os
+import threading
+import time
+
+import flask
+import pytest
+import requests
+from werkzeug.serving import make_server
+
+import magicproxy.keys
+from magicproxy import magictoken, proxy
+from magicproxy.config import Config
+from magicproxy.plugins import LazyPlugin
+from magicproxy.types import Permission, ScopeSettings
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+KEYS = magicproxy.keys.Keys.from_files(
+    private_key_file=os.path.join(DATA, "private.pem"),
+    certificate_file=os.path.join(DATA, "public.x509.cer"),
+)
+LARGE_CONTENT = b"x" * (1024 * 1024)
+ETAG_REQUESTS = []
+
+
+@pytest.fixture(scope="module")
+def api_root():
+    app = flask.Flask("api")
+
+    @app.route("/", methods=["GET"])
+    def route():
+        if flask.request.headers.get("Authorization") == "Bearer fake_token":
+            return "authorized by API", 200
+        return "not authorized by API", 401
+
+    @app.route("/large", methods=["GET"])
+    def large():
+        return LARGE_CONTENT
+
+    @app.route("/etag", methods=["GET"])
+    def etag():
+        ETAG_REQUESTS.append(flask.request.headers.get("If-None-Match"))
+        if flask.request.headers.get("If-None-Match") == '"v1"':
+            return "", 304, {"ETag": '"v1"'}
+        return "etag content", 200, {"ETag": '"v1"'}
+
+    @app.route("/limited", methods=["GET"])
+    def limited():
+        reset = str(int(time.time()) + 60)
+        return "almost exhausted", 200, {"X-RateLimit-Remaining": "1", "X-RateLimit-Reset": reset}
+
+    @app.route("/exhausted", methods=["GET"])
+    def exhausted():
+        reset = str(int(time.time()) + 1)
+        return "exhausted", 200, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": reset}
+
+    @app.route("/upload", methods=["PUT"])
+    def upload():
+        return {
+            "content_length": flask.request.headers.get("Content-Length"),
+            "transfer_encoding": flask.request.headers.get("Transfer-Encoding"),
+            "size": len(flask.request.get_data()),
+        }
+
+    with serve(app) as root:
+        yield root
+
+
+@contextlib.contextmanager
+def serve(app):
+    server = make_server("localhost", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://localhost:{server.port}"
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def make_client(api_root, **config_kwargs):
+    config = Config(api_root=api_root, keys=KEYS, **config_kwargs)
+    return proxy.build_app(config).test_client()
+
+
+def auth_headers(token="fake_token", allowed=("GET /.*",)):
+    return {"Authorization": f"Bearer {magictoken.create(KEYS, token, allowed=list(allowed))}"}
+
+
+def test_proxy_reuses_pooled_session(api_root):
+    client = make_client(api_root, upstream_pool_maxsize=4)
+
+    response = client.get("/", headers=auth_headers())
+    assert response.status_code == 200
+    assert response.data == b"authorized by API"
+
+    session = proxy._get_session()
+    assert session.get_adapter(api_root)._pool_maxsize == 4
+
+    response = client.get("/", headers=auth_headers("wrong_token"))
+    assert response.status_code == 401
+    assert proxy._get_session() is session
+
+
+def test_proxy_streams_responses(api_root):
+    client = make_client(api_root, stream_responses=True)
+
+    response = client.get("/large", headers=auth_headers())
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.data == LARGE_CONTENT
+
+
+@pytest.mark.parametrize("stream_responses", [False, True])
+def test_proxy_revalidates_cached_responses(api_root, stream_responses):
+    client = make_client(api_root, response_cache_size=10, stream_responses=stream_responses)
+    ETAG_REQUESTS.clear()
+
+    for _ in range(3):
+        response = client.get("/etag", headers=auth_headers())
+        assert response.status_code == 200
+        assert response.data == b"etag content"
+
+    assert ETAG_REQUESTS == [None, '"v1"', '"v1"']
+
+    # cached per API token
+    response = client.get("/etag", headers=auth_headers("other_token"))
+    assert response.data == b"etag content"
+    assert ETAG_REQUESTS[-1] is None
+
+
+def test_proxy_streams_sized_request_body(api_root):
+    client = make_client(api_root)
+
+    response = client.put("/upload", data=LARGE_CONTENT, headers=auth_headers(allowed=["PUT /upload"]))
+    assert response.status_code == 200
+    assert response.json == {
+        "content_length": str(len(LARGE_CONTENT)),
+        "transfer_encoding": None,
+        "size": len(LARGE_CONTENT),
+    }
+
+
+def test_proxy_streams_chunked_request_body(api_root):
+    app = proxy.build_app(Config(api_root=api_root, keys=KEYS))
+
+    def chunks():
+        for _ in range(4):
+            yield b"x" * 1000
+
+    with serve(app) as proxy_root:
+        response = requests.put(f"{proxy_root}/upload", data=chunks(), headers=auth_headers(allowed=["PUT /upload"]))
+    assert response.status_code == 200
+    assert response.json() == {"content_length": None, "transfer_encoding": "chunked", "size": 4000}
+
+
+def test_metrics(api_root):
+    client = make_client(api_root, token_cache_size=10)
+
+    assert client.get("/", headers=auth_headers()).status_code == 200
+    assert client.get("/", headers=auth_headers(allowed=["GET /other"])).status_code == 401
+
+    response = client.get("/__metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    metrics = response.data.decode("utf-8")
+    assert 'magicproxy_requests_total{status="200",scope="none"} 1' in metrics
+    assert 'magicproxy_requests_total{status="401",scope="none"} 1' in metrics
+    for stage in ("decode", "validate", "upstream_ttfb", "upstream"):
+        assert f'magicproxy_stage_duration_seconds_count{{stage="{stage}"}}' in metrics
+    assert "magicproxy_upstream_pool_connections 1" in metrics
+    assert "magicproxy_token_cache_size 2" in metrics
+
+
+def test_metrics_disabled(api_root):
+    client = make_client(api_root, metrics_enabled=False)
+
+    assert client.get("/__metrics").status_code == 404
+
+
+def test_profile_requests(api_root, tmp_path):
+    output = tmp_path / "proxy.prof"
+    client = make_client(api_root, profile_requests=2, profile_output=str(output))
+
+    client.get("/", headers=auth_headers())
+    assert not output.exists()
+    client.get("/", headers=auth_headers())
+    assert output.exists()
+
+
+def test_create_magic_tokens_batch(api_root):
+    client = make_client(
+        api_root,
+        private_key_location=os.path.join(DATA, "private.pem"),
+        public_certificate_location=os.path.join(DATA, "public.x509.cer"),
+    )
+
+    response = client.post(
+        "/__magictoken",
+        json=[
+            {"token": "first_token", "allowed": ["GET /user"]},
+            {"allowed": ["GET /user"]},
+            {"token": "second_token", "allowed": ["GET /repos/.*"]},
+            "not a spec",
+            {"token": 123, "allowed": ["GET /user"]},
+            {"token": "third_token", "scopes": None},
+        ],
+    )
+    assert response.status_code == 200
+    first, missing_token, second, not_a_spec, not_a_string, null_scopes = response.json
+    assert magictoken.decode(KEYS, first["token"]).token == "first_token"
+    assert magictoken.decode(KEYS, second["token"]).allowed == ["GET /repos/.*"]
+    assert "token" in missing_token["error"]
+    assert not_a_spec == {"error": "each item of a batch must be a json object"}
+    assert not_a_string == {"error": "token must be a string"}
+    assert null_scopes == {"error": "scopes must be a list of strings"}
+
+
+def test_create_magic_tokens_batch_too_large(api_root):
+    client = make_client(api_root, magictoken_batch_max_size=1)
+
+    response = client.post("/__magictoken", json=[{"token": "token", "allowed": ["GET /user"]}] * 2)
+    assert response.status_code == 400
+
+
+def test_proxy_sheds_requests_when_rate_limit_runs_low(api_root):
+    client = make_client(api_root, rate_limit_reserve=1)
+
+    response = client.get("/limited", headers=auth_headers())
+    assert response.status_code == 200
+
+    response = client.get("/limited", headers=auth_headers())
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 60
+
+    # another API token has its own quota
+    assert client.get("/limited", headers=auth_headers("other_token")).status_code == 200
+
+
+def test_proxy_queues_requests_until_rate_limit_resets(api_root):
+    client = make_client(api_root, rate_limit_reserve=0, rate_limit_max_wait=5)
+
+    assert client.get("/exhausted", headers=auth_headers()).status_code == 200
+    # waits for the reset, at most a second away
+    start = time.monotonic()
+    assert client.get("/exhausted", headers=auth_headers()).status_code == 200
+    assert time.monotonic() - start < 5
+
+
+def test_proxy_limits_magic_token_rate(api_root):
+    client = make_client(
+        api_root,
+        scopes={"bot": [Permission("GET", "/.*")]},
+        scope_settings={"bot": ScopeSettings(rate_limit=0.1, burst=2)},
+    )
+    token = magictoken.create(KEYS, "fake_token", scopes=["bot"])
+
+    for _ in range(2):
+        assert client.get("/", headers={"Authorization": f"Bearer {token}"}).status_code == 200
+    response = client.get("/", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 10
+
+    # another magic token, even for the same API token, has its own bucket
+    other_token = magictoken.create(KEYS, "fake_token", scopes=["bot"], version=2)
+    assert client.get("/", headers={"Authorization": f"Bearer {other_token}"}).status_code == 200
+
+
+def test_proxy_lazy_plugin_import_failure(api_root, tmp_path):
+    plugin_path = tmp_path / "broken.py"
+    plugin_path.write_text("raise ImportError('missing dependency')\n")
+    client = make_client(api_root, scopes={"broken": LazyPlugin(plugin_path)})
+    token = magictoken.create(KEYS, "fake_token", scopes=["broken"])
+
+    for _ in range(2):
+        assert client.get("/", headers={"Authorization": f"Bearer {token}"}).status_code == 503
@@ -0,0 +1,150 @@
+import json
+import time
+
+import pytest
+
+from magicproxy import scopes
+from magicproxy.config import Config, from_file
+from magicproxy.ratelimit import PROBE_TIMEOUT, RateLimits, resource
+from magicproxy.types import Permission, ScopeSettings
+
+
+def rate_limit_headers(remaining, reset_in=60, resource_name=None):
+    headers = {"X-RateLimit-Remaining": str(remaining), "X-RateLimit-Reset": str(int(time.time() + reset_in))}
+    if resource_name is not None:
+        headers["X-RateLimit-Resource"] = resource_name
+    return headers
+
+
+def test_resource():
+    assert resource("repos/org/repo/pulls") == "core"
+    assert resource("/search/issues") == "search"
+    assert resource("search/code") == "code_search"
+    assert resource("graphql") == "graphql"
+
+
+def test_unknown_quota_lets_requests_through():
+    rate_limits = RateLimits(reserve=10)
+    assert rate_limits.check("token", "user") is None
+    rate_limits.update("token", "user", {"Content-Type": "application/json"})
+    assert rate_limits.check("token", "user") is None
+
+
+def test_sheds_requests_by_priority():
+    rate_limits = RateLimits(reserve=10)
+    rate_limits.update("token", "user", rate_limit_headers(10))
+
+    retry_after = rate_limits.check("token", "user", priority=0)
+    assert 58 < retry_after <= 60
+    # the reserve of priority 1 is 10 // 2
+    for _ in range(5):
+        assert rate_limits.check("token", "user", priority=1) is None
+    assert rate_limits.check("token", "user", priority=1) is not None
+    assert rate_limits.check("token", "user", priority=9) is None
+    assert rate_limits.stats() == {"tokens": 1, "shed": 2}
+
+    # another token, or another resource, has its own quota
+    assert rate_limits.check("other token", "user") is None
+    assert rate_limits.check("token", "search/issues") is None
+
+
+def test_exhausted_quota_sheds_every_priority():
+    rate_limits = RateLimits(reserve=0)
+    rate_limits.update("token", "user", rate_limit_headers(1))
+
+    assert rate_limits.check("token", "user", priority=5) is None
+    assert rate_limits.check("token", "user", priority=5) is not None
+
+
+def test_quota_resource_from_headers():
+    rate_limits = RateLimits(reserve=0)
+    rate_limits.update("token", "search/issues", rate_limit_headers(0, resource_name="search"))
+
+    assert rate_limits.check("token", "search/repositories") is not None
+    assert rate_limits.check("token", "user") is None
+
+
+def test_quota_forgotten_once_reset():
+    rate_limits = RateLimits(reserve=0)
+    rate_limits.update("token", "user", rate_limit_headers(0, reset_in=-1))
+
+    assert rate_limits.check("token", "user") is None
+    assert rate_limits.stats()["tokens"] == 0
+
+
+def test_one_request_probes_the_reset_quota(monkeypatch):
+    rate_limits = RateLimits(reserve=10)
+    now = time.time()
+    rate_limits.update("token", "user", {"X-RateLimit-Remaining": "5", "X-RateLimit-Reset": str(now + 1)})
+    monkeypatch.setattr(time, "time", lambda: now + 1.5)
+
+    # the first request after the reset goes, the others wait for its response
+    assert rate_limits.check("token", "user") is None
+    assert 0 < rate_limits.check("token", "user", priority=9) <= PROBE_TIMEOUT
+    rate_limits.update("token", "user", rate_limit_headers(5000))
+    assert rate_limits.check("token", "user") is None
+
+
+def test_quota_with_room_left_is_not_probed(monkeypatch):
+    rate_limits = RateLimits(reserve=10)
+    now = time.time()
+    rate_limits.update("token", "user", {"X-RateLimit-Remaining": "100", "X-RateLimit-Reset": str(now + 1)})
+    monkeypatch.setattr(time, "time", lambda: now + 1.5)
+
+    assert rate_limits.check("token", "user") is None
+    assert rate_limits.check("token", "user") is None
+
+
+def test_secondary_rate_limit():
+    rate_limits = RateLimits(reserve=0)
+    rate_limits.update("token", "user", {"Retry-After": "30", **rate_limit_headers(4000)})
+
+    assert 29 < rate_limits.check("token", "user", priority=9) <= 30
+
+
+def test_invalid_headers_are_ignored():
+    rate_limits = RateLimits(reserve=0)
+    rate_limits.update("token", "user", {"X-RateLimit-Remaining": "many", "X-RateLimit-Reset": "soon"})
+
+    assert rate_limits.check("token", "user") is None
+
+
+def test_scope_priority():
+    config = Config(
+        scopes={"low": [Permission("GET", "/.*")], "high": [Permission("GET", "/.*")]},
+        scope_settings={"high": ScopeSettings(priority=3)},
+    )
+    assert scopes.priority(config, ["low"]) == 0
+    assert scopes.priority(config, ["low", "high"]) == 3
+    assert scopes.priority(config, None) == 0
+
+
+def test_scope_settings_from_file(tmp_path):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(
+        json.dumps(
+            {
+                "scopes": {
+                    "read": ["GET /.*"],
+                    "deploy": {"permissions": ["POST /repos/.*/deployments"], "priority": 2},
+                    "a_plugin": {"priority": 1},
+                }
+            }
+        )
+    )
+
+    config = from_file(str(config_file))
+    assert config["scopes"] == {
+        "read": [Permission("GET", "/.*")],
+        "deploy": [Permission("POST", "/repos/.*/deployments")],
+    }
+    assert config["scope_settings"] == {"deploy": ScopeSettings(priority=2), "a_plugin": ScopeSettings(priority=1)}
+
+
+@pytest.mark.parametrize("settings", [{"permissions": [], "weight": 2}, {"priority": -1}, {"priority": "high"}])
+def test_invalid_scope_settings(tmp_path, settings):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"scopes": {"scope": settings}}))
+
+    with pytest.raises(ValueError):
+        from_file(str(config_file))
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import os
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import magicproxy.keys
+from magicproxy import async_proxy, magictoken, proxy
+from magicproxy.config import Config, load_config
+from magicproxy.reload import Reloader, carry_over
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+KEYS = magicproxy.keys.Keys.from_files(
+    private_key_file=os.path.join(DATA, "private.pem"),
+    certificate_file=os.path.join(DATA, "public.x509.cer"),
+)
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    path = tmp_path / "config.json"
+    monkeypatch.setenv("CONFIG_FILE", str(path))
+    for name in ("KEYS_LOCATION", "PRIVATE_KEY_LOCATION", "PUBLIC_CERTIFICATE_LOCATION"):
+        monkeypatch.delenv(name, raising=False)
+
+    def write(**config):
+        config.setdefault("keys_location", DATA)
+        config.setdefault("api_root", "http://localhost:1")
+        text = json.dumps(config)
+        if path.exists():
+            # a different size, the change is seen whatever the mtime resolution
+            text += " " * (path.stat().st_size + 1 - len(text))
+        path.write_text(text)
+
+    return write
+
+
+def test_carry_over():
+    previous = Config(keys=KEYS, token_cache_size=10, response_cache_size=10, rate_limit_reserve=5)
+    config = Config(keys=KEYS, token_cache_size=10, response_cache_size=20, rate_limit_reserve=5)
+    carry_over(previous, config)
+
+    assert config.token_cache is previous.token_cache
+    assert config.response_cache is not previous.response_cache
+    assert config.rate_limits is previous.rate_limits
+    assert config.limiter is previous.limiter
+    # rebuilt for the new scopes
+    assert config.decisions is not previous.decisions
+
+
+def test_carry_over_token_cache_needs_same_keys():
+    previous = Config(keys=KEYS, token_cache_size=10)
+    config = Config(keys=None, token_cache_size=10)
+    carry_over(previous, config)
+
+    assert config.token_cache is not previous.token_cache
+
+
+def test_reloader_swaps_config(config_file):
+    config_file(scopes={"read": ["GET /user"]})
+    swapped = []
+    reloader = Reloader(load_config(), swapped.append)
+    assert not reloader.changed()
+
+    config_file(scopes={"read": ["GET /user", "GET /repos/.*"]})
+    assert reloader.changed()
+    assert reloader.poll()
+    assert not reloader.changed()
+    assert swapped == [reloader.config]
+    assert [permission.path for permission in reloader.config.scopes["read"]] == ["/user", "/repos/.*"]
+    assert reloader.stats() == {"reloads": 1, "failures": 0}
+
+
+def test_reloader_keeps_config_on_failure(config_file):
+    config_file(scopes={"read": ["GET /user"]})
+    config = load_config()
+    swapped = []
+    reloader = Reloader(config, swapped.append)
+
+    config_file(scopes={"read": ["GET"]})
+    assert not reloader.poll()
+    assert reloader.config is config
+    assert swapped == []
+    assert reloader.stats() == {"reloads": 0, "failures": 1}
+    # not tried again until the files change
+    assert not reloader.changed()
+
+
+def test_reloader_watches_plugins(config_file, tmp_path):
+    plugins = tmp_path / "plugins"
+    plugins.mkdir()
+    (plugins / "gate.py").write_text("def is_request_allowed(method, path):\n    return False\n")
+    config_file(plugins_location=str(plugins))
+    reloader = Reloader(load_config(), lambda config: None)
+    plugin = reloader.config.scopes["gate"]
+
+    (plugins / "other.py").write_text("def is_request_allowed(method, path):\n    return True\n")
+    assert reloader.poll()
+    # not imported again, unchanged
+    assert reloader.config.scopes["gate"] is plugin
+    assert reloader.config.scopes["other"].is_request_allowed("GET", "/")
+
+    (plugins / "gate.py").write_text("def is_request_allowed(method, path):\n    return True  # open\n")
+    assert reloader.poll()
+    assert reloader.config.scopes["gate"] is not plugin
+    assert reloader.config.scopes["gate"].is_request_allowed("GET", "/")
+
+
+def test_flask_proxy_reload(config_file):
+    config_file(scopes={"read": ["GET /user"]})
+    app = proxy.build_app(reload=True)
+    client = app.test_client()
+    token = magictoken.create(KEYS, "api token", scopes=["read"])
+    previous = app.config["CONFIG"]
+
+    assert client.get("/repos/org/repo", headers={"Authorization": f"Bearer {token}"}).status_code == 401
+
+    config_file(scopes={"read": []})
+    assert app.config["RELOADER"].reload()
+    assert app.config["CONFIG"] is not previous
+    assert app.config["CONFIG"].scopes == {"read": []}
+    assert "magicproxy_config_reload_reloads 1" in client.get("/__metrics").data.decode("utf-8")
+
+
+def test_async_proxy_reload(config_file):
+    config_file(scopes={"read": ["GET /user"]}, config_reload_interval=0.05)
+    token = magictoken.create(KEYS, "api token", scopes=["read"])
+
+    async def test():
+        app = await async_proxy.build_app(reload=True)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get("/repos/org/repo", headers={"Authorization": f"Bearer {token}"})
+            assert response.status == 403
+
+            config_file(scopes={"read": []}, config_reload_interval=0.05)
+            for _ in range(100):
+                if app["RELOADER"].reloads:
+                    break
+                await asyncio.sleep(0.05)
+            assert app["CONFIG_HOLDER"].config.scopes == {"read": []}
+            assert app["CRYPTO_EXECUTOR"].config is app["CONFIG_HOLDER"].config
+
+    asyncio.run(test())
@@ -1,14 +1,22 @@
+import asyncio
+import inspect
+import json
+import logging
 import os
+import threading
 import types
 
 import pytest
 
+from magicproxy.config import Config, load_config
 from magicproxy.plugins import (
     load_plugin,
     InvalidPluginError,
+    LazyPlugin,
     load_plugins,
     PluginNotFoundError,
 )
+from magicproxy.scopes import response_callback_async, validate_request, validate_request_async
 
 plugins_dir = os.path.join(os.path.dirname(__file__), "data", "plugins")
 invalid_plugins_dir = os.path.join(os.path.dirname(__file__), "data", "invalid_plugins")
@@ -68,4 +76,140 @@ def test_plugins_load():
     assert "allow_none" in plugins
     assert "allow_all" in plugins
     assert "other_code" in plugins
+    assert "async_allow_all" in plugins
     assert "invalid_syntax" not in plugins
+
+
+def test_plugin_load_async():
+    plugin_path = os.path.join(plugins_dir, "async_allow_all.py")
+    key, module = load_plugin(plugin_path)
+    assert key == "async_allow_all"
+    assert inspect.iscoroutinefunction(module.is_request_allowed)
+
+
+def test_validate_request_with_async_plugin():
+    _, module = load_plugin(os.path.join(plugins_dir, "async_allow_all.py"))
+    config = Config(scopes={"async_allow_all": module})
+
+    assert validate_request(config, "GET", "/", scopes=["async_allow_all"])
+    assert asyncio.run(validate_request_async(config, "GET", "/", scopes=["async_allow_all"]))
+
+
+def test_sync_hooks_run_in_thread_pool():
+    calls = []
+
+    plugin = types.ModuleType("sync_plugin")
+
+    def is_request_allowed(method, path):
+        calls.append(threading.current_thread())
+        return True
+
+    def response_callback(method, path, content, code, headers):
+        calls.append(threading.current_thread())
+
+    plugin.is_request_allowed = is_request_allowed
+    plugin.response_callback = response_callback
+    config = Config(scopes={"sync_plugin": plugin})
+
+    async def test():
+        assert await validate_request_async(config, "GET", "/", scopes=["sync_plugin"])
+        await response_callback_async(config, "GET", "/", b"", 200, {}, scopes=["sync_plugin"])
+
+    asyncio.run(test())
+    assert len(calls) == 2
+    assert threading.main_thread() not in calls
+
+
+def write_plugin(folder, name, marker):
+    plugin_path = folder / f"{name}.py"
+    plugin_path.write_text(
+        f"open({str(marker)!r}, 'a').write('{name}\\n')\n\n\ndef is_request_allowed(method, path):\n    return True\n"
+    )
+    return plugin_path
+
+
+def test_plugins_load_lazy(tmp_path):
+    marker = tmp_path / "imported"
+    write_plugin(tmp_path, "lazy_one", marker)
+    write_plugin(tmp_path, "lazy_two", marker)
+
+    plugins = load_plugins(tmp_path, lazy=True)
+    assert sorted(plugins) == ["lazy_one", "lazy_two"]
+    assert all(isinstance(plugin, LazyPlugin) for plugin in plugins.values())
+    assert not marker.exists()
+
+    config = Config(scopes=plugins)
+    assert validate_request(config, "GET", "/", scopes=["lazy_one"])
+    assert marker.read_text() == "lazy_one\n"
+
+    # imported already, and unchanged
+    assert not isinstance(load_plugins(tmp_path, lazy=True)["lazy_one"], LazyPlugin)
+
+
+def test_load_config_plugin_settings(tmp_path, monkeypatch):
+    marker = tmp_path / "imported"
+    write_plugin(tmp_path, "lazy_setting", marker)
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"plugins_location": str(tmp_path), "plugins_lazy": False}))
+    monkeypatch.setenv("CONFIG_FILE", str(config_file))
+    monkeypatch.delenv("PLUGINS_LAZY", raising=False)
+
+    # the keyword arguments come first, then the environment, then the file
+    config = load_config(_load_keys=False, plugins_lazy=True)
+    assert isinstance(config.scopes["lazy_setting"], LazyPlugin)
+    assert not marker.exists()
+
+    monkeypatch.setenv("PLUGINS_LAZY", "true")
+    assert isinstance(load_config(_load_keys=False).scopes["lazy_setting"], LazyPlugin)
+
+
+def test_lazy_plugin_invalid_on_first_use():
+    plugin = LazyPlugin(os.path.join(invalid_plugins_dir, "invalid_plugin.py"))
+    with pytest.raises(InvalidPluginError):
+        plugin.is_request_allowed
+
+
+def test_lazy_plugin_import_failure_is_kept(tmp_path):
+    marker = tmp_path / "imported"
+    plugin_path = tmp_path / "broken.py"
+    plugin_path.write_text(f"open({str(marker)!r}, 'a').write('broken\\n')\nraise ImportError('missing dependency')\n")
+    config = Config(scopes={"broken": LazyPlugin(plugin_path)})
+
+    for _ in range(2):
+        with pytest.raises(InvalidPluginError):
+            validate_request(config, "GET", "/", scopes=["broken"])
+    assert marker.read_text() == "broken\n"
+
+
+def test_lazy_plugin_imported_off_the_event_loop(tmp_path):
+    plugin_path = tmp_path / "lazy.py"
+    plugin_path.write_text(
+        "import threading\n\nthread = threading.current_thread()\n\n\n"
+        "def is_request_allowed(method, path):\n    return True\n"
+    )
+    plugin = LazyPlugin(plugin_path)
+    config = Config(scopes={"lazy": plugin})
+
+    async def test():
+        assert await validate_request_async(config, "GET", "/", scopes=["lazy"])
+
+    asyncio.run(test())
+    assert plugin.thread is not threading.main_thread()
+
+
+def test_plugins_load_in_parallel(tmp_path):
+    marker = tmp_path / "imported"
+    for number in range(4):
+        write_plugin(tmp_path, f"plugin_{number}", marker)
+
+    plugins = load_plugins(tmp_path)
+    assert sorted(plugins) == [f"plugin_{number}" for number in range(4)]
+    assert sorted(marker.read_text().split()) == sorted(plugins)
+
+
+def test_plugin_import_budget(tmp_path, caplog):
+    plugin_path = write_plugin(tmp_path, "slow", tmp_path / "imported")
+
+    with caplog.at_level(logging.INFO):
+        load_plugin(plugin_path, budget=0)
+    assert any(record.levelno == logging.WARNING and "budget" in record.getMessage() for record in caplog.records)
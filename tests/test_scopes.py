@@ -1,20 +1,19 @@
+import types
+
 from magicproxy.config import Config
-from magicproxy.scopes import is_request_allowed, validate_request
+from magicproxy.matcher import PermissionMatcher
+from magicproxy.scopes import allowed_matcher, allowed_matchers, validate_request
 from magicproxy.types import Permission
 
 
 def test_valid_scopes():
-    assert is_request_allowed(Permission(method="GET", path="/this"), "GET", "/this")
-    assert is_request_allowed(Permission(method="GET", path="/subpath/*"), "GET", "/subpath/works")
-    assert is_request_allowed(
-        Permission(method="GET", path="/subpath*"),
-        "GET",
-        "/subpath/works/also/that/way",
-    )
-    assert is_request_allowed(Permission(method="GET", path="/this*"), "GET", "this")
+    assert PermissionMatcher([Permission(method="GET", path="/this")]).match("GET", "/this")
+    assert PermissionMatcher([Permission(method="GET", path="/subpath/*")]).match("GET", "/subpath/works")
+    assert PermissionMatcher([Permission(method="GET", path="/subpath*")]).match("GET", "/subpath/works/also/that/way")
+    assert PermissionMatcher([Permission(method="GET", path="/this*")]).match("GET", "this")
 
-    assert not is_request_allowed(Permission(method="GET", path="/this"), "GET", "/that")
-    assert not is_request_allowed(Permission(method="GET", path="/subpath*"), "PUT", "/different/method/fails")
+    assert not PermissionMatcher([Permission(method="GET", path="/this")]).match("GET", "/that")
+    assert not PermissionMatcher([Permission(method="GET", path="/subpath*")]).match("PUT", "/different/method/fails")
 
 
 def test_request_allowed():
@@ -73,3 +72,64 @@ def test_request_multiple_scopes():
     assert validate_request(config, "POST", "/those", scopes=other_scopes)
     assert validate_request(config, "POST", "/them", scopes=other_scopes)
     assert not validate_request(config, "GET", "/those", scopes=other_scopes)
+
+
+def test_request_allowed_matcher_memoized():
+    allowed = ["GET /memoized", "POST /memoized/.+"]
+    config = Config()
+    hits = allowed_matchers.hits
+
+    assert validate_request(config, "GET", "/memoized", allowed=allowed)
+    assert validate_request(config, "POST", "/memoized/1", allowed=list(allowed))
+    assert not validate_request(config, "GET", "/other", allowed=allowed)
+
+    assert allowed_matchers.hits == hits + 2
+    assert allowed_matcher(allowed) is allowed_matcher(list(allowed))
+
+
+def test_decisions_cached():
+    config = Config(scopes={"this_scope": [Permission(method="GET", path="/this")]})
+
+    assert validate_request(config, "GET", "/this", scopes=["this_scope"])
+    assert validate_request(config, "GET", "this", scopes=["this_scope"])
+    assert not validate_request(config, "GET", "/that", scopes=["this_scope"])
+    assert config.decisions.stats()["hits"] == 1
+
+    # the scopes change, the decisions made with the previous ones are dropped
+    config.scopes["this_scope"] = [Permission(method="GET", path="/that")]
+    config.compile()
+    assert not validate_request(config, "GET", "/this", scopes=["this_scope"])
+    assert validate_request(config, "GET", "/that", scopes=["this_scope"])
+
+
+def plugin(cacheable):
+    module = types.ModuleType("plugin")
+    module.calls = 0
+
+    def is_request_allowed(method, path):
+        module.calls += 1
+        return True
+
+    module.is_request_allowed = is_request_allowed
+    if cacheable:
+        module.cacheable = True
+    return module
+
+
+def test_plugin_decisions_cached_when_cacheable():
+    dynamic, pure = plugin(cacheable=False), plugin(cacheable=True)
+    config = Config(scopes={"dynamic": dynamic, "pure": pure})
+
+    for _ in range(3):
+        assert validate_request(config, "GET", "/this", scopes=["dynamic"])
+        assert validate_request(config, "GET", "/this", scopes=["pure"])
+
+    assert dynamic.calls == 3
+    assert pure.calls == 1
+
+
+def test_decision_cache_disabled():
+    config = Config(decision_cache_size=0)
+
+    assert config.decisions is None
+    assert validate_request(config, "GET", "/this", allowed=["GET /this"])
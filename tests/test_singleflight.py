@@ -0,0 +1,43 @@
+import asyncio
+
+from magicproxy.singleflight import SingleFlight
+
+
+def test_key():
+    single_flight = SingleFlight(max_size=1024)
+    headers = {"Accept": "application/json", "User-Agent": "ci/1"}
+    key = single_flight.key("GET", "repos", "page=2", headers, "token")
+
+    assert (
+        single_flight.key("GET", "repos", "page=2", {"Accept": "application/json", "User-Agent": "ci/2"}, "token")
+        == key
+    )
+    assert single_flight.key("GET", "repos", "page=2", headers, "other_token") != key
+    assert single_flight.key("GET", "repos", "page=2", {"Accept": "text/plain"}, "token") != key
+    assert single_flight.key("GET", "repos", "page=3", headers, "token") != key
+    assert single_flight.key("POST", "repos", "page=2", headers, "token") is None
+
+
+def test_key_ignores_magic_token():
+    single_flight = SingleFlight(max_size=1024)
+    key = single_flight.key("GET", "repos", "", {"Authorization": "Bearer first magic token"}, "token")
+
+    # another magic token for the same API token
+    assert single_flight.key("GET", "repos", "", {"Authorization": "Bearer second magic token"}, "token") == key
+    assert single_flight.key("GET", "repos", "", {"Authorization": "Bearer second magic token"}, "other_token") != key
+
+
+def test_join_and_finish():
+    async def run():
+        single_flight = SingleFlight(max_size=1024)
+        assert single_flight.join("key") is None
+        call = single_flight.join("key")
+        assert call is not None
+
+        single_flight.finish("key", "result")
+        assert await call == "result"
+        # the next request leads a new call
+        assert single_flight.join("key") is None
+        assert single_flight.stats() == {"in_flight": 1, "leaders": 2, "followers": 1}
+
+    asyncio.run(run())
@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from magicproxy import workers
+
+
+def test_listening_socket():
+    sock = workers.listening_socket("localhost", 0)
+    try:
+        assert sock.get_inheritable()
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR)
+        with socket.create_connection(sock.getsockname()[:2], timeout=5):
+            pass
+    finally:
+        sock.close()
+
+
+def test_serve_restarts_crashed_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(workers, "RESTART_DELAY", 0.01)
+    runs = tmp_path / "runs"
+
+    def run_worker():
+        with open(runs, "a") as runs_file:
+            runs_file.write(f"{os.getpid()}\n")
+        if len(runs.read_text().split()) < 3:
+            raise RuntimeError("crashed")
+        time.sleep(60)
+
+    master = multiprocessing.get_context("fork").Process(target=workers.serve, args=(run_worker, 1))
+    master.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not runs.exists() or len(runs.read_text().split()) < 3:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        master.terminate()
+        master.join(10)
+
+    assert master.exitcode == 0
+    last_worker = int(runs.read_text().split()[-1])
+    time.sleep(0.1)
+    try:
+        os.kill(last_worker, 0)
+        alive = True
+    except ProcessLookupError:
+        alive = False
+    assert not alive
+
+
+def test_serve_passes_sighup_on(tmp_path):
+    ready = tmp_path / "ready"
+    reloads = tmp_path / "reloads"
+
+    def run_worker():
+        signal.signal(signal.SIGHUP, lambda signum, frame: reloads.write_text("reloaded"))
+        ready.write_text("ready")
+        time.sleep(60)
+
+    master = multiprocessing.get_context("fork").Process(target=workers.serve, args=(run_worker, 1))
+    master.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not ready.exists():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        os.kill(master.pid, signal.SIGHUP)
+        while not reloads.exists():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        master.terminate()
+        master.join(10)